@@ -0,0 +1,99 @@
+"""
+This script measures recall@k and latency of the approximate nearest neighbour index (IVFIndex)
+for different values of nprobe, compared to the exact search used by default.
+
+By default a synthetic, clustered feature matrix is generated, as uniformly random vectors have
+no neighbourhood structure and are a worst case for any approximate index. Existing features
+can be benchmarked with the --features option, e.g. precomputedFeatures/bso/features/features.npy.
+In that case, the queries are perturbed copies of random indexed vectors.
+
+Usage:
+
+    python benchmarks/benchmarkAnn.py
+    python benchmarks/benchmarkAnn.py --size 1000000 --nprobes 1,4,16,64
+    python benchmarks/benchmarkAnn.py --features precomputedFeatures/bso/features/features.npy
+
+Parameters:
+    --size: The number of synthetic vectors. Optional, defaults to 200000.
+    --features: Path to a features.npy file to use instead of synthetic vectors. Optional.
+    --lists: The number of lists of the index. Optional, defaults to 4 * sqrt(number of vectors).
+    --nprobes: Comma separated list of nprobe values. Optional, defaults to 1,2,4,8,16,32,64.
+    --queries: The number of queries. Optional, defaults to 100.
+    --limit: The k of recall@k. Optional, defaults to 100.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import time
+import numpy as np
+from sariIiifClipSearch.ann import IVFIndex
+from sariIiifClipSearch.search import blockedTopK
+
+DIMENSIONS = 512
+
+def normalise(vectors):
+    return (vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)).astype(np.float32)
+
+def syntheticFeatures(size, rng):
+    # Mixture of gaussians around random centres, which resembles the neighbourhood structure of CLIP embeddings
+    centres = normalise(rng.normal(size=(max(1, size // 500), DIMENSIONS)))
+    features = np.empty((size, DIMENSIONS), dtype=np.float32)
+    chunk = 100000
+    for start in range(0, size, chunk):
+        count = min(chunk, size - start)
+        features[start:start + count] = normalise(centres[rng.integers(0, centres.shape[0], count)] + rng.normal(scale=0.04, size=(count, DIMENSIONS)))
+    return features
+
+def run(options):
+    rng = np.random.default_rng(0)
+    if 'features' in options:
+        features = np.load(options['features'])
+    else:
+        print(f"Generating {options['size']} synthetic vectors")
+        features = syntheticFeatures(options['size'], rng)
+    queries = normalise(features[rng.integers(0, features.shape[0], options['queries'])] + rng.normal(scale=0.03, size=(options['queries'], DIMENSIONS)))
+
+    start = time.perf_counter()
+    index = IVFIndex.train(features, lists=options.get('lists'))
+    print(f"Trained index with {index.lists} lists in {time.perf_counter() - start:.1f}s")
+
+    limit = options['limit']
+    exactResults = []
+    timings = []
+    for queryFeatures in queries:
+        start = time.perf_counter()
+        indices, _ = blockedTopK(queryFeatures, features, limit)
+        timings.append(time.perf_counter() - start)
+        exactResults.append(set(indices))
+    exactTime = np.median(timings) * 1000
+
+    print(f"{'search':>8} {'nprobe':>7} {f'recall@{limit}':>11} {'median (ms)':>12} {'speedup':>8}")
+    print(f"{'exact':>8} {'-':>7} {1:>11.3f} {exactTime:>12.2f} {1:>7.1f}x")
+    for nprobe in options['nprobes']:
+        timings = []
+        recall = []
+        for queryFeatures, exact in zip(queries, exactResults):
+            start = time.perf_counter()
+            indices, _ = index.search(queryFeatures, features, limit, nprobe=nprobe)
+            timings.append(time.perf_counter() - start)
+            recall.append(len(exact.intersection(indices)) / len(exact))
+        annTime = np.median(timings) * 1000
+        print(f"{'ivf':>8} {nprobe:>7} {np.mean(recall):>11.3f} {annTime:>12.2f} {exactTime / annTime:>7.1f}x")
+
+if __name__ == "__main__":
+    options = {
+        'size': 200000,
+        'nprobes': [1, 2, 4, 8, 16, 32, 64],
+        'queries': 100,
+        'limit': 100
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--nprobes':
+                options['nprobes'] = [int(nprobe) for nprobe in value.split(',')]
+            elif arg == '--features':
+                options['features'] = value
+            else:
+                options[arg[2:]] = int(value)
+    run(options)
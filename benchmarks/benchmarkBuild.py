@@ -0,0 +1,120 @@
+"""
+This script compares the throughput of building the features with the sequential phases (downloadImages, then
+processImages) and with the overlapped pipeline of build.py (downloadAndProcessImages), once storing the images and once
+decoding them in memory (storeImages=False).
+
+A fixture set of synthetic JPEG images is generated and served by a local HTTP server that answers IIIF image requests
+after a configurable latency, standing in for a IIIF image server. All variants then build the features of all images
+into a fresh data directory (this requires the CLIP model). The pipeline reports the throughput and utilization of
+every stage and the occupancy of its queues when it has finished, then the images per second and the disk space used by
+the data directory of every variant are printed.
+
+Usage:
+
+    python benchmarks/benchmarkBuild.py
+    python benchmarks/benchmarkBuild.py --images 2000 --latency 50 --decodeProcesses 4
+
+Parameters:
+    --images: The number of images in the fixture set. Optional, defaults to 512.
+    --latency: The latency of the fixture server per request in milliseconds. Optional, defaults to 20.
+    --threads: The number of download threads. Optional, defaults to 16.
+    --batchSize: The number of images encoded at once. Optional, defaults to 64.
+    --decodeProcesses: The number of processes decoding images in the pipeline. Optional, defaults to half of the CPU cores.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import csv
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from pathlib import Path
+from PIL import Image
+from sariIiifClipSearch import Images
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    # Answers /iiif/<name>/full/<size>/0/default.jpg with the image <name>.jpg, ignoring the requested size
+    latency = 0
+
+    def translate_path(self, path):
+        name = path.split('/')[2]
+        return os.path.join(self.directory, name + '.jpg')
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+def createFixtures(directory, images):
+    # Smooth random images at the size of the derivatives requested by build.py
+    random = np.random.default_rng(0)
+    for i in range(images):
+        small = random.integers(0, 256, (12, 16, 3), dtype=np.uint8)
+        Image.fromarray(small).resize((640, 480), Image.BICUBIC).save(directory / f"image{i}.jpg", quality=90)
+
+def serveFixtures(directory, latency):
+    handler = type('Handler', (FixtureHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def writeImageCSV(path, url, images):
+    with open(path, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['iiif_url'])
+        writer.writeheader()
+        for i in range(images):
+            writer.writerow({'iiif_url': f"{url}/iiif/image{i}"})
+
+def run(options):
+    workDir = Path(tempfile.mkdtemp())
+    try:
+        fixtureDir = workDir / 'fixtures'
+        fixtureDir.mkdir()
+        print(f"Creating {options['images']} fixture images")
+        createFixtures(fixtureDir, options['images'])
+        server = serveFixtures(fixtureDir, options['latency'] / 1000)
+        imageCSV = workDir / 'images.csv'
+        writeImageCSV(imageCSV, f"http://127.0.0.1:{server.server_address[1]}", options['images'])
+
+        def build(name, steps, storeImages=True):
+            images = Images(mode=Images.MODE_CSV, imageCSV=imageCSV, dataDir=workDir / name, threads=options['threads'],
+                batchSize=options['batchSize'], decodeProcesses=options.get('decodeProcesses'), storeImages=storeImages)
+            start = time.perf_counter()
+            for step in steps:
+                getattr(images, step)()
+            duration = time.perf_counter() - start
+            rows = np.load(workDir / name / 'features' / 'features.npy', mmap_mode='r').shape[0]
+            disk = sum(path.stat().st_size for path in (workDir / name).rglob('*') if path.is_file())
+            return rows, duration, disk
+
+        results = {
+            'sequential': build('sequential', ['downloadImages', 'processImages']),
+            'pipeline': build('pipeline', ['downloadAndProcessImages']),
+            'streaming': build('streaming', ['downloadAndProcessImages'], storeImages=False)
+        }
+        server.shutdown()
+
+        print(f"{'variant':>12} {'images':>8} {'seconds':>8} {'images/s':>9} {'disk (MB)':>10}")
+        for name, (rows, duration, disk) in results.items():
+            print(f"{name:>12} {rows:>8} {duration:>8.1f} {rows / duration:>9.1f} {disk / 1024 / 1024:>10.1f}")
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    options = {
+        'images': 512,
+        'latency': 20,
+        'threads': 16,
+        'batchSize': 64
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            options[arg[2:]] = int(sys.argv[i + 2])
+
+    run(options)
@@ -0,0 +1,125 @@
+"""
+This script compares loading the features and the image lookup from the index bundle with loading them from
+features.npy, imageIds.csv and the image CSV file.
+
+A synthetic data directory with the requested number of images is written to a temporary directory, containing
+features.npy, imageIds.csv, an images.csv file with a few additional columns and the index bundle. Every way of
+loading is then measured in a fresh process, which reports:
+
+    - the time to load the features and the lookup from a row to the image ID and IIIF URL
+    - the time to look up 1000 image IDs
+    - the resident memory of the process after loading, minus the memory before
+    - whether pandas has been imported
+
+Usage:
+
+    python benchmarks/benchmarkBundle.py
+    python benchmarks/benchmarkBundle.py --size 1000000
+
+Parameters:
+    --size: The number of synthetic images. Optional, defaults to 1000000.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import csv
+import subprocess
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+
+DIMENSIONS = 512
+
+def residentMemory():
+    # Returns the resident memory of the current process in MB
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def writeDataDir(dataDir, size):
+    from sariIiifClipSearch import writeIndexBundle
+
+    featuresDir = dataDir / 'features'
+    featuresDir.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    features = np.lib.format.open_memmap(featuresDir / 'features.npy', mode='w+', dtype=np.float32, shape=(size, DIMENSIONS))
+    chunk = 100000
+    for start in range(0, size, chunk):
+        block = rng.normal(size=(min(chunk, size - start), DIMENSIONS)).astype(np.float32)
+        features[start:start + chunk] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    features.flush()
+    del features
+
+    with open(featuresDir / 'imageIds.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['image_id'])
+        for i in range(size):
+            writer.writerow([f"image-{i:08d}"])
+    with open(dataDir / 'images.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['localIdentifier', 'iiif_url', 'title', 'creator'])
+        for i in range(size):
+            writer.writerow([f"image-{i:08d}", f"https://iiif.example.org/iiif/2/image-{i:08d}", f"Title of image {i}", f"Creator {i % 1000}"])
+
+    writeIndexBundle(featuresDir, imageCSV=dataDir / 'images.csv')
+
+def measure(dataDir, bundle):
+    from sariIiifClipSearch import IndexBundle, StringTable, readImageLookup
+
+    featuresDir = Path(dataDir) / 'features'
+    memoryBefore = residentMemory()
+    start = time.perf_counter()
+    if bundle:
+        loaded = IndexBundle.load(featuresDir / IndexBundle.FILENAME)
+        features, imageIDs = loaded.features, loaded.imageIDs
+    else:
+        features = np.load(featuresDir / 'features.npy')
+        ids, urls = readImageLookup(featuresDir, Path(dataDir) / 'images.csv')
+        imageIDs, imageUrls = StringTable.fromStrings(ids), StringTable.fromStrings(urls)
+    loadTime = time.perf_counter() - start
+    memory = residentMemory() - memoryBefore
+
+    rng = np.random.default_rng(1)
+    start = time.perf_counter()
+    for row in rng.integers(0, features.shape[0], 1000):
+        imageIDs.find(f"image-{row:08d}")
+    lookupTime = time.perf_counter() - start
+
+    return loadTime, lookupTime * 1000, memory, int('pandas' in sys.modules)
+
+def run(options):
+    with tempfile.TemporaryDirectory() as tempDir:
+        dataDir = Path(tempDir)
+        print(f"Writing {options['size']} synthetic images to {dataDir}")
+        writeDataDir(dataDir, options['size'])
+
+        print(f"{'source':>8} {'load (s)':>9} {'1000 lookups (ms)':>18} {'memory MB':>10} {'pandas':>7}")
+        for source, bundle in [('csv', 0), ('bundle', 1)]:
+            # Every way of loading runs in its own process so that the measurements are independent
+            output = subprocess.run([
+                sys.executable, __file__, '--measure', str(dataDir),
+                '--bundle', str(bundle)
+            ], capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+            loadTime, lookupTime, memory, pandas = [float(value) for value in output.split(',')]
+            print(f"{source:>8} {loadTime:>9.3f} {lookupTime:>18.2f} {memory:>10.1f} {'yes' if pandas else 'no':>7}")
+
+if __name__ == "__main__":
+    options = {
+        'size': 1000000
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--measure':
+                options['measure'] = value
+            else:
+                options[arg[2:]] = int(value)
+
+    if 'measure' in options:
+        result = measure(options['measure'], options['bundle'] == 1)
+        print(','.join(str(value) for value in result))
+    else:
+        run(options)
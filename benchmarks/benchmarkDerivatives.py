@@ -0,0 +1,130 @@
+"""
+This script compares downloading fixed 640 pixel wide JPEG derivatives with derivatives sized for the CLIP model.
+
+A local HTTP server stands in for a IIIF image server: it answers info.json and resizes large synthetic source images
+of different aspect ratios to the requested size and format. For every variant, all images are downloaded and the
+transferred bytes (which are also the bytes stored on disk), the pixels per image and the time to decode and
+preprocess an image as build.py does are measured. The preprocessing of the CLIP model is used, the model weights
+are not needed.
+
+The variants are:
+    640: The fixed derivatives requested before, /full/640,/0/default.jpg.
+    model: Derivatives fitted into a box of twice the input resolution, as requested by build.py.
+    model-webp: The same derivatives in WebP, if requested with --imageFormats webp,jpg.
+
+Usage:
+
+    python benchmarks/benchmarkDerivatives.py
+    python benchmarks/benchmarkDerivatives.py --images 500 --size 336
+
+Parameters:
+    --images: The number of images downloaded per variant. Optional, defaults to 200.
+    --size: The input resolution of the model. Optional, defaults to 224, the resolution of ViT-B/32.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import json
+import re
+import threading
+import time
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from PIL import Image
+from sariIiifClipSearch import Downloader, ImageServices
+from sariIiifClipSearch.pipeline import _decodeImage
+# sariIiifClipSearch makes the CLIP module importable
+from clip import clip
+
+# Source images of the typical aspect ratios of paintings, photographs and manuscripts
+SOURCESIZES = [(2400, 1800), (1800, 2400), (3000, 2000), (2000, 2000), (1500, 2600)]
+
+class IiifHandler(BaseHTTPRequestHandler):
+    # Answers /iiif/<n>/info.json and /iiif/<n>/full/<size>/0/default.<format> for the source image n modulo the number of sources
+    protocol_version = 'HTTP/1.1'
+    sources = []
+
+    def do_GET(self):
+        match = re.match(r'/iiif/(\d+)/(info\.json|full/([^/]+)/0/default\.(\w+))$', self.path)
+        if not match:
+            return self.answer(404, b'', 'text/plain')
+        source = self.sources[int(match.group(1)) % len(self.sources)]
+        if match.group(2) == 'info.json':
+            info = {'@context': 'http://iiif.io/api/image/2/context.json', 'width': source.width, 'height': source.height,
+                'profile': ['http://iiif.io/api/image/2/level2.json', {'formats': ['webp']}]}
+            return self.answer(200, json.dumps(info).encode(), 'application/json')
+        image = source.resize(self.size(match.group(3), source.width, source.height), Image.BILINEAR)
+        buffer = BytesIO()
+        image.save(buffer, format='WEBP' if match.group(4) == 'webp' else 'JPEG', quality=85)
+        self.answer(200, buffer.getvalue(), f"image/{match.group(4)}")
+
+    @staticmethod
+    def size(size, width, height):
+        if size in ('full', 'max'):
+            return width, height
+        if size.startswith('!'):
+            boxWidth, boxHeight = (int(value) for value in size[1:].split(','))
+            scale = min(boxWidth / width, boxHeight / height)
+            return round(width * scale), round(height * scale)
+        requestWidth, requestHeight = size.split(',')
+        if requestWidth:
+            return int(requestWidth), round(height * int(requestWidth) / width)
+        return round(width * int(requestHeight) / height), int(requestHeight)
+
+    def answer(self, status, body, contentType):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def createSources():
+    random = np.random.default_rng(0)
+    sources = []
+    for width, height in SOURCESIZES:
+        small = random.integers(0, 256, (height // 100, width // 100, 3), dtype=np.uint8)
+        sources.append(Image.fromarray(small).resize((width, height), Image.BICUBIC))
+    return sources
+
+def run(options):
+    IiifHandler.sources = createSources()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), IiifHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseUrl = f"http://127.0.0.1:{server.server_address[1]}/iiif"
+    preprocess = clip._transform(options['size'])
+    downloader = Downloader()
+
+    variants = {
+        '640': lambda iiifUrl: iiifUrl + '/full/640,/0/default.jpg',
+        'model': ImageServices(downloader.fetch, size=options['size']).url,
+        'model-webp': ImageServices(downloader.fetch, size=options['size'], formats=('webp', 'jpg')).url
+    }
+    print(f"{'variant':>12} {'KB/image':>9} {'MB total':>9} {'pixels/image':>13} {'decode (ms)':>12} {'min edge':>9}")
+    for name, url in variants.items():
+        sizes, pixels, decodeTimes, shortestEdges = [], [], [], []
+        for i in range(options['images']):
+            content = downloader.fetch(url(f"{baseUrl}/{i}"))
+            sizes.append(len(content))
+            with Image.open(BytesIO(content)) as image:
+                pixels.append(image.width * image.height)
+                shortestEdges.append(min(image.width, image.height))
+            start = time.perf_counter()
+            _decodeImage(content, preprocess)
+            decodeTimes.append(time.perf_counter() - start)
+        print(f"{name:>12} {np.mean(sizes) / 1024:>9.1f} {np.sum(sizes) / 1024 / 1024:>9.1f} {np.mean(pixels):>13.0f} {np.mean(decodeTimes) * 1000:>12.2f} {min(shortestEdges):>9}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    options = {
+        'images': 200,
+        'size': 224
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            options[arg[2:]] = int(sys.argv[i + 2])
+
+    run(options)
@@ -0,0 +1,92 @@
+"""
+This script compares the start up time and memory use of the CLIP model loaded with and without the image encoder.
+
+Every configuration is measured in a fresh process (the model is downloaded to ~/.cache/clip first if needed), which reports:
+
+    - the time to load the model
+    - the resident memory of the process after loading the model, minus the memory before
+    - the median latency of encoding a text query
+    - for the text only model, the time to load the image encoder with the first query by image (CLIP_IMAGE_ENCODER=lazy)
+
+Usage:
+
+    python benchmarks/benchmarkImageEncoder.py
+    python benchmarks/benchmarkImageEncoder.py --queries 50
+
+Parameters:
+    --queries: The number of text queries encoded per configuration. Optional, defaults to 20.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src', 'clip'))
+
+import gc
+import subprocess
+import time
+import numpy as np
+
+MODEL = 'ViT-B/32'
+
+def residentMemory():
+    # Returns the resident memory of the current process in MB
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def measure(visual, queries):
+    import torch
+    from clip import clip
+
+    memoryBefore = residentMemory()
+    start = time.perf_counter()
+    model, _ = clip.load(MODEL, device="cpu", visual=visual)
+    loadTime = time.perf_counter() - start
+    gc.collect()
+    memory = residentMemory() - memoryBefore
+
+    timings = []
+    with torch.no_grad():
+        for i in range(queries):
+            tokens = clip.tokenize(f"a photo of a mountain lake number {i}")
+            start = time.perf_counter()
+            model.encode_text(tokens)
+            timings.append(time.perf_counter() - start)
+
+    visualLoadTime = 0
+    if not visual:
+        start = time.perf_counter()
+        clip.load_visual(model, MODEL)
+        visualLoadTime = time.perf_counter() - start
+
+    return loadTime, memory, np.median(timings) * 1000, visualLoadTime
+
+def run(options):
+    # Download the model before measuring
+    from clip import clip
+    clip.download(MODEL)
+
+    print(f"{'profile':>10} {'load (s)':>9} {'memory MB':>10} {'text (ms)':>10} {'lazy image encoder (s)':>23}")
+    for profile, visual in [('full', 1), ('text only', 0)]:
+        output = subprocess.run([
+            sys.executable, __file__, '--measure', str(visual),
+            '--queries', str(options['queries'])
+        ], capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+        loadTime, memory, textLatency, visualLoadTime = [float(value) for value in output.split(',')]
+        print(f"{profile:>10} {loadTime:>9.2f} {memory:>10.1f} {textLatency:>10.2f} {visualLoadTime if not visual else '-':>23}")
+
+if __name__ == "__main__":
+    options = {
+        'queries': 20
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            options[arg[2:]] = int(value)
+
+    if 'measure' in options:
+        result = measure(options['measure'] == 1, options['queries'])
+        print(','.join(str(value) for value in result))
+    else:
+        run(options)
@@ -0,0 +1,121 @@
+"""
+This script compares the time to update a large index after a small change of the image CSV file with the incremental
+merge of build.py and with rewriting features.npy and imageIds.csv from all batches, as done before. Everything build.py
+does after encoding the images is timed: the merge, updating or training again the approximate nearest neighbour index
+(ivf.npz) and the int8 quantized features, and writing the index bundle, which is only written after a rewrite.
+
+Synthetic features of random images are written as batches to a temporary data directory and merged. Then a share of
+the images (--delta, by default 1%) changes: half of them are new images, two fifths are images whose content has changed
+and one tenth are removed from the image CSV file. The features of the new and changed images are written as a new batch,
+as downloadAndProcessImages does after encoding them, and merged once incrementally and once by rewriting everything.
+The time of merging, of the bundle and of the whole update, and the number of images that need to be encoded are printed,
+with an estimate of the time to encode them at --encodeRate images per second. The CLIP model is not needed.
+
+Usage:
+
+    python benchmarks/benchmarkIncremental.py
+    python benchmarks/benchmarkIncremental.py --images 1000000 --delta 1
+
+Parameters:
+    --images: The number of images of the index. Optional, defaults to 200000.
+    --delta: The share of the images that changes, in percent. Optional, defaults to 1.
+    --batchSize: The number of images per batch. Optional, defaults to 1024.
+    --encodeRate: The number of images per second encoded by the model, used to estimate the encoding time. Optional, defaults to 200.
+    --ivfLists: The number of lists of the approximate nearest neighbour index. Optional, defaults to 4 * sqrt(images).
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import csv
+import shutil
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+from sariIiifClipSearch import Images, MANIFESTFILE
+
+DIMENSIONS = 512
+
+def writeImageCSV(images, urls):
+    # The identifiers are needed to write the bundle
+    with open(images.imageCSV, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['iiif_url', 'localIdentifier'])
+        writer.writeheader()
+        writer.writerows({'iiif_url': url, 'localIdentifier': images._customHash(url)} for url in urls)
+
+def randomFeatures(random, rows):
+    features = random.normal(size=(rows, DIMENSIONS)).astype(np.float32)
+    return features / np.linalg.norm(features, axis=1, keepdims=True)
+
+def writeBatches(images, random, identifiers, batchSize):
+    batch = images._nextBatch()
+    for start in range(0, len(identifiers), batchSize):
+        batchIds = identifiers[start:start + batchSize]
+        images._writeBatch(batch, batchIds, randomFeatures(random, len(batchIds)), [f"{random.integers(2 ** 63):x}" for _ in batchIds])
+        batch += 1
+
+def run(options):
+    random = np.random.default_rng(0)
+    workDir = Path(tempfile.mkdtemp())
+    try:
+        images = Images(mode=Images.MODE_CSV, dataDir=workDir, storeImages=False)
+        urls = [f"https://example.org/iiif/image{i}" for i in range(options['images'])]
+        writeImageCSV(images, urls)
+        print(f"Writing the features of {len(urls)} images")
+        writeBatches(images, random, [images._customHash(url) for url in urls], options['batchSize'])
+        start = time.perf_counter()
+        images._mergeBatches()
+        images.buildIndex(lists=options.get('ivfLists'))
+        images.quantizeFeatures('int8')
+        images.writeBundle()
+        print(f"Initial build took {time.perf_counter() - start:.1f}s")
+
+        delta = max(1, options['images'] * options['delta'] // 100)
+        added = [f"https://example.org/iiif/new{i}" for i in range(delta // 2)]
+        changed = urls[:delta * 2 // 5]
+        removed = set(urls[-max(1, delta // 10):])
+        writeImageCSV(images, [url for url in urls if url not in removed] + added)
+        writeBatches(images, random, [images._customHash(url) for url in added + changed], options['batchSize'])
+        print(f"{len(added)} new, {len(changed)} changed and {len(removed)} removed images")
+
+        featuresDir = workDir / 'features'
+        snapshot = workDir / 'snapshot'
+        shutil.copytree(featuresDir, snapshot)
+        results = {}
+        for name in ('incremental', 'rewrite'):
+            shutil.rmtree(featuresDir)
+            shutil.copytree(snapshot, featuresDir)
+            if name == 'rewrite':
+                # Without a manifest, the features are rewritten from all batches
+                (featuresDir / MANIFESTFILE).unlink()
+            start = time.perf_counter()
+            # The merge updates or trains again the index and the quantized features
+            images._mergeBatches()
+            merged = time.perf_counter()
+            # As in build.py, the bundle is only written after a rewrite
+            if images.featuresRewritten:
+                images.writeBundle()
+            results[name] = (merged - start, time.perf_counter() - merged)
+
+        encoded = len(added) + len(changed)
+        total = len(urls) - len(removed) + len(added)
+        print(f"{'variant':>12} {'encoded':>8} {'encode (s, est.)':>17} {'merge (s)':>10} {'bundle (s)':>11} {'build (s, est.)':>16}")
+        rows = [('full', total, results['rewrite'])] + [(name, encoded, results[name]) for name in ('incremental', 'rewrite')]
+        for name, count, (merge, bundle) in rows:
+            encode = count / options['encodeRate']
+            print(f"{name:>12} {count:>8} {encode:>17.1f} {merge:>10.2f} {bundle:>11.2f} {encode + merge + bundle:>16.1f}")
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    options = {
+        'images': 200000,
+        'delta': 1,
+        'batchSize': 1024,
+        'encodeRate': 200
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            options[arg[2:]] = int(sys.argv[i + 2])
+
+    run(options)
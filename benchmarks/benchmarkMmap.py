@@ -0,0 +1,115 @@
+"""
+This script compares the memory use and query latency of searching an eagerly loaded feature matrix
+with searching a memory-mapped feature matrix in fixed-size blocks.
+
+A synthetic features.npy file with the requested number of normalised 512 dimensional vectors is
+written to a temporary directory. Every configuration is then measured in a fresh process, which
+loads the matrix, runs a number of random queries and reports:
+
+    - the median and p99 latency per query
+    - the private (anonymous) resident memory of the process, which is what every process pays for itself
+    - the file-backed resident memory, which is page cache shared between processes and can be reclaimed by the OS
+
+Usage:
+
+    python benchmarks/benchmarkMmap.py
+    python benchmarks/benchmarkMmap.py --size 1000000 --blockSizes 65536,262144 --queries 20
+
+Parameters:
+    --size: The number of synthetic vectors. Optional, defaults to 1000000.
+    --blockSizes: Comma separated list of block sizes used with the memory-mapped matrix. Optional, defaults to 16384,131072.
+    --queries: The number of queries per configuration. Optional, defaults to 20.
+    --limit: The number of results per query. Optional, defaults to 100.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import subprocess
+import tempfile
+import time
+import numpy as np
+from pathlib import Path
+
+DIMENSIONS = 512
+
+def residentMemory():
+    # Returns the anonymous and file-backed resident memory of the current process in MB
+    memory = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:') or line.startswith('RssFile:'):
+                key, value, _ = line.split()
+                memory[key[:-1]] = int(value) / 1024
+    return memory['RssAnon'], memory['RssFile']
+
+def writeFeatures(path, size):
+    rng = np.random.default_rng(0)
+    features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(size, DIMENSIONS))
+    chunk = 100000
+    for start in range(0, size, chunk):
+        block = rng.normal(size=(min(chunk, size - start), DIMENSIONS)).astype(np.float32)
+        features[start:start + chunk] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    features.flush()
+    del features
+
+def measure(path, mmap, blockSize, queries, limit):
+    from sariIiifClipSearch.search import blockedTopK
+
+    anonBefore, fileBefore = residentMemory()
+    features = np.load(path, mmap_mode='r' if mmap else None)
+
+    rng = np.random.default_rng(1)
+    timings = []
+    for _ in range(queries):
+        queryFeatures = rng.normal(size=DIMENSIONS).astype(np.float32)
+        queryFeatures /= np.linalg.norm(queryFeatures)
+        start = time.perf_counter()
+        blockedTopK(queryFeatures, features, limit, minScore=0.0, blockSize=blockSize)
+        timings.append(time.perf_counter() - start)
+
+    anonAfter, fileAfter = residentMemory()
+    timings = np.array(timings) * 1000
+    return np.median(timings), np.percentile(timings, 99), anonAfter - anonBefore, fileAfter - fileBefore
+
+def run(options):
+    with tempfile.TemporaryDirectory() as tempDir:
+        path = Path(tempDir) / 'features.npy'
+        print(f"Writing {options['size']} synthetic vectors to {path}")
+        writeFeatures(path, options['size'])
+
+        configurations = [('eager', 0)] + [('mmap', blockSize) for blockSize in options['blockSizes']]
+        print(f"{'mode':>8} {'blockSize':>10} {'median (ms)':>12} {'p99 (ms)':>10} {'private MB':>11} {'shared MB':>10}")
+        for mode, blockSize in configurations:
+            # Every configuration runs in its own process so that the memory measurements are independent
+            output = subprocess.run([
+                sys.executable, __file__, '--measure', str(path),
+                '--mmap', '1' if mode == 'mmap' else '0',
+                '--blockSize', str(blockSize),
+                '--queries', str(options['queries']),
+                '--limit', str(options['limit'])
+            ], capture_output=True, text=True, check=True).stdout.strip().splitlines()[-1]
+            median, p99, anon, shared = [float(value) for value in output.split(',')]
+            print(f"{mode:>8} {blockSize or '-':>10} {median:>12.2f} {p99:>10.2f} {anon:>11.1f} {shared:>10.1f}")
+
+if __name__ == "__main__":
+    options = {
+        'size': 1000000,
+        'blockSizes': [16384, 131072],
+        'queries': 20,
+        'limit': 100
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--blockSizes':
+                options['blockSizes'] = [int(blockSize) for blockSize in value.split(',')]
+            elif arg == '--measure':
+                options['measure'] = value
+            else:
+                options[arg[2:]] = int(value)
+
+    if 'measure' in options:
+        result = measure(options['measure'], options['mmap'] == 1, options['blockSize'] or None, options['queries'], options['limit'])
+        print(','.join(str(value) for value in result))
+    else:
+        run(options)
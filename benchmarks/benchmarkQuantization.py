@@ -0,0 +1,86 @@
+"""
+This script measures the memory per image, recall@k and latency of searching compressed features
+(int8 scalar quantization and product quantization) with exact re-ranking of a shortlist, compared
+to the exact search over the full precision features.
+
+By default a synthetic, clustered feature matrix is generated (see benchmarkAnn.py). Existing features
+can be benchmarked with the --features option, e.g. precomputedFeatures/bso/features/features.npy.
+
+Usage:
+
+    python benchmarks/benchmarkQuantization.py
+    python benchmarks/benchmarkQuantization.py --size 1000000 --reranks 200,1000
+
+Parameters:
+    --size: The number of synthetic vectors. Optional, defaults to 200000.
+    --features: Path to a features.npy file to use instead of synthetic vectors. Optional.
+    --reranks: Comma separated list of shortlist sizes re-ranked with the full precision features. Optional, defaults to 100,500,2000.
+    --subvectors: The number of subvectors (bytes per image) of the product quantizer. Optional, defaults to 64.
+    --queries: The number of queries. Optional, defaults to 50.
+    --limit: The k of recall@k. Optional, defaults to 100.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import time
+import numpy as np
+from benchmarkAnn import DIMENSIONS, normalise, syntheticFeatures
+from sariIiifClipSearch.quantization import ScalarQuantizer, ProductQuantizer
+from sariIiifClipSearch.search import blockedTopK
+
+def run(options):
+    rng = np.random.default_rng(0)
+    if 'features' in options:
+        features = np.load(options['features'])
+    else:
+        print(f"Generating {options['size']} synthetic vectors")
+        features = syntheticFeatures(options['size'], rng)
+    queries = normalise(features[rng.integers(0, features.shape[0], options['queries'])] + rng.normal(scale=0.03, size=(options['queries'], DIMENSIONS)))
+
+    quantizers = []
+    for name, train in [('int8', lambda: ScalarQuantizer.train(features)), ('pq', lambda: ProductQuantizer.train(features, subvectors=options['subvectors']))]:
+        start = time.perf_counter()
+        quantizers.append((name, train()))
+        print(f"Trained {name} quantizer in {time.perf_counter() - start:.1f}s")
+
+    limit = options['limit']
+    exactResults = []
+    timings = []
+    for queryFeatures in queries:
+        start = time.perf_counter()
+        indices, _ = blockedTopK(queryFeatures, features, limit)
+        timings.append(time.perf_counter() - start)
+        exactResults.append(set(indices))
+    exactTime = np.median(timings) * 1000
+
+    print(f"{'search':>8} {'bytes/image':>12} {'rerank':>7} {f'recall@{limit}':>11} {'median (ms)':>12}")
+    print(f"{'exact':>8} {features.shape[1] * features.itemsize:>12} {'-':>7} {1:>11.3f} {exactTime:>12.2f}")
+    for name, quantizer in quantizers:
+        for rerank in options['reranks']:
+            timings = []
+            recall = []
+            for queryFeatures, exact in zip(queries, exactResults):
+                start = time.perf_counter()
+                indices, _ = quantizer.search(queryFeatures, features, limit, rerank=rerank)
+                timings.append(time.perf_counter() - start)
+                recall.append(len(exact.intersection(indices)) / len(exact))
+            print(f"{name:>8} {quantizer.codes.shape[1]:>12} {rerank:>7} {np.mean(recall):>11.3f} {np.median(timings) * 1000:>12.2f}")
+
+if __name__ == "__main__":
+    options = {
+        'size': 200000,
+        'reranks': [100, 500, 2000],
+        'subvectors': 64,
+        'queries': 50,
+        'limit': 100
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--reranks':
+                options['reranks'] = [int(rerank) for rerank in value.split(',')]
+            elif arg == '--features':
+                options['features'] = value
+            else:
+                options[arg[2:]] = int(value)
+    run(options)
@@ -0,0 +1,124 @@
+"""
+This script compares streamed responses with the default responses of the API for queries with many results.
+
+For every response format, the API is started (this requires the CLIP model and a data directory) with the result
+and ranking caches disabled, so that every request runs the query. Then the same text queries are sent with a large
+limit, and the time to the first byte, the total time of every request and the peak memory of the API process while
+answering them are measured. The peak memory is reset before the queries by writing to /proc/<pid>/clear_refs, so
+the increase of the peak over the memory before the queries is the memory needed to answer them.
+
+The formats are:
+    json: The default response, the results are serialized after all of them have been built.
+    stream: The same JSON array, streamed with stream=json.
+    ndjson: One result per line, streamed with stream=ndjson.
+
+Usage:
+
+    python benchmarks/benchmarkStreaming.py --dataDir /precomputedFeatures/bso
+    python benchmarks/benchmarkStreaming.py --dataDir /precomputedFeatures/bso --limit 50000 --requests 10
+
+Parameters:
+    --dataDir: The directory containing the extracted features.
+    --limit: The number of results per query. Optional, defaults to 10000.
+    --requests: The number of queries per format. Optional, defaults to 5.
+    --port: The port the API is started on. Optional, defaults to 5099.
+"""
+import sys, os
+
+import http.client
+import signal
+import subprocess
+import time
+import urllib.parse
+import urllib.request
+import numpy as np
+
+WORDS = ["mountain", "lake", "portrait", "map", "church", "horse", "bridge", "ship", "garden", "castle"]
+FORMATS = {'json': {}, 'stream': {'stream': 'json'}, 'ndjson': {'stream': 'ndjson'}}
+API = os.path.join(os.path.dirname(__file__), '..', 'src', 'api.py')
+
+def memory(pid, field):
+    # Returns a field of /proc/<pid>/status, e.g. VmRSS or VmHWM, in MB
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def resetPeakMemory(pid):
+    with open(f'/proc/{pid}/clear_refs', 'w') as f:
+        f.write('5')
+
+def waitForApi(url, process, timeout=600):
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise Exception("The API exited during start up")
+        try:
+            urllib.request.urlopen(url + '/ready')
+            return
+        except Exception:
+            time.sleep(1)
+    raise Exception("The API did not start in time")
+
+def timeRequest(port, path):
+    # Returns the time to the first byte and the total time of a request in ms, and the size of the response
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    start = time.perf_counter()
+    connection.request('GET', path)
+    response = connection.getresponse()
+    response.read(1)
+    firstByte = time.perf_counter() - start
+    size = 1 + len(response.read())
+    total = time.perf_counter() - start
+    connection.close()
+    return firstByte * 1000, total * 1000, size
+
+def run(options):
+    url = f"http://127.0.0.1:{options['port']}"
+    print(f"{'format':>8} {'TTFB p50 (ms)':>14} {'total p50 (ms)':>15} {'MB/response':>12} {'peak +MB':>10}")
+    for streamFormat, parameters in FORMATS.items():
+        environment = dict(os.environ,
+            CLIP_DATA_DIRECTORY=options['dataDir'],
+            CLIP_API_PORT=str(options['port']),
+            CLIP_RESULT_CACHE_SIZE='0',
+            CLIP_RANKING_CACHE_RESULTS='0'
+        )
+        process = subprocess.Popen([sys.executable, API], env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            waitForApi(url, process)
+            # Warm up the text encoder before measuring the memory
+            timeRequest(options['port'], '/query?' + urllib.parse.urlencode({'str': 'warm up', 'limit': 10}))
+            resetPeakMemory(process.pid)
+            before = memory(process.pid, 'VmRSS')
+            firstBytes, totals = [], []
+            for i in range(options['requests']):
+                query = {'str': f"a {WORDS[i % len(WORDS)]}", 'limit': options['limit'], 'minScore': -1, **parameters}
+                firstByte, total, size = timeRequest(options['port'], '/query?' + urllib.parse.urlencode(query))
+                firstBytes.append(firstByte)
+                totals.append(total)
+            peak = memory(process.pid, 'VmHWM') - before
+            print(f"{streamFormat:>8} {np.percentile(firstBytes, 50):>14.1f} {np.percentile(totals, 50):>15.1f} {size / 1024 / 1024:>12.2f} {peak:>10.1f}")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+if __name__ == "__main__":
+    options = {
+        'limit': 10000,
+        'requests': 5,
+        'port': 5099
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--dataDir':
+                options['dataDir'] = value
+            else:
+                options[arg[2:]] = int(value)
+
+    if not 'dataDir' in options:
+        print("The data directory is required")
+        sys.exit(1)
+
+    run(options)
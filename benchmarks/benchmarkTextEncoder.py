@@ -0,0 +1,78 @@
+"""
+This script benchmarks CLIP.encode_text on CPU with the sequence trimmed to the longest query of the
+batch, compared to running all 77 positions of the context, and checks that both give the same embeddings.
+
+By default a randomly initialised model with the architecture of ViT-B/32 is used, which has the same
+cost as the pretrained model and does not require downloading it. With --pretrained the ViT-B/32 weights are loaded.
+
+Usage:
+
+    python benchmarks/benchmarkTextEncoder.py
+    python benchmarks/benchmarkTextEncoder.py --pretrained 1 --batchSizes 1,8,32 --repeat 20
+
+Parameters:
+    --pretrained: Load the pretrained ViT-B/32 model instead of a randomly initialised one. Optional, defaults to 0.
+    --batchSizes: Comma separated list of batch sizes. Optional, defaults to 1,8,32.
+    --repeat: The number of timed runs per configuration. Optional, defaults to 10.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src', 'clip'))
+
+import time
+import numpy as np
+import torch
+from clip import clip
+from model import CLIP
+
+QUERIES = [
+    "Airplane",
+    "A mountain lake",
+    "a group of people in front of a church",
+    "A detailed map of the city of Zurich with the lake and the surrounding villages in the eighteenth century",
+]
+
+def timeit(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1000
+
+def run(options):
+    if options['pretrained']:
+        model, _ = clip.load("ViT-B/32", device="cpu")
+    else:
+        torch.manual_seed(0)
+        # The architecture of ViT-B/32
+        model = CLIP(512, 224, 12, 768, 32, 77, 49408, 512, 8, 12).eval()
+
+    print(f"{'query tokens':>12} {'batch':>6} {'77 positions (ms)':>18} {'trimmed (ms)':>13} {'speedup':>8} {'max abs diff':>13}")
+    with torch.no_grad():
+        for queryString in QUERIES:
+            for batchSize in options['batchSizes']:
+                tokens = clip.tokenize([queryString] * batchSize, truncate=True)
+                length = int(tokens.argmax(dim=-1).max()) + 1
+                full = model.encode_text(tokens, trim=False)
+                trimmed = model.encode_text(tokens)
+                difference = float((full / full.norm(dim=-1, keepdim=True) - trimmed / trimmed.norm(dim=-1, keepdim=True)).abs().max())
+
+                fullTime = timeit(lambda: model.encode_text(tokens, trim=False), options['repeat'])
+                trimmedTime = timeit(lambda: model.encode_text(tokens), options['repeat'])
+                print(f"{length:>12} {batchSize:>6} {fullTime:>18.2f} {trimmedTime:>13.2f} {fullTime / trimmedTime:>7.1f}x {difference:>13.1e}")
+
+if __name__ == "__main__":
+    options = {
+        'pretrained': 0,
+        'batchSizes': [1, 8, 32],
+        'repeat': 10
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--batchSizes':
+                options['batchSizes'] = [int(batchSize) for batchSize in value.split(',')]
+            else:
+                options[arg[2:]] = int(value)
+    run(options)
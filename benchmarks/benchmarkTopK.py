@@ -0,0 +1,79 @@
+"""
+This script benchmarks the top-k selection stage of Query.query on synthetic similarity scores.
+
+It compares the previous approach (a Python sort over a list of all scores) with the vectorised
+topK function (minScore mask, np.argpartition and a sort of the k survivors only).
+The similarity scores are drawn from a distribution that resembles CLIP text-to-image cosine
+similarities, so that the minScore mask keeps a realistic share of the rows.
+
+Usage:
+
+    python benchmarks/benchmarkTopK.py
+    python benchmarks/benchmarkTopK.py --sizes 30000,1000000,10000000 --limit 100 --minScore 0.2
+
+Parameters:
+    --sizes: Comma separated list of numbers of synthetic vectors. Optional, defaults to 30000,1000000,10000000.
+    --limit: The number of results to select. Optional, defaults to 100.
+    --minScore: The minimum score of the selected results. Optional, defaults to 0.2.
+    --repeat: The number of timed runs per size. Optional, defaults to 5.
+    --maxSortedSize: Largest size for which the Python sort baseline is run. Optional, defaults to 1000000.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import time
+import numpy as np
+from sariIiifClipSearch.search import topK
+
+def sortedTopK(similarities, numResults, minScore):
+    # The selection as previously done in Query.query
+    bestImages = sorted(zip(list(similarities), range(similarities.shape[0])), key=lambda x: x[0], reverse=True)
+    results = []
+    for image in bestImages[:numResults]:
+        score = float(image[0])
+        if score < minScore:
+            break
+        results.append(image[1])
+    return results
+
+def timeit(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1000
+
+def run(options):
+    rng = np.random.default_rng(0)
+    print(f"{'vectors':>12} {'sorted (ms)':>14} {'topK (ms)':>12} {'speedup':>10}")
+    for size in options['sizes']:
+        similarities = rng.normal(0.2, 0.03, size).astype(np.float32)
+
+        topKTime = timeit(lambda: topK(similarities, options['limit'], minScore=options['minScore']), options['repeat'])
+        if size <= options['maxSortedSize']:
+            sortedTime = timeit(lambda: sortedTopK(similarities, options['limit'], options['minScore']), options['repeat'])
+            indices, _ = topK(similarities, options['limit'], minScore=options['minScore'])
+            assert list(indices) == sortedTopK(similarities, options['limit'], options['minScore'])
+            print(f"{size:>12} {sortedTime:>14.2f} {topKTime:>12.2f} {sortedTime / topKTime:>9.1f}x")
+        else:
+            print(f"{size:>12} {'-':>14} {topKTime:>12.2f} {'-':>10}")
+
+if __name__ == "__main__":
+    options = {
+        'sizes': [30000, 1000000, 10000000],
+        'limit': 100,
+        'minScore': 0.2,
+        'repeat': 5,
+        'maxSortedSize': 1000000
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--sizes':
+                options['sizes'] = [int(size) for size in value.split(',')]
+            elif arg == '--minScore':
+                options['minScore'] = float(value)
+            else:
+                options[arg[2:]] = int(value)
+    run(options)
@@ -0,0 +1,130 @@
+"""
+This script measures the throughput and memory use of the API served by a different number of worker processes.
+
+For every configuration, the API is started with CLIP_WORKERS set to the number of workers (this requires the
+CLIP model and a data directory). Once it answers, a number of client threads send unique text queries over
+HTTP as fast as possible. Afterwards, the proportional set size (PSS) of the parent and every worker process is
+read from /proc. PSS divides pages shared between processes by the number of processes sharing them, so the
+sum over all processes is the total memory used by the service. Compare the total with the memory of one
+worker multiplied by the number of workers to see how much is shared.
+
+Usage:
+
+    python benchmarks/benchmarkWorkers.py --dataDir /precomputedFeatures/bso
+    python benchmarks/benchmarkWorkers.py --dataDir /precomputedFeatures/bso --workers 1,2,4 --clients 16 --mmap 1
+
+Parameters:
+    --dataDir: The directory containing the extracted features.
+    --workers: Comma separated list of numbers of worker processes. Optional, defaults to 1,2,4.
+    --clients: The number of concurrent client threads. Optional, defaults to 8.
+    --requests: The number of queries per client and configuration. Optional, defaults to 25.
+    --limit: The number of results per query. Optional, defaults to 100.
+    --port: The port the API is started on. Optional, defaults to 5099.
+    --mmap: Memory-map the features (1) or load them into memory (0). Optional, defaults to 0.
+"""
+import sys, os
+
+import signal
+import subprocess
+import threading
+import time
+import urllib.parse
+import urllib.request
+import numpy as np
+
+WORDS = ["mountain", "lake", "portrait", "map", "church", "horse", "bridge", "ship", "garden", "castle"]
+API = os.path.join(os.path.dirname(__file__), '..', 'src', 'api.py')
+
+def proportionalMemory(pid):
+    # Returns the proportional set size of a process in MB
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def childProcesses(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+def waitForApi(url, process, timeout=600):
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise Exception("The API exited during start up")
+        try:
+            urllib.request.urlopen(url + '/ready')
+            return
+        except Exception:
+            time.sleep(1)
+    raise Exception("The API did not start in time")
+
+def runClients(url, clients, requests, limit, offset):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(clientId):
+        for i in range(requests):
+            queryString = f"a {WORDS[i % len(WORDS)]} number {offset + clientId * requests + i}"
+            start = time.perf_counter()
+            urllib.request.urlopen(url + '/query?' + urllib.parse.urlencode({'str': queryString, 'limit': limit})).read()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(clientId,)) for clientId in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return len(latencies) / duration, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+def run(options):
+    url = f"http://127.0.0.1:{options['port']}"
+    print(f"{'workers':>8} {'queries/s':>10} {'p50 (ms)':>10} {'p99 (ms)':>10} {'MB/worker':>10} {'total MB':>10}")
+    for i, workers in enumerate(options['workers']):
+        environment = dict(os.environ,
+            CLIP_DATA_DIRECTORY=options['dataDir'],
+            CLIP_WORKERS=str(workers),
+            CLIP_API_PORT=str(options['port']),
+            CLIP_MMAP='true' if options['mmap'] else 'false',
+            CLIP_TEXT_CACHE_SIZE='0'
+        )
+        process = subprocess.Popen([sys.executable, API], env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            waitForApi(url, process)
+            throughput, p50, p99 = runClients(url, options['clients'], options['requests'], options['limit'], i * options['clients'] * options['requests'])
+            workerPids = childProcesses(process.pid) if workers > 1 else [process.pid]
+            workerMemory = [proportionalMemory(pid) for pid in workerPids]
+            total = sum(workerMemory) + (proportionalMemory(process.pid) if workers > 1 else 0)
+            print(f"{workers:>8} {throughput:>10.1f} {p50:>10.1f} {p99:>10.1f} {np.mean(workerMemory):>10.1f} {total:>10.1f}")
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+if __name__ == "__main__":
+    options = {
+        'workers': [1, 2, 4],
+        'clients': 8,
+        'requests': 25,
+        'limit': 100,
+        'port': 5099,
+        'mmap': 0
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--workers':
+                options['workers'] = [int(workers) for workers in value.split(',')]
+            elif arg == '--dataDir':
+                options['dataDir'] = value
+            else:
+                options[arg[2:]] = int(value)
+
+    if not 'dataDir' in options:
+        print("The data directory is required")
+        sys.exit(1)
+
+    run(options)
@@ -0,0 +1,91 @@
+"""
+This script measures throughput and latency of concurrent text queries with and without micro-batching.
+
+A Query object is loaded from the given data directory (this requires the CLIP model). Then, for every
+configuration, a number of client threads send queries as fast as possible, the same way the request
+threads of the API do. The text cache is disabled and every query string is unique, so that every
+query runs the text encoder.
+
+Usage:
+
+    python benchmarks/loadTest.py --dataDir /precomputedFeatures/bso
+    python benchmarks/loadTest.py --dataDir /precomputedFeatures/bso --clients 16 --maxWaits 0,2,5,10 --maxBatch 32
+
+Parameters:
+    --dataDir: The directory containing the extracted features.
+    --clients: The number of concurrent client threads. Optional, defaults to 8.
+    --requests: The number of queries per client and configuration. Optional, defaults to 25.
+    --maxWaits: Comma separated list of maximum batch wait times in milliseconds. 0 runs without batching. Optional, defaults to 0,2,5,10.
+    --maxBatch: The maximum number of queries per batch. Optional, defaults to 32.
+    --limit: The number of results per query. Optional, defaults to 100.
+"""
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import threading
+import time
+import numpy as np
+from sariIiifClipSearch import Query, MicroBatcher
+
+WORDS = ["mountain", "lake", "portrait", "map", "church", "horse", "bridge", "ship", "garden", "castle"]
+
+def runClients(searcher, clients, requests, limit, offset):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(clientId):
+        for i in range(requests):
+            queryString = f"a {WORDS[i % len(WORDS)]} number {offset + clientId * requests + i}"
+            start = time.perf_counter()
+            searcher.query(queryString, numResults=limit)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(clientId,)) for clientId in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return len(latencies) / duration, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+def run(options):
+    clipQuery = Query(dataDir=options['dataDir'], textCacheSize=0)
+    # Warm up the model
+    clipQuery.query("warm up")
+
+    print(f"{'maxWait (ms)':>12} {'queries/s':>10} {'p50 (ms)':>10} {'p99 (ms)':>10} {'avg batch':>10}")
+    for i, maxWait in enumerate(options['maxWaits']):
+        if maxWait > 0:
+            searcher = MicroBatcher(clipQuery, maxWait=maxWait / 1000, maxBatch=options['maxBatch'])
+        else:
+            searcher = clipQuery
+        throughput, p50, p99 = runClients(searcher, options['clients'], options['requests'], options['limit'], i * options['clients'] * options['requests'])
+        averageBatch = searcher.stats()['averageBatchSize'] if maxWait > 0 else 1
+        print(f"{maxWait if maxWait > 0 else 'off':>12} {throughput:>10.1f} {p50:>10.1f} {p99:>10.1f} {averageBatch:>10.1f}")
+
+if __name__ == "__main__":
+    options = {
+        'clients': 8,
+        'requests': 25,
+        'maxWaits': [0, 2, 5, 10],
+        'maxBatch': 32,
+        'limit': 100
+    }
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            value = sys.argv[i + 2]
+            if arg == '--maxWaits':
+                options['maxWaits'] = [float(maxWait) for maxWait in value.split(',')]
+            elif arg == '--dataDir':
+                options['dataDir'] = value
+            else:
+                options[arg[2:]] = int(value)
+
+    if not 'dataDir' in options:
+        print("The data directory is required")
+        sys.exit(1)
+
+    run(options)
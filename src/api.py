@@ -4,17 +4,27 @@ import json
 import os
 import re
 import logging
-from flask import Flask, Response, request, logging as flogging
+import threading
+import time
+import itertools
+import contextlib
+from urllib.parse import urlencode
+from hashlib import blake2b
+from flask import Flask, Response, g, request, logging as flogging
 from io import BytesIO
 from rdflib.term import Variable, URIRef, Literal
 from PIL import Image
-from sariIiifClipSearch import Query
+from sariIiifClipSearch import Query, MicroBatcher, Collections, LRUCache, AdmissionLimiter, Overloaded
 from sariSparqlParser import parser
 
-try:
+# Several collections can be served as name=directory pairs, a single data directory is named after the directory
+if os.environ.get('CLIP_COLLECTIONS'):
+  dataDirs = dict(collection.strip().split('=', 1) for collection in os.environ['CLIP_COLLECTIONS'].split(','))
+elif os.environ.get('CLIP_DATA_DIRECTORY'):
   dataDir = os.environ['CLIP_DATA_DIRECTORY']
-except:
-  print("CLIP_DATA_DIRECTORY environment variable not set.")
+  dataDirs = {os.path.basename(os.path.normpath(dataDir)): dataDir}
+else:
+  print("CLIP_DATA_DIRECTORY or CLIP_COLLECTIONS environment variable not set.")
   sys.exit(1)
 
 try:
@@ -34,17 +44,378 @@ except:
 
 app = Flask(__name__)
 
-clipQuery=Query(
-    dataDir=dataDir
-)
+collections = None
+# The searcher of every loaded collection, created with the first query of the collection
+searchers = {}
+searchersLock = threading.Lock()
+startupTimes = {}
+# Serialized responses of recent queries, keyed on their ETag
+resultCacheTTL = os.environ.get('CLIP_RESULT_CACHE_TTL')
+resultCache = LRUCache(int(os.environ.get('CLIP_RESULT_CACHE_SIZE') or 1024), ttl=float(resultCacheTTL) if resultCacheTTL else None)
+cacheMaxAge = int(os.environ.get('CLIP_CACHE_MAX_AGE') or 0)
+# The best results of recent queries, from which the pages of a query are sliced. Bounded by the total number of results
+rankingDepth = int(os.environ.get('CLIP_RANKING_DEPTH') or 500)
+rankingCache = LRUCache(int(os.environ.get('CLIP_RANKING_CACHE_RESULTS') or 100000), sizeOf=lambda ranking: len(ranking[0]) + 1,
+    ttl=float(os.environ.get('CLIP_RANKING_CACHE_TTL') or 300))
+
+def createLimiter(name, maxConcurrent):
+    maxConcurrent = int(maxConcurrent)
+    if maxConcurrent <= 0:
+        return None
+    return AdmissionLimiter(maxConcurrent, maxQueued=int(os.environ.get('CLIP_MAX_QUEUED') or 16),
+        maxWait=float(os.environ.get('CLIP_MAX_QUEUE_WAIT_MS') or 2000) / 1000, name=name)
+
+# Queries by text or image ID only run the text encoder or no encoder at all, queries by URL or image run the image encoder
+# and are limited separately, so that a burst of the more expensive queries does not hold up all other queries
+limiters = {
+    'text': createLimiter('text', os.environ.get('CLIP_MAX_CONCURRENT_TEXT') or 4),
+    'image': createLimiter('image', os.environ.get('CLIP_MAX_CONCURRENT_IMAGE') or 2)
+}
+# Set once the model and the index of the default collection are loaded and the model has been warmed up
+ready = threading.Event()
+loadError = None
+
+def createCollections():
+    memoryBudget = os.environ.get('CLIP_MEMORY_BUDGET_MB')
+    return Collections(
+        dataDirs,
+        default=os.environ.get('CLIP_DEFAULT_COLLECTION') or None,
+        memoryBudget=int(float(memoryBudget) * 1024 * 1024) if memoryBudget else None,
+        onEvict=closeSearcher,
+        mmap=os.environ.get('CLIP_MMAP', 'false').lower() == 'true',
+        blockSize=int(os.environ['CLIP_BLOCK_SIZE']) if os.environ.get('CLIP_BLOCK_SIZE') else None,
+        nprobe=int(os.environ['CLIP_NPROBE']) if os.environ.get('CLIP_NPROBE') else None,
+        quantization=os.environ.get('CLIP_QUANTIZATION') or None,
+        rerank=int(os.environ.get('CLIP_RERANK') or 1000),
+        textCacheSize=int(os.environ.get('CLIP_TEXT_CACHE_SIZE') or 1024),
+        imageEncoder=os.environ.get('CLIP_IMAGE_ENCODER') or 'eager'
+    )
+
+def createSearcher(clipQuery):
+    """
+    Concurrent queries are collected into batches if a maximum wait time is configured
+    """
+    batchMaxWait = float(os.environ.get('CLIP_BATCH_MAX_WAIT_MS') or 0) / 1000
+    if batchMaxWait > 0:
+        return MicroBatcher(clipQuery, maxWait=batchMaxWait, maxBatch=int(os.environ.get('CLIP_BATCH_MAX_SIZE') or 32))
+    return clipQuery
+
+def getSearcher(collection):
+    """
+    Return the searcher of a collection, loading the collection if needed
+    """
+    clipQuery = collections.get(collection)
+    with searchersLock:
+        searcher = searchers.get(collection)
+        # A collection that has been unloaded and loaded again needs a new searcher
+        if searcher is None or getattr(searcher, 'clipQuery', searcher) is not clipQuery:
+            searcher = searchers[collection] = createSearcher(clipQuery)
+    return searcher
+
+def closeSearcher(collection, clipQuery):
+    with searchersLock:
+        searcher = searchers.get(collection)
+        if searcher is not None and getattr(searcher, 'clipQuery', searcher) is clipQuery:
+            del searchers[collection]
+            if isinstance(searcher, MicroBatcher):
+                searcher.close()
+    logging.info(f"Unloaded or replaced collection {collection}")
+
+def startWatcher():
+    """
+    Reload collections whose index files have changed if a reload interval is configured
+    """
+    reloadInterval = float(os.environ.get('CLIP_RELOAD_INTERVAL') or 0)
+    if reloadInterval > 0:
+        collections.watch(reloadInterval)
+
+def loadService():
+    """
+    Load the model and the index of the default collection and warm up the model. The service answers queries once this is done.
+    Other collections are loaded with the first query that uses them.
+    """
+    global collections, startupTimes, loadError
+    start = time.perf_counter()
+    try:
+        collections = createCollections()
+        clipQuery = collections.get()
+        clipQuery.warmUp()
+        startupTimes = clipQuery.startupTimes
+    except Exception as e:
+        loadError = str(e)
+        logging.exception("Loading the service failed")
+        return
+    ready.set()
+    logging.info(f"Service ready after {time.perf_counter() - start:.2f}s: {startupTimes}")
+    # Forked workers start their own watcher
+    if int(os.environ.get('CLIP_WORKERS') or 1) <= 1:
+        startWatcher()
+
+# Load in the background, so that the server can answer liveness checks in the meantime
+loader = threading.Thread(target=loadService, daemon=True)
+loader.start()
 
 DEFAULT_MINSCORE=0.2
 DEFAULT_NUMRESULTS=100
+# The number of results serialized at once in streamed responses
+STREAM_CHUNK_SIZE=int(os.environ.get('CLIP_STREAM_CHUNK_SIZE') or 256)
+IMAGE_QUERIES_NOT_SUPPORTED="Queries by image are not supported by this service"
+
+class UnknownCollection(Exception):
+    pass
+
+def getCollectionNames(value):
+    """
+    Return the collections to search for the value of the collection parameter: a name, several names separated
+    by commas or * for all collections. Defaults to the default collection.
+    """
+    if not value:
+        return [collections.default]
+    if value.strip() == '*':
+        return collections.names
+    names = [name.strip() for name in value.split(',')]
+    for name in names:
+        if name not in collections.dataDirs:
+            raise UnknownCollection(f"Unknown collection {name}, available collections are {', '.join(collections.names)}")
+    return names
+
+def canQuery(queryInput, mode, collectionNames):
+    return any(collections.get(name).canQuery(queryInput, mode) for name in collectionNames)
+
+def hasImage(imageId, collectionNames):
+    return any(collections.get(name).hasImage(imageId) for name in collectionNames)
+
+def useIndex(collection, clipQuery):
+    """
+    Record the index answering the current request, which is reported in the response headers
+    """
+    if 'indexes' not in g:
+        g.indexes = {}
+    g.indexes[collection] = clipQuery
+
+def admission(mode):
+    """
+    Return the limiter admitting queries of a mode, which raises Overloaded if too many queries are running and waiting
+    """
+    limiter = limiters['image' if mode in (Query.MODE_URL, Query.MODE_IMAGE) else 'text']
+    return limiter or contextlib.nullcontext()
+
+def runQuery(queryInput, mode, *, collectionNames, minScore, numResults, nprobe):
+    """
+    Run a query on one collection with its searcher, or on several collections merging their results
+    """
+    if collectionNames is None:
+        collectionNames = [collections.default]
+    if len(collectionNames) > 1:
+        for name in collectionNames:
+            useIndex(name, collections.get(name))
+        with admission(mode):
+            return collections.query(queryInput, collections=collectionNames, mode=mode, numResults=numResults, minScore=minScore, nprobe=nprobe)
+    searcher = getSearcher(collectionNames[0])
+    useIndex(collectionNames[0], getattr(searcher, 'clipQuery', searcher))
+    with admission(mode):
+        return searcher.query(queryInput, mode=mode, numResults=numResults, minScore=minScore, nprobe=nprobe)
+
+def iterQuery(queryInput, mode, *, collectionNames, minScore, numResults, nprobe, offset=0):
+    """
+    Run a query and return a generator of the results offset to offset + numResults with their links.
+    The query is run without the searcher and the caches, the results are built while they are streamed
+    """
+    if len(collectionNames) > 1:
+        for name in collectionNames:
+            useIndex(name, collections.get(name))
+        with admission(mode):
+            results = collections.queryIter(queryInput, collections=collectionNames, mode=mode, numResults=offset + numResults, minScore=minScore, nprobe=nprobe)
+    else:
+        clipQuery = collections.get(collectionNames[0])
+        useIndex(collectionNames[0], clipQuery)
+        with admission(mode):
+            results = clipQuery.queryIter(queryInput, mode=mode, numResults=offset + numResults, minScore=minScore, nprobe=nprobe)
+    return (addLink(result) for result in itertools.islice(results, offset, None))
+
+def getStreamFormat():
+    """
+    Return the format in which the results are streamed, 'ndjson' or 'json', or None if they are not streamed.
+    Results are streamed with the parameter stream=ndjson or stream=json, or if the client accepts application/x-ndjson
+    """
+    stream = request.values.get('stream', '').lower()
+    if stream in ('ndjson', 'json'):
+        return stream
+    if stream == 'true':
+        return 'json'
+    if not stream and request.accept_mimetypes.best == 'application/x-ndjson':
+        return 'ndjson'
+    return None
+
+def iterChunks(results):
+    results = iter(results)
+    while True:
+        chunk = list(itertools.islice(results, STREAM_CHUNK_SIZE))
+        if not chunk:
+            return
+        yield chunk
+
+def serializeStream(results, streamFormat):
+    """
+    Serialize results while they are generated, STREAM_CHUNK_SIZE results at a time: one JSON object
+    per line for 'ndjson', or a JSON array identical to the response that is not streamed for 'json'
+    """
+    if streamFormat == 'ndjson':
+        for chunk in iterChunks(results):
+            yield ''.join(json.dumps(result) + '\n' for result in chunk)
+        return
+    separator = '['
+    for chunk in iterChunks(results):
+        yield separator + ', '.join(json.dumps(result) for result in chunk)
+        separator = ', '
+    yield ']' if separator == ', ' else '[]'
+
+@app.before_request
+def checkReady():
+    if not ready.is_set() and request.endpoint not in ('index', 'live', 'readiness'):
+        return Response(json.dumps(error(loadError or 'The service is starting')), status=503, headers={'Retry-After': '10'}, mimetype='application/json')
+
+def cachedResponse(key, collectionNames, compute, *, limit=None, offset=0):
+    """
+    Answer a query from the result cache, or with status 304 if the client already has the current result.
+    The ETag of the response is derived from the key identifying the query and the versions of the indexes
+    of the collections, so that it changes when an index is reloaded. If limit is given and the page of results
+    is full, the response links to the next page.
+    """
+    etag = responseETag(key, collectionNames)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        def serialize():
+            result = compute()
+            return json.dumps(result), len(result)
+        body, count = resultCache.get(etag, serialize)
+        response = Response(body, mimetype='application/json')
+        if limit and count == limit and request.method == 'GET':
+            args = request.args.copy()
+            args['offset'] = str(offset + limit)
+            response.headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    return setCacheHeaders(response, etag)
+
+def streamedResponse(key, collectionNames, compute, mimetype):
+    """
+    Answer a query with a streamed response, or with status 304 if the client already has the current result.
+    compute() returns the serialized response, as a string or a generator of strings. Streamed responses are
+    not cached, but have the same ETag as the cached ones
+    """
+    etag = responseETag(key, collectionNames)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(compute(), mimetype=mimetype)
+    return setCacheHeaders(response, etag)
+
+def responseETag(key, collectionNames):
+    versions = []
+    for name in collectionNames:
+        clipQuery = collections.get(name)
+        useIndex(name, clipQuery)
+        versions.append((name, clipQuery.indexVersion))
+    return digest((key, versions))
+
+def digest(value):
+    """
+    Return a short hash of a value, so that keys of large queries, e.g. base64 encoded images, stay small in the caches
+    """
+    return blake2b(repr(value).encode('utf-8'), digest_size=16).hexdigest()
+
+def setCacheHeaders(response, etag):
+    response.set_etag(etag)
+    # Without a maximum age, caches have to revalidate the response, which is answered with 304 if the index has not changed
+    response.headers['Cache-Control'] = f"public, max-age={cacheMaxAge}" if cacheMaxAge > 0 else 'no-cache'
+    return response
+
+def rankedPage(key, collectionNames, offset, numResults, compute):
+    """
+    Return the results offset to offset + numResults of a query, sliced from its cached ranking if possible.
+    compute(depth) runs the query for its best depth results. The ranking is computed to a depth of at least
+    rankingDepth, so that the following pages do not need to run the query again.
+    """
+    indexes = g.get('indexes') or {}
+    key = digest((key, tuple((name, (indexes.get(name) or collections.get(name)).indexVersion) for name in collectionNames)))
+    needed = offset + numResults
+    initialDepth = max(needed, rankingDepth)
+    results, depth = rankingCache.get(key, lambda: (compute(initialDepth), initialDepth))
+    if len(results) == depth and depth < needed:
+        # The ranking may continue beyond the cached results
+        depth = max(needed, 2 * depth)
+        results = compute(depth)
+        rankingCache.put(key, (results, depth))
+    return results[offset:needed]
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    app.logger.warning(f"Rejected query: {e}")
+    return Response(json.dumps(error(str(e))), status=503, headers={'Retry-After': str(e.retryAfter)}, mimetype='application/json')
+
+@app.after_request
+def addIndexHeaders(response):
+    """
+    Report the version and the number of images of the indexes that answered the request, so that
+    clients and caches can tell when the index has been reloaded
+    """
+    indexes = g.get('indexes')
+    if indexes:
+        if len(indexes) == 1:
+            response.headers['X-Index-Version'] = next(iter(indexes.values())).indexVersion
+        else:
+            response.headers['X-Index-Version'] = ','.join(f"{name}={clipQuery.indexVersion}" for name, clipQuery in indexes.items())
+        response.headers['X-Index-Rows'] = str(sum(clipQuery.rows for clipQuery in indexes.values()))
+    return response
 
 @app.route('/')
 def index():
     return 'Server Works!'
 
+@app.route('/live')
+def live():
+    return Response('{"status": "OK"}', mimetype='application/json')
+
+@app.route('/ready')
+def readiness():
+    if ready.is_set():
+        return Response(json.dumps({'status': 'OK', 'startupTimes': startupTimes}), mimetype='application/json')
+    if loadError:
+        return Response(json.dumps(error(loadError)), status=503, mimetype='application/json')
+    return Response(json.dumps({'status': 'starting'}), status=503, headers={'Retry-After': '10'}, mimetype='application/json')
+
+@app.route('/stats')
+def stats():
+    response = collections.get().stats()
+    response['collections'] = collections.stats()
+    response['resultCache'] = resultCache.stats()
+    response['rankingCache'] = rankingCache.stats()
+    response['admission'] = {name: limiter.stats() for name, limiter in limiters.items() if limiter}
+    with searchersLock:
+        batching = {name: searcher.stats() for name, searcher in searchers.items() if isinstance(searcher, MicroBatcher)}
+    if batching:
+        response['batching'] = batching
+    return Response(json.dumps(response), mimetype='application/json')
+
+@app.route('/admin/reload', methods=['POST'])
+def reload():
+    """
+    Reload the index of a collection in the background, e.g. after build.py has added images
+    """
+    adminToken = os.environ.get('CLIP_ADMIN_TOKEN')
+    if adminToken and request.headers.get('Authorization') != f"Bearer {adminToken}":
+        return Response(json.dumps(error('Unauthorized')), status=401, mimetype='application/json')
+    try:
+        collectionNames = getCollectionNames(request.values.get('collection'))
+    except UnknownCollection as e:
+        return Response(json.dumps(error(str(e))), status=404, mimetype='application/json')
+    response = {}
+    for name in collectionNames:
+        started = collections.reload(name)
+        response[name] = 'reloading' if started else 'already reloading'
+        logging.info(f"Reload of collection {name}: {response[name]}")
+    return Response(json.dumps(response), status=202, mimetype='application/json')
+
 @app.route('/query', methods=['GET', 'POST'])
 def query():
     if 'limit' in request.values:
@@ -55,34 +426,136 @@ def query():
         minScore = float(request.values['minScore'])
     else:
         minScore = DEFAULT_MINSCORE
+    if 'nprobe' in request.values:
+        nprobe = int(request.values['nprobe'])
+        if nprobe < 0:
+            return Response(json.dumps(error('nprobe must not be negative')), status=400, mimetype='application/json')
+    else:
+        nprobe = None
+    offset = int(request.values.get('offset') or 0)
+    if offset < 0:
+        return Response(json.dumps(error('offset must not be negative')), status=400, mimetype='application/json')
+    try:
+        collectionNames = getCollectionNames(request.values.get('collection'))
+    except UnknownCollection as e:
+        return Response(json.dumps(error(str(e))), status=404, mimetype='application/json')
 
+    streamFormat = getStreamFormat()
     if 'str' in request.values:
         queryString = request.values['str']
-        result = queryWithString(queryString, minScore=minScore, numResults=limit)
         app.logger.info(f"Query by string: queryString='{queryString}', minScore={minScore}, numResults={limit}")
-        return Response(json.dumps(result), mimetype='application/json')
+        mode, queryInput, key = Query.MODE_TEXT, queryString, ('str', Query._textCacheKey(queryString))
     elif 'url' in request.values:
         queryUrl = request.values['url']
-        result = queryWithUrl(queryUrl, minScore=minScore, numResults=limit)
+        if not canQuery(queryUrl, Query.MODE_URL, collectionNames):
+            return Response(json.dumps(error(IMAGE_QUERIES_NOT_SUPPORTED)), status=501, mimetype='application/json')
         app.logger.info(f"Query by url: queryUrl='{queryUrl}', minScore={minScore}, numResults={limit}")
-        return Response(json.dumps(result), mimetype='application/json')
+        mode, queryInput, key = Query.MODE_URL, queryUrl, ('url', queryUrl)
+    elif 'imageId' in request.values:
+        queryImageId = request.values['imageId']
+        if not hasImage(queryImageId, collectionNames):
+            return Response(json.dumps(error(f"Image {queryImageId} is not indexed")), status=404, mimetype='application/json')
+        app.logger.info(f"Query by imageId: queryImageId='{queryImageId}', minScore={minScore}, numResults={limit}")
+        mode, queryInput, key = Query.MODE_ID, queryImageId, ('imageId', queryImageId)
     elif 'image' in request.values:
-        queryImage = decodeImageFromUrlString(request.values['image'])
-        result = queryWithImage(queryImage, minScore=minScore, numResults=limit)
-        app.logger.info(f"Query by image: queryImage='{queryImage}', minScore={minScore}, numResults={limit}")
-        return Response(json.dumps(result), mimetype='application/json')
-    return Response('{"status": "OK"}', mimetype='application/json')
+        if not canQuery(None, Query.MODE_IMAGE, collectionNames):
+            return Response(json.dumps(error(IMAGE_QUERIES_NOT_SUPPORTED)), status=501, mimetype='application/json')
+        queryImage = request.values['image']
+        app.logger.info(f"Query by image: minScore={minScore}, numResults={limit}")
+        mode, queryInput, key = Query.MODE_IMAGE, queryImage, ('image', digest(queryImage))
+    else:
+        return Response('{"status": "OK"}', mimetype='application/json')
+
+    key += (minScore, nprobe)
+    if streamFormat:
+        return streamedResponse(key + (limit, offset, streamFormat), collectionNames,
+            lambda: serializeStream(iterQuery(decodeQueryInput(queryInput, mode), mode, minScore=minScore, numResults=limit, nprobe=nprobe, collectionNames=collectionNames, offset=offset), streamFormat),
+            'application/x-ndjson' if streamFormat == 'ndjson' else 'application/json')
+    return cachedResponse(key + (limit, offset), collectionNames, lambda: rankedPage(key, collectionNames, offset, limit,
+        lambda depth: addLinks(runQuery(decodeQueryInput(queryInput, mode), mode, minScore=minScore, numResults=depth, nprobe=nprobe, collectionNames=collectionNames))), limit=limit, offset=offset)
+
+@app.route('/query/batch', methods=['POST'])
+def queryBatch():
+    body = request.get_json(silent=True)
+    if not body or not isinstance(body.get('queries'), list):
+        return Response(json.dumps(error('A JSON body with a list of queries is required')), status=400, mimetype='application/json')
+    limit = int(body.get('limit', DEFAULT_NUMRESULTS))
+    minScore = float(body.get('minScore', DEFAULT_MINSCORE))
+    nprobe = int(body['nprobe']) if 'nprobe' in body else None
+    if nprobe is not None and nprobe < 0:
+        return Response(json.dumps(error('nprobe must not be negative')), status=400, mimetype='application/json')
+    # Batches are run on a single collection
+    collection = body.get('collection') or collections.default
+    if collection not in collections.dataDirs:
+        return Response(json.dumps(error(f"Unknown collection {collection}, available collections are {', '.join(collections.names)}")), status=404, mimetype='application/json')
+    clipQuery = collections.get(collection)
+    useIndex(collection, clipQuery)
+
+    queries = []
+    for item in body['queries']:
+        if 'str' in item:
+            query = {'input': item['str'], 'mode': Query.MODE_TEXT}
+        elif 'url' in item:
+            query = {'input': item['url'], 'mode': Query.MODE_URL}
+        elif 'imageId' in item:
+            if not clipQuery.hasImage(item['imageId']):
+                return Response(json.dumps(error(f"Image {item['imageId']} is not indexed")), status=404, mimetype='application/json')
+            query = {'input': item['imageId'], 'mode': Query.MODE_ID}
+        elif 'image' in item:
+            query = {'input': decodeImageFromUrlString(item['image']), 'mode': Query.MODE_IMAGE}
+        else:
+            return Response(json.dumps(error('Every query requires a str, url, imageId or image')), status=400, mimetype='application/json')
+        if not clipQuery.canQuery(query['input'], query['mode']):
+            return Response(json.dumps(error(IMAGE_QUERIES_NOT_SUPPORTED)), status=501, mimetype='application/json')
+        query['numResults'] = int(item.get('limit', limit))
+        query['minScore'] = float(item.get('minScore', minScore))
+        queries.append(query)
+
+    # A batch is admitted as a single query, as a query by image if it contains any
+    byImage = any(query['mode'] in (Query.MODE_URL, Query.MODE_IMAGE) for query in queries)
+    with admission(Query.MODE_IMAGE if byImage else Query.MODE_TEXT):
+        results = clipQuery.queryBatch(queries, nprobe=nprobe)
+    for queryResults in results:
+        addLinks(queryResults)
+    app.logger.info(f"Batch query: queries={len(queries)}")
+    return Response(json.dumps(results), mimetype='application/json')
 
 @app.route('/sparql', methods=['GET', 'POST'])
 def sparql():
     if 'query' in request.values:
         query = request.values['query']
-        response = processSparqlQuery(query)
-        return Response(json.dumps(response), mimetype='application/json')
+        try:
+            collectionNames = getCollectionNames(extractRequestFromSparqlQuery(query).get('options', {}).get('collection'))
+        except UnknownCollection:
+            # The error is reported by processSparqlQuery
+            collectionNames = [collections.default]
+        key = ('sparql', ' '.join(query.split()))
+        if getStreamFormat():
+            # SPARQL results are always streamed as a single JSON document
+            return streamedResponse(key + ('stream',), collectionNames, lambda: streamSparqlQuery(query), 'application/json')
+        return cachedResponse(key, collectionNames, lambda: processSparqlQuery(query))
     
     return Response('{"status": "OK"}', mimetype='application/json')
 
 def createSparqlResponse(query, request, results):
+    parsedQuery = parser().parseQuery(query)
+    response = {}
+    response['head'] = {
+        "vars": parsedQuery['select']
+    }
+    response['results'] = {'bindings': list(iterSparqlBindings(parsedQuery, request, results))}
+    return response
+
+def streamSparqlResponse(query, request, results):
+    """
+    Serialize the SPARQL response while the results are generated, STREAM_CHUNK_SIZE bindings at a time
+    """
+    parsedQuery = parser().parseQuery(query)
+    yield '{"head": ' + json.dumps({"vars": parsedQuery['select']}) + ', "results": {"bindings": '
+    yield from serializeStream(iterSparqlBindings(parsedQuery, request, results), 'json')
+    yield '}}'
+
+def iterSparqlBindings(parsedQuery, request, results):
 
     def getDataTypeForValue(value):
         if isinstance(value, int):
@@ -96,15 +569,6 @@ def createSparqlResponse(query, request, results):
             return 'uri'
         return 'literal'
 
-    p = parser()
-    parsedQuery = p.parseQuery(query)
-
-    response = {}
-    response['head'] = {
-        "vars": parsedQuery['select']
-    }
-    bindings = []
-
     for result in results:
         row = {}
         for key, variable in request['select'].items():
@@ -114,9 +578,7 @@ def createSparqlResponse(query, request, results):
                     "type": getTypeForField(key),
                     "datatype": getDataTypeForValue(result[key])
                 }
-        bindings.append(row)
-    response['results'] = {'bindings': bindings}
-    return response
+        yield row
 
 def decodeImageFromUrlString(urlString): 
     """
@@ -191,8 +653,14 @@ def extractRequestFromSparqlQuery(query):
                 request['queryURL'] = triple['o']['value']
             elif getValueWithoutPrefix(triple['p']['value']) == 'queryImage' and triple['o']['type'] == Literal:
                 request['queryImage'] = triple['o']['value']
+            elif getValueWithoutPrefix(triple['p']['value']) == 'queryImageId' and triple['o']['type'] in (Literal, URIRef):
+                request['queryImageId'] = triple['o']['value']
             elif getValueWithoutPrefix(triple['p']['value']) == 'minScore' and triple['o']['type'] == Literal:
                 request = addOption(request, 'minScore', float(triple['o']['value']))
+            elif getValueWithoutPrefix(triple['p']['value']) == 'nprobe' and triple['o']['type'] == Literal:
+                request = addOption(request, 'nprobe', int(triple['o']['value']))
+            elif getValueWithoutPrefix(triple['p']['value']) == 'collection' and triple['o']['type'] == Literal:
+                request = addOption(request, 'collection', triple['o']['value'])
             elif getValueWithoutPrefix(triple['p']['value']) == 'iiifUrl' and triple['o']['type'] == Variable:
                 request = addSelect(request, 'url', triple['o']['value'])
             elif getValueWithoutPrefix(triple['p']['value']) == 'score' and triple['o']['type'] == Variable:
@@ -201,6 +669,8 @@ def extractRequestFromSparqlQuery(query):
     if 'limitOffset' in parsedQuery and parsedQuery['limitOffset']:
         if 'limit' in parsedQuery['limitOffset']:
             request = addOption(request, 'numResults', int(parsedQuery['limitOffset']['limit']))
+        if 'offset' in parsedQuery['limitOffset']:
+            request = addOption(request, 'offset', int(parsedQuery['limitOffset']['offset']))
 
     return request
 
@@ -210,58 +680,166 @@ def processSparqlQuery(query):
   """
   request = extractRequestFromSparqlQuery(query)
   result = queryWithRequest(request)
+  if 'error' in result:
+      return result
   response = createSparqlResponse(query, request, result)
   return response
 
-def queryWithRequest(request):
-    if not 'queryString' in request and not 'queryURL' in request and not 'queryImage' in request:
+def streamSparqlQuery(query):
+  """
+  Like processSparqlQuery, but returns a generator serializing the SPARQL response while the results are generated.
+  """
+  request = extractRequestFromSparqlQuery(query)
+  result = queryWithRequest(request, stream=True)
+  if isinstance(result, dict):
+      return json.dumps(result)
+  return streamSparqlResponse(query, request, result)
+
+def queryWithRequest(request, stream=False):
+    if not 'queryString' in request and not 'queryURL' in request and not 'queryImage' in request and not 'queryImageId' in request:
         return error('No query string provided')
+    minScore, numResults, nprobe, offset = DEFAULT_MINSCORE, DEFAULT_NUMRESULTS, None, 0
     if 'options' in request:
         if 'minScore' in request['options']:
             minScore = float(request['options']['minScore'])
-        else:
-            minScore = DEFAULT_MINSCORE
         if 'numResults' in request['options']:
             numResults = int(request['options']['numResults'])
-        else:
-            numResults = DEFAULT_NUMRESULTS
+        nprobe = request['options'].get('nprobe')
+        offset = request['options'].get('offset', 0)
+    if nprobe is not None and nprobe < 0:
+        return error('nprobe must not be negative')
+    try:
+        collectionNames = getCollectionNames(request.get('options', {}).get('collection'))
+    except UnknownCollection as e:
+        return error(str(e))
+    if 'queryURL' in request and not canQuery(request['queryURL'], Query.MODE_URL, collectionNames):
+        return error(IMAGE_QUERIES_NOT_SUPPORTED)
+    if 'queryImage' in request and not canQuery(None, Query.MODE_IMAGE, collectionNames):
+        return error(IMAGE_QUERIES_NOT_SUPPORTED)
     if 'queryString' in request:
-        results = clipQuery.query(request['queryString'], minScore=minScore, numResults=numResults)
+        mode, queryInput, key = Query.MODE_TEXT, request['queryString'], ('str', Query._textCacheKey(request['queryString']))
     elif 'queryURL' in request:
-        results = clipQuery.query(request['queryURL'], mode=Query.MODE_URL, minScore=minScore, numResults=numResults)
+        mode, queryInput, key = Query.MODE_URL, request['queryURL'], ('url', request['queryURL'])
+    elif 'queryImageId' in request:
+        mode, queryInput, key = Query.MODE_ID, request['queryImageId'], ('imageId', request['queryImageId'])
     elif 'queryImage' in request:
-        queryImage = decodeImageFromUrlString(request['queryImage'])
-        results = clipQuery.query(queryImage, mode=Query.MODE_IMAGE, minScore=minScore, numResults=numResults)
-    filteredResults = []
+        mode, queryInput, key = Query.MODE_IMAGE, request['queryImage'], ('image', digest(request['queryImage']))
+    if stream:
+        results = iterQuery(decodeQueryInput(queryInput, mode), mode, minScore=minScore, numResults=numResults, nprobe=nprobe, collectionNames=collectionNames, offset=offset)
+    else:
+        # The rankings are shared with the REST API
+        key += (minScore, nprobe)
+        results = rankedPage(key, collectionNames, offset, numResults,
+            lambda depth: addLinks(runQuery(decodeQueryInput(queryInput, mode), mode, minScore=minScore, numResults=depth, nprobe=nprobe, collectionNames=collectionNames)))
     if 'select' in request:
-        for result in results:
-            filteredResult = {}
-            for key, value in result.items():
-                if key in request['select']:
-                    filteredResult[key] = value
-            filteredResults.append(filteredResult)
-        return filteredResults
+        filteredResults = ({key: value for key, value in result.items() if key in request['select']} for result in results)
+        return filteredResults if stream else list(filteredResults)
     else:
         return results
 
-def queryWithImage(image, *, minScore=DEFAULT_MINSCORE, numResults=DEFAULT_NUMRESULTS):
-    results = clipQuery.query(image, mode=Query.MODE_IMAGE, numResults=numResults, minScore=minScore)
-    for result in results:
-        result['link'] = result['url'] + '/full/640,/0/default.jpg'
-    return results
+def decodeQueryInput(queryInput, mode):
+    """
+    Decode the base64 encoded image of an image query, other queries are passed as they are
+    """
+    if mode == Query.MODE_IMAGE:
+        return decodeImageFromUrlString(queryInput)
+    return queryInput
 
-def queryWithString(queryString, *, minScore=DEFAULT_MINSCORE, numResults=DEFAULT_NUMRESULTS):
-    results = clipQuery.query(queryString, numResults=numResults, minScore=minScore)
-    for result in results:
-        result['link'] = result['url'] + '/full/640,/0/default.jpg'
-    return results
+def addLink(result):
+    result['link'] = result['url'] + '/full/640,/0/default.jpg'
+    return result
 
-def queryWithUrl(queryUrl, *, minScore=DEFAULT_MINSCORE, numResults=DEFAULT_NUMRESULTS):
-    results = clipQuery.query(queryUrl, mode=Query.MODE_URL, numResults=numResults, minScore=minScore)
+def addLinks(results):
     for result in results:
-        result['link'] = result['url'] + '/full/640,/0/default.jpg'
+        addLink(result)
     return results
 
-if __name__ == "__main__":
+def serviceThreads():
+    """
+    Return the number of threads serving requests. By default, there are enough threads for all queries that
+    may run and wait, and a few more, so that queries beyond these and health checks are answered at once
+    """
+    if os.environ.get('CLIP_THREADS'):
+        return int(os.environ['CLIP_THREADS'])
+    return sum(limiter.maxConcurrent + limiter.maxQueued for limiter in limiters.values() if limiter) + 4
+
+def runWorker(sock, workers):
+    """
+    Serve requests on an inherited socket in a forked worker process.
+    """
+    import torch
     from waitress import serve
-    serve(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+
+    # Threads do not survive a fork, so the batching and watcher threads have to be started in the worker
+    searchers.clear()
+    startWatcher()
+    # Share the CPU cores between the workers instead of letting every worker use all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+    serve(app, sockets=[sock], threads=serviceThreads())
+
+def servePreforked(workers, *, host="0.0.0.0", port=5000):
+    """
+    Serve the app with several worker processes forked from this process.
+    The model, the features and the image ID table are loaded once, before forking, and the workers share
+    these pages with the parent process instead of each loading their own copy. Workers that exit are restarted.
+    Collections other than the default collection are loaded by every worker with their first query.
+    """
+    import signal
+    import socket
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+
+    children = set()
+    stopping = False
+
+    def startWorker():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                runWorker(sock, workers)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        startWorker()
+    logging.info(f"Started {workers} workers on {host}:{port}")
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            logging.info(f"Worker {pid} exited, starting a new worker")
+            startWorker()
+
+if __name__ == "__main__":
+    workers = int(os.environ.get('CLIP_WORKERS') or 1)
+    port = int(os.environ.get('CLIP_API_PORT') or 5000)
+    if workers > 1:
+        # The workers share what has been loaded before forking, so loading has to finish first
+        loader.join()
+        if not ready.is_set():
+            sys.exit(1)
+        servePreforked(workers, port=port)
+    else:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=port, threads=serviceThreads())
\ No newline at end of file
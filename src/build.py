@@ -9,11 +9,20 @@ If another column is used, it can be provided via the --iiifColumn option.
 
 For both modes of operation the path to a directory needs to be specified via the --dataDir option. The script will operate in
 this directory. A subdirectory named 'images' will be created and the images will be downloaded to this directory. The
-features will be computed and stored in a subdirectory named 'features'.
+features will be computed and stored in a subdirectory named 'features'. Images are encoded while further images are
+downloaded, and images whose features have already been computed are skipped, so an interrupted run can be resumed.
+Images that cannot be downloaded after retrying are listed in the file failures.csv in the data directory.
+With --storeImages false, the images are decoded in memory and never written to the 'images' directory.
+When the script is run again, only new images are encoded and appended to features.npy in place; images that are no
+longer listed are marked as removed in tombstones.npy instead of rewriting the features.
+The images are downloaded at the size needed by the CLIP model instead of in full, as described by the info.json of
+the first image of every image server.
 
 For publishing the extracted features, the downloaded images can be deleted from the directory when the script has finished. 
-The final features will be stored in the files features.npy and imageIds.csv. For publishing all other files in the features
-directory can be deleted. Retaining them locally can however be useful to speed up later processing.
+The final features will be stored in the files features.npy and imageIds.csv. Additionally, the features, image IDs and IIIF URLs
+are written to a single file index.bundle, which the service loads much faster than the other files. The bundle is only written
+when features.npy has been written as a whole, an incremental update removes it (use convertIndex.py to write it again). For publishing all other
+files in the features directory except tombstones.npy can be deleted. Retaining them locally can however be useful to speed up later processing.
 
 Usage:
 
@@ -41,6 +50,15 @@ Parameters:
     --iiifColumn: The name of the column containing the IIIF image URLs. Optional, defaults to iiif_url.
     --threads: The number of threads to use for downloading images. Optional, defaults to 16.
     --batchSize: The number of images to process in one batch. Optional, defaults to 64.
+    --decodeProcesses: The number of processes decoding and preprocessing images. Optional, defaults to half of the CPU cores.
+    --hostConcurrency: The maximum number of concurrent downloads from an image server. Optional, defaults to 8.
+    --hostRate: The maximum number of requests per second to an image server. Optional, not limited by default.
+    --retries: The maximum number of retries of a failed download. Optional, defaults to 3.
+    --imageSize: The minimum shortest edge of the downloaded images in pixels. Optional, defaults to the input resolution of the CLIP model.
+    --imageFormats: Comma separated list of image formats to download in the order of preference, if the image server supports them, e.g. webp,jpg. Optional, defaults to jpg.
+    --storeImages: Store the downloaded images in the images subdirectory, true or false. Optional, defaults to true.
+    --quantization: Additionally store the features compressed, either int8 or pq (product quantization). Optional.
+    --ivfLists: Build an approximate nearest neighbour index with this number of lists. Use 0 to derive it from the number of images. Optional, no index is built by default.
 
 """
 
@@ -60,7 +78,7 @@ LIMIT 100
 endpoint = 'http://blazegraph:8080/blazegraph/sparql'
 
 def build(options):
-    from sariIiifClipSearch import Images
+    from sariIiifClipSearch import Images, IVFIndex
 
     if options['mode'] == 'SPARQL':
         mode = Images.MODE_SPARQL
@@ -80,7 +98,15 @@ def build(options):
             imageQuery=options['imageQuery'],
             endpoint=options['endpoint'],
             threads=options['threads'],
-            batchSize=options['batchSize']
+            batchSize=options['batchSize'],
+            quantization=options.get('quantization'),
+            decodeProcesses=options.get('decodeProcesses'),
+            hostConcurrency=options['hostConcurrency'],
+            hostRate=options.get('hostRate'),
+            retries=options['retries'],
+            imageSize=options.get('imageSize'),
+            imageFormats=options['imageFormats'],
+            storeImages=options['storeImages']
         )
     elif mode == Images.MODE_CSV:
         csvFile = options['csvFile']
@@ -91,7 +117,15 @@ def build(options):
             iiifColumn=options['iiifColumn'],
             imageCSV=options['csvFile'],
             threads=options['threads'],
-            batchSize=options['batchSize']
+            batchSize=options['batchSize'],
+            quantization=options.get('quantization'),
+            decodeProcesses=options.get('decodeProcesses'),
+            hostConcurrency=options['hostConcurrency'],
+            hostRate=options.get('hostRate'),
+            retries=options['retries'],
+            imageSize=options.get('imageSize'),
+            imageFormats=options['imageFormats'],
+            storeImages=options['storeImages']
         )
     
     if mode == Images.MODE_SPARQL:
@@ -101,11 +135,23 @@ def build(options):
         except Exception as e:
             sys.exit(e)
 
-    print("Downloading images")
-    imageProcessor.downloadImages()
-
-    print("Processing images")
-    imageProcessor.processImages()
+    print("Downloading and processing images")
+    imageProcessor.downloadAndProcessImages()
+
+    # After an incremental update, the merge has already updated the index and the bundle would be rewritten as a whole
+    ivfPath = imageProcessor.featuresDir / IVFIndex.FILENAME
+    if 'ivfLists' in options:
+        if imageProcessor.featuresRewritten or not ivfPath.exists() or options['ivfLists'] not in (0, IVFIndex.load(ivfPath).lists):
+            print("Building approximate nearest neighbour index")
+            imageProcessor.buildIndex(lists=options['ivfLists'] or None)
+        else:
+            print("The approximate nearest neighbour index has been updated with the changed images")
+
+    if imageProcessor.featuresRewritten:
+        print("Writing index bundle")
+        imageProcessor.writeBundle()
+    else:
+        print("Not writing the index bundle, the features have been updated in place")
 
     print("Done.")
 
@@ -157,5 +203,23 @@ if __name__ == "__main__":
     else:
         options['batchSize'] = int(options['batchSize'])
 
+    if 'ivfLists' in options:
+        options['ivfLists'] = int(options['ivfLists'])
+
+    if 'decodeProcesses' in options:
+        options['decodeProcesses'] = int(options['decodeProcesses'])
+
+    options['hostConcurrency'] = int(options.get('hostConcurrency', 8))
+    options['retries'] = int(options.get('retries', 3))
+    if 'hostRate' in options:
+        options['hostRate'] = float(options['hostRate'])
+
+    if 'imageSize' in options:
+        options['imageSize'] = int(options['imageSize'])
+
+    options['imageFormats'] = tuple(options.get('imageFormats', 'jpg').split(','))
+
+    options['storeImages'] = options.get('storeImages', 'true').lower() != 'false'
+
     build(options)
     
\ No newline at end of file
@@ -10,7 +10,7 @@ from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
-from model import build_model
+from model import build_model, load_visual as _load_visual
 from simple_tokenizer import SimpleTokenizer as _Tokenizer
 
 try:
@@ -24,7 +24,7 @@ if packaging.version.parse(torch.__version__) < packaging.version.parse("1.7.1")
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "download", "load", "load_visual", "tokenize"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -39,6 +39,35 @@ _MODELS = {
 }
 
 
+def _sha256(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _verify(path: str, expected_sha256: str):
+    # the checksum is only computed if the file changed since it was last verified,
+    # which is recorded in a stamp file next to it together with its size and modification time
+    stamp_path = path + ".sha256"
+    stat = os.stat(path)
+    stamp = f"{stat.st_size} {stat.st_mtime_ns} {expected_sha256}"
+    if os.path.isfile(stamp_path):
+        with open(stamp_path) as f:
+            if f.read().strip() == stamp:
+                return True
+
+    if _sha256(path) != expected_sha256:
+        return False
+    try:
+        with open(stamp_path, "w") as f:
+            f.write(stamp)
+    except OSError:
+        pass
+    return True
+
+
 def _download(url: str, root: str):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -50,7 +79,7 @@ def _download(url: str, root: str):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _verify(download_target, expected_sha256):
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
@@ -65,7 +94,7 @@ def _download(url: str, root: str):
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if not _verify(download_target, expected_sha256):
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
     return download_target
@@ -90,7 +119,20 @@ def available_models() -> List[str]:
     return list(_MODELS.keys())
 
 
-def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None):
+def download(name: str, download_root: str = None):
+    """Download a CLIP model if needed and return the path to the checkpoint
+
+    The checksum of a downloaded model is only computed again if the file has been modified.
+    """
+    if name in _MODELS:
+        return _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
+    elif os.path.isfile(name):
+        return name
+    else:
+        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+
+def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_available() else "cpu", jit: bool = False, download_root: str = None, visual: bool = True):
     """Load a CLIP model
 
     Parameters
@@ -107,6 +149,10 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     download_root: str
         path to download the model files; by default, it uses "~/.cache/clip"
 
+    visual : bool
+        Whether to build the image encoder. A model loaded without it can only encode text until
+        `clip.load_visual` is called. Not supported by the JIT model.
+
     Returns
     -------
     model : torch.nn.Module
@@ -115,12 +161,10 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     preprocess : Callable[[PIL.Image], torch.Tensor]
         A torchvision transform that converts a PIL image into a tensor that the returned model can take as its input
     """
-    if name in _MODELS:
-        model_path = _download(_MODELS[name], download_root or os.path.expanduser("~/.cache/clip"))
-    elif os.path.isfile(name):
-        model_path = name
-    else:
-        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+    if jit and not visual:
+        raise RuntimeError("The JIT model cannot be loaded without the image encoder, use jit=False")
+
+    model_path = download(name, download_root)
 
     try:
         # loading JIT archive
@@ -134,10 +178,10 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
         state_dict = torch.load(model_path, map_location="cpu")
 
     if not jit:
-        model = build_model(state_dict or model.state_dict()).to(device)
+        model = build_model(state_dict or model.state_dict(), visual=visual).to(device)
         if str(device) == "cpu":
             model.float()
-        return model, _transform(model.visual.input_resolution)
+        return model, _transform(model.image_resolution)
 
     # patch the device names
     device_holder = torch.jit.trace(lambda: torch.ones([]).to(torch.device(device)), example_inputs=[])
@@ -192,6 +236,37 @@ def load(name: str, device: Union[str, torch.device] = "cuda" if torch.cuda.is_a
     return model, _transform(model.input_resolution.item())
 
 
+def load_visual(model: torch.nn.Module, name: str, download_root: str = None):
+    """Load the image encoder of a model loaded with `visual=False`
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The CLIP model returned by `clip.load(name, visual=False)`
+
+    name : str
+        The model name or checkpoint path the model has been loaded from
+
+    download_root: str
+        path to download the model files; by default, it uses "~/.cache/clip"
+
+    Returns
+    -------
+    model : torch.nn.Module
+        The same CLIP model, now able to encode images
+    """
+    model_path = download(name, download_root)
+    try:
+        state_dict = torch.jit.load(model_path, map_location="cpu").state_dict()
+    except RuntimeError:
+        state_dict = torch.load(model_path, map_location="cpu")
+
+    _load_visual(model, state_dict)
+    if model.text_projection.device.type == "cpu":
+        model.visual.float()
+    return model
+
+
 def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False) -> torch.LongTensor:
     """
     Returns the tokenized representation of given input string(s)
@@ -180,7 +180,9 @@ class ResidualAttentionBlock(nn.Module):
 
     def attention(self, x: torch.Tensor):
         self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        # the sequence can be shorter than the context length the mask was built for (see CLIP.encode_text)
+        attn_mask = self.attn_mask[:x.shape[0], :x.shape[0]] if self.attn_mask is not None else None
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
 
     def forward(self, x: torch.Tensor):
         x = x + self.attention(self.ln_1(x))
@@ -236,6 +238,32 @@ class VisionTransformer(nn.Module):
         return x
 
 
+def build_visual(embed_dim: int,
+                 image_resolution: int,
+                 vision_layers: Union[Tuple[int, int, int, int], int],
+                 vision_width: int,
+                 vision_patch_size: int):
+    if isinstance(vision_layers, (tuple, list)):
+        vision_heads = vision_width * 32 // 64
+        return ModifiedResNet(
+            layers=vision_layers,
+            output_dim=embed_dim,
+            heads=vision_heads,
+            input_resolution=image_resolution,
+            width=vision_width
+        )
+
+    vision_heads = vision_width // 64
+    return VisionTransformer(
+        input_resolution=image_resolution,
+        patch_size=vision_patch_size,
+        width=vision_width,
+        layers=vision_layers,
+        heads=vision_heads,
+        output_dim=embed_dim
+    )
+
+
 class CLIP(nn.Module):
     def __init__(self,
                  embed_dim: int,
@@ -249,31 +277,19 @@ class CLIP(nn.Module):
                  vocab_size: int,
                  transformer_width: int,
                  transformer_heads: int,
-                 transformer_layers: int
+                 transformer_layers: int,
+                 # build the image encoder, a text only model can load it later with load_visual
+                 visual: bool = True
                  ):
         super().__init__()
 
         self.context_length = context_length
+        self.image_resolution = image_resolution
 
-        if isinstance(vision_layers, (tuple, list)):
-            vision_heads = vision_width * 32 // 64
-            self.visual = ModifiedResNet(
-                layers=vision_layers,
-                output_dim=embed_dim,
-                heads=vision_heads,
-                input_resolution=image_resolution,
-                width=vision_width
-            )
+        if visual:
+            self.visual = build_visual(embed_dim, image_resolution, vision_layers, vision_width, vision_patch_size)
         else:
-            vision_heads = vision_width // 64
-            self.visual = VisionTransformer(
-                input_resolution=image_resolution,
-                patch_size=vision_patch_size,
-                width=vision_width,
-                layers=vision_layers,
-                heads=vision_heads,
-                output_dim=embed_dim
-            )
+            self.visual = None
 
         self.transformer = Transformer(
             width=transformer_width,
@@ -331,15 +347,24 @@ class CLIP(nn.Module):
 
     @property
     def dtype(self):
-        return self.visual.conv1.weight.dtype
+        return self.text_projection.dtype
 
     def encode_image(self, image):
+        if self.visual is None:
+            raise RuntimeError("The model has been built without the image encoder")
         return self.visual(image.type(self.dtype))
 
-    def encode_text(self, text):
+    def encode_text(self, text, trim: bool = True):
+        eot = text.argmax(dim=-1)  # eot_token is the highest number in each sequence
+
+        if trim:
+            # the attention mask is causal and only the eot embedding is read, so the positions after
+            # the last eot token of the batch do not affect the output and need not be computed
+            text = text[:, :int(eot.max()) + 1]
+
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
-        x = x + self.positional_embedding.type(self.dtype)
+        x = x + self.positional_embedding[:text.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
         x = self.transformer(x)
         x = x.permute(1, 0, 2)  # LND -> NLD
@@ -347,7 +372,7 @@ class CLIP(nn.Module):
 
         # x.shape = [batch_size, n_ctx, transformer.width]
         # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0]), eot] @ self.text_projection
 
         return x
 
@@ -392,7 +417,7 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+def _visual_config(state_dict: dict):
     vit = "visual.proj" in state_dict
 
     if vit:
@@ -410,6 +435,12 @@ def build_model(state_dict: dict):
         assert output_width ** 2 + 1 == state_dict["visual.attnpool.positional_embedding"].shape[0]
         image_resolution = output_width * 32
 
+    return image_resolution, vision_layers, vision_width, vision_patch_size
+
+
+def build_model(state_dict: dict, visual: bool = True):
+    image_resolution, vision_layers, vision_width, vision_patch_size = _visual_config(state_dict)
+
     embed_dim = state_dict["text_projection"].shape[1]
     context_length = state_dict["positional_embedding"].shape[0]
     vocab_size = state_dict["token_embedding.weight"].shape[0]
@@ -420,13 +451,25 @@ def build_model(state_dict: dict):
     model = CLIP(
         embed_dim,
         image_resolution, vision_layers, vision_width, vision_patch_size,
-        context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+        context_length, vocab_size, transformer_width, transformer_heads, transformer_layers,
+        visual=visual
     )
 
     for key in ["input_resolution", "context_length", "vocab_size"]:
         if key in state_dict:
             del state_dict[key]
+    if not visual:
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith("visual.")}
 
     convert_weights(model)
     model.load_state_dict(state_dict)
     return model.eval()
+
+
+def load_visual(model: CLIP, state_dict: dict):
+    """Build the image encoder of a model built with visual=False and load its weights"""
+    visual = build_visual(model.text_projection.shape[1], *_visual_config(state_dict))
+    convert_weights(visual)
+    visual.load_state_dict({k[len("visual."):]: v for k, v in state_dict.items() if k.startswith("visual.")})
+    model.visual = visual.to(model.text_projection.device).eval()
+    return model
@@ -0,0 +1,52 @@
+"""
+This script writes the index bundle (index.bundle) for features that have been extracted before the bundle was introduced,
+such as the directories in precomputedFeatures. The bundle contains the features, image IDs and IIIF URLs in a single file
+that the service loads without parsing the CSV files. build.py writes the bundle itself.
+
+The data directory needs to contain the file images.csv (or the CSV file given via --csvFile) and the subdirectory features
+with the files features.npy and imageIds.csv. The bundle is written to the features subdirectory.
+
+Usage:
+
+    python convertIndex.py --dataDir ../precomputedFeatures/bso
+
+Parameters:
+    --dataDir: The path to the directory containing the extracted features.
+    --csvFile: The path to the CSV file containing the IIIF image URLs. Optional, defaults to images.csv in the data directory.
+    --iiifColumn: The name of the column containing the IIIF image URLs. Optional, defaults to iiif_url.
+
+"""
+import sys
+from pathlib import Path
+
+def convert(options):
+    from sariIiifClipSearch import writeIndexBundle
+
+    dataDir = Path(options['dataDir'])
+    writeIndexBundle(
+        dataDir / 'features',
+        imageCSV=options.get('csvFile') or dataDir / 'images.csv',
+        iiifColumn=options['iiifColumn']
+    )
+
+    print("Done.")
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if i + 2 < len(sys.argv) and not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'dataDir' in options:
+        print("The data directory is required")
+        sys.exit(1)
+
+    if not 'iiifColumn' in options:
+        options['iiifColumn'] = 'iiif_url'
+
+    convert(options)
@@ -1 +1,12 @@
-from .iiifClipSearch import *
\ No newline at end of file
+from .iiifClipSearch import *
+from .search import *
+from .ann import *
+from .quantization import *
+from .cache import *
+from .batching import *
+from .bundle import *
+from .collection import *
+from .admission import *
+from .pipeline import *
+from .download import *
+from .iiif import *
@@ -0,0 +1,144 @@
+import math
+import threading
+import time
+
+__all__ = ["AdmissionLimiter", "Overloaded"]
+
+class Overloaded(Exception):
+    """
+    Raised when a query is rejected because too many queries are running and waiting.
+    retryAfter is the number of seconds after which the query may be admitted.
+    """
+
+    def __init__(self, message, retryAfter):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+class AdmissionLimiter:
+    """
+    Limits the number of queries run at once, so that a burst of queries does not slow down all of them.
+
+    Up to maxConcurrent queries run at once. Further queries wait for a running query to finish, but at most
+    maxQueued of them and for at most maxWait seconds. A query that finds the queue full, or is not admitted
+    before its deadline, is rejected with Overloaded instead of waiting further, so that the client can retry
+    later or go elsewhere.
+
+    Usage Example:
+
+        limiter = AdmissionLimiter(4, maxQueued=16, maxWait=2, name='text')
+        try:
+            with limiter:
+                results = clipQuery.query('A mountain lake')
+        except Overloaded as e:
+            print(f"Retry after {e.retryAfter}s")
+    """
+
+    def __init__(self, maxConcurrent, *, maxQueued=16, maxWait=2.0, name='queries'):
+        """
+        Instantiate the limiter.
+
+        params:
+            maxConcurrent: The maximum number of queries running at once.
+            maxQueued: The maximum number of queries waiting to run. 0 rejects all queries that cannot run at once. Defaults to 16.
+            maxWait: The maximum time in seconds a query waits to run. Defaults to 2.
+            name: The name of the limited queries, used in the messages of the rejections. Defaults to 'queries'.
+        """
+        if maxConcurrent < 1:
+            raise Exception("At least one concurrent query is required")
+        self.maxConcurrent = maxConcurrent
+        self.maxQueued = maxQueued
+        self.maxWait = maxWait
+        self.name = name
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejectedQueueFull = 0
+        self.rejectedDeadline = 0
+        self.maxQueuedSeen = 0
+        self._waitTime = 0.0
+        # A moving average of the time a query runs, to estimate when a rejected query can be retried
+        self._runTime = None
+        self._condition = threading.Condition()
+        # The start of the query of every thread using the limiter as a context manager
+        self._started = threading.local()
+
+    def acquire(self):
+        """
+        Wait until the query may run. Raises Overloaded if the queue is full or the query is not admitted in time.
+        Every successful call has to be followed by a call of release.
+        """
+        with self._condition:
+            if self.running < self.maxConcurrent:
+                self._admit(0)
+                return time.perf_counter()
+            if self.queued >= self.maxQueued:
+                self.rejectedQueueFull += 1
+                raise Overloaded(f"Too many {self.name} queries: {self.running} running and {self.queued} waiting", self.retryAfter())
+            start = time.monotonic()
+            deadline = start + self.maxWait
+            self.queued += 1
+            self.maxQueuedSeen = max(self.maxQueuedSeen, self.queued)
+            try:
+                while self.running >= self.maxConcurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejectedDeadline += 1
+                        raise Overloaded(f"Too many {self.name} queries: not admitted within {self.maxWait}s", self.retryAfter())
+                    self._condition.wait(remaining)
+            finally:
+                self.queued -= 1
+            self._admit(time.monotonic() - start)
+            return time.perf_counter()
+
+    def _admit(self, waitTime):
+        self.running += 1
+        self.admitted += 1
+        self._waitTime += waitTime
+
+    def release(self, started=None):
+        """
+        Mark a query as finished, admitting the next waiting query.
+
+        params:
+            started: The value returned by acquire, to measure how long the query ran. Optional.
+        """
+        with self._condition:
+            self.running -= 1
+            if started is not None:
+                runTime = time.perf_counter() - started
+                self._runTime = runTime if self._runTime is None else 0.9 * self._runTime + 0.1 * runTime
+            self._condition.notify()
+
+    def __enter__(self):
+        self._started.value = self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release(self._started.value)
+        return False
+
+    def retryAfter(self):
+        """
+        Return the number of seconds, at least 1, until the queries running and waiting are expected to have finished.
+        """
+        if self._runTime is None:
+            return 1
+        return max(1, math.ceil(self._runTime * (self.running + self.queued) / self.maxConcurrent))
+
+    def stats(self):
+        """
+        Return the number of queries running and waiting, and the number of admitted and rejected queries.
+        """
+        return {
+            'maxConcurrent': self.maxConcurrent,
+            'maxQueued': self.maxQueued,
+            'running': self.running,
+            'queued': self.queued,
+            'maxQueuedSeen': self.maxQueuedSeen,
+            'admitted': self.admitted,
+            'rejected': self.rejectedQueueFull + self.rejectedDeadline,
+            'rejectedQueueFull': self.rejectedQueueFull,
+            'rejectedDeadline': self.rejectedDeadline,
+            'averageWait': self._waitTime / self.admitted if self.admitted else 0,
+            'averageRunTime': self._runTime or 0
+        }
@@ -0,0 +1,152 @@
+import math
+import numpy as np
+from .search import topK
+
+__all__ = ["IVFIndex"]
+
+class IVFIndex:
+    """
+    An inverted file index for approximate nearest neighbour search over normalised feature vectors.
+
+    The feature vectors are partitioned into lists by assigning them to the nearest of a set of
+    coarse centroids, which are trained with spherical k-means. A query only scans the rows of the
+    nprobe lists whose centroids are most similar to the query instead of all rows.
+
+    The index only stores the centroids and the row numbers of each list. The feature vectors themselves
+    are read from features.npy, so the index can be used together with a memory-mapped feature matrix.
+
+    Usage Example:
+
+        # Build the index and save it next to features.npy
+        index = IVFIndex.train(features)
+        index.save('data/features/ivf.npz')
+
+        # Load the index and search it
+        index = IVFIndex.load('data/features/ivf.npz')
+        indices, scores = index.search(queryFeatures, features, 10, nprobe=8)
+    """
+
+    FILENAME = 'ivf.npz'
+
+    def __init__(self, centroids, listOffsets, listRows):
+        """
+        Instantiate the index from its arrays. Use IVFIndex.train or IVFIndex.load to create an index.
+
+        params:
+            centroids: The normalised coarse centroids, of shape (lists, dimensions).
+            listOffsets: The start of each list in listRows, of shape (lists + 1,).
+            listRows: The row numbers of the feature vectors, grouped by list.
+        """
+        self.centroids = centroids
+        self.listOffsets = listOffsets
+        self.listRows = listRows
+
+    @property
+    def lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def train(cls, features, *, lists=None, iterations=20, sampleSize=None, blockSize=65536, seed=0):
+        """
+        Train the coarse centroids with spherical k-means and assign all feature vectors to their list.
+
+        params:
+            features: The normalised feature matrix, of shape (rows, dimensions).
+            lists: The number of lists. Defaults to 4 * sqrt(rows).
+            iterations: The number of k-means iterations. Defaults to 20.
+            sampleSize: The number of rows used to train the centroids. Defaults to 64 rows per list.
+            blockSize: The number of rows assigned to lists at once. Defaults to 65536.
+            seed: The seed of the random number generator. Defaults to 0.
+        """
+        rows = features.shape[0]
+        if not lists:
+            lists = max(1, int(4 * math.sqrt(rows)))
+        lists = min(lists, rows)
+        if not sampleSize:
+            sampleSize = 64 * lists
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(rows, size=min(sampleSize, rows), replace=False))
+        trainingFeatures = np.asarray(features[sample], dtype=np.float32)
+
+        centroids = trainingFeatures[rng.choice(trainingFeatures.shape[0], size=lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = cls._assign(trainingFeatures, centroids, blockSize)
+            order = np.argsort(assignment, kind='stable')
+            counts = np.bincount(assignment, minlength=lists)
+            # Lists that lost all their vectors keep their previous centroid
+            used = counts > 0
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])[used]
+            sums = np.add.reduceat(trainingFeatures[order], offsets, axis=0)
+            centroids[used] = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+        assignment = cls._assign(features, centroids, blockSize)
+        listRows = np.argsort(assignment, kind='stable').astype(np.int64)
+        listOffsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=lists))]).astype(np.int64)
+        return cls(centroids.astype(np.float32), listOffsets, listRows)
+
+    def update(self, rows, features, *, blockSize=65536):
+        """
+        Assign rows of the feature matrix to their list again, keeping the centroids, e.g. after an incremental build
+        changed or appended them. Rows beyond the rows of the index are added to it and must all be given.
+
+        params:
+            rows: The row numbers whose feature vectors have changed.
+            features: The normalised feature matrix, of shape (rows, dimensions).
+            blockSize: The number of rows assigned to lists at once. Defaults to 65536.
+        """
+        # Reading the rows in file order is considerably faster for memory-mapped features
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if np.count_nonzero(rows >= self.listRows.shape[0]) != features.shape[0] - self.listRows.shape[0]:
+            raise Exception("All rows appended to the feature matrix need to be assigned to a list")
+        assignment = np.empty(features.shape[0], dtype=np.int64)
+        assignment[self.listRows] = np.repeat(np.arange(self.lists), np.diff(self.listOffsets))
+        assignment[rows] = self._assign(features[rows], self.centroids, blockSize)
+        self.listRows = np.argsort(assignment, kind='stable').astype(np.int64)
+        self.listOffsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=self.lists))]).astype(np.int64)
+
+    @staticmethod
+    def _assign(features, centroids, blockSize):
+        assignment = np.empty(features.shape[0], dtype=np.int64)
+        for start in range(0, features.shape[0], blockSize):
+            block = np.asarray(features[start:start + blockSize], dtype=np.float32)
+            assignment[start:start + blockSize] = np.argmax(block @ centroids.T, axis=1)
+        return assignment
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved with IVFIndex.save.
+        """
+        with np.load(path) as data:
+            return cls(data['centroids'], data['listOffsets'], data['listRows'])
+
+    def save(self, path):
+        """
+        Save the index to a .npz file.
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, listOffsets=self.listOffsets, listRows=self.listRows)
+
+    def search(self, queryFeatures, features, k, *, nprobe=8, minScore=None):
+        """
+        Select the approximately k best rows of the feature matrix for a query vector.
+
+        params:
+            queryFeatures: The normalised query vector, of shape (dimensions,).
+            features: The normalised feature matrix the index was built for.
+            k: The maximum number of results to return.
+            nprobe: The number of lists to scan. Higher values give better recall at the cost of latency. At least one
+                    list is scanned. Defaults to 8.
+            minScore: Optional minimum score. Scores below this value are never returned.
+
+        returns:
+            A tuple (indices, scores) of arrays sorted by descending score.
+        """
+        queryFeatures = np.asarray(queryFeatures, dtype=np.float32).reshape(-1)
+        probes, _ = topK(self.centroids @ queryFeatures, max(1, min(nprobe, self.lists)))
+        rows = np.concatenate([self.listRows[self.listOffsets[probe]:self.listOffsets[probe + 1]] for probe in probes])
+        # Read the rows in file order, which is considerably faster for memory-mapped features
+        rows.sort()
+        selected, scores = topK(features[rows] @ queryFeatures, k, minScore=minScore)
+        return rows[selected], scores
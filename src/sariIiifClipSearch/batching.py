@@ -0,0 +1,150 @@
+import queue
+import threading
+import time
+
+__all__ = ["MicroBatcher"]
+
+class _Request:
+    """
+    A query waiting to be run as part of a batch.
+    """
+
+    def __init__(self, query, nprobe):
+        self.query = query
+        self.nprobe = nprobe
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher:
+    """
+    Collects queries submitted concurrently by several threads and runs them together with Query.queryBatch.
+
+    The first waiting query opens a batch. The batch is run as soon as it holds maxBatch queries or
+    maxWait seconds after it was opened, whichever comes first. The results are handed back to the
+    waiting threads. Under load, this replaces many forward passes with a batch size of 1, which
+    compete for the same CPU cores, by a few larger ones.
+
+    Usage Example:
+
+        batcher = MicroBatcher(clipQuery, maxWait=0.005, maxBatch=32)
+        results = batcher.query('A mountain lake', numResults=10)
+    """
+
+    def __init__(self, query, *, maxWait=0.005, maxBatch=32):
+        """
+        Instantiate the batcher and start its worker thread.
+
+        params:
+            query: The Query object used to run the batches.
+            maxWait: The maximum time in seconds a query waits for other queries to join its batch. Defaults to 0.005.
+            maxBatch: The maximum number of queries in a batch. Defaults to 32.
+        """
+        self.clipQuery = query
+        self.maxWait = maxWait
+        self.maxBatch = maxBatch
+        self._queue = queue.Queue()
+        self._closed = False
+        self._closeLock = threading.Lock()
+        self.batches = 0
+        self.queries = 0
+        self._worker = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self._worker.start()
+
+    def query(self, queryInput, *, mode=None, numResults=5, minScore=0.2, nprobe=None):
+        """
+        Run a query as part of a batch and wait for its results. Takes the same parameters as Query.query.
+        """
+        if mode is None:
+            mode = self.clipQuery.MODE_TEXT
+        if mode == self.clipQuery.MODE_URL and self.clipQuery._lookupRow(queryInput, mode) is None:
+            # Download the image in the requesting thread so that a slow server does not hold up the batch
+            queryInput = self.clipQuery._loadImage(queryInput, mode)
+            mode = self.clipQuery.MODE_IMAGE
+
+        request = _Request({'input': queryInput, 'mode': mode, 'numResults': numResults, 'minScore': minScore}, nprobe)
+        with self._closeLock:
+            closed = self._closed
+            if not closed:
+                self._queue.put(request)
+        if closed:
+            # The batcher has been closed after this query picked it, run the query on its own
+            return self.clipQuery.queryBatch([request.query], nprobe=nprobe)[0]
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        """
+        Stop the worker thread once the queries already submitted have been run, e.g. when the Query object is unloaded.
+        Queries submitted afterwards are run without batching.
+        """
+        with self._closeLock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def stats(self):
+        """
+        Return the number of batches and queries run, and the number of queries waiting.
+        """
+        return {
+            'batches': self.batches,
+            'queries': self.queries,
+            'averageBatchSize': self.queries / self.batches if self.batches else 0,
+            'waiting': self._queue.qsize()
+        }
+
+    def _collect(self):
+        # Returns None when the batcher is closed
+        request = self._queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.monotonic() + self.maxWait
+        while len(batch) < self.maxBatch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                # Run the current batch first, the next call stops the worker
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # Queries with a different nprobe use a different search and are run as separate batches
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.nprobe, []).append(request)
+            for nprobe, requests in groups.items():
+                self._runBatch(requests, nprobe)
+
+    def _runBatch(self, requests, nprobe):
+        try:
+            results = self.clipQuery.queryBatch([request.query for request in requests], nprobe=nprobe)
+        except Exception as e:
+            if len(requests) == 1:
+                # Pass the exception on to the waiting thread
+                requests[0].error = e
+                requests[0].done.set()
+            else:
+                # Run the queries one by one, so that a single failing query does not fail the others
+                for request in requests:
+                    self._runBatch([request], nprobe)
+            return
+        self.batches += 1
+        self.queries += len(requests)
+        for request, result in zip(requests, results):
+            request.result = result
+            request.done.set()
@@ -0,0 +1,215 @@
+import json
+import os
+import numpy as np
+from datetime import datetime, timezone
+
+__all__ = ["StringTable", "IndexBundle"]
+
+class StringTable:
+    """
+    A table of UTF-8 strings aligned with the rows of the feature matrix.
+
+    The strings are stored back to back in a single bytes array, together with the offset of every string in it
+    and the order of the rows sorted by their string. The table holds no Python objects, so it can be memory-mapped
+    and shared by forked processes, and a string is found with a binary search instead of a dictionary.
+
+    Usage Example:
+
+        table = StringTable.fromStrings(['b', 'a', 'c'])
+        table[0]          # 'b'
+        table.find('c')   # 2
+    """
+
+    def __init__(self, offsets, data, order):
+        """
+        Instantiate the table from its arrays. Use StringTable.fromStrings to create a table from a list of strings.
+
+        params:
+            offsets: The start of each string in data, of shape (rows + 1,).
+            data: The UTF-8 encoded strings, as an array of bytes.
+            order: The rows sorted by their string, rows with the same string in ascending order.
+        """
+        self.offsets = offsets
+        self.data = data
+        self.order = order
+
+    @classmethod
+    def fromStrings(cls, strings):
+        """
+        Build a table from a sequence of strings.
+        """
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        # sorted is stable, so rows with the same string stay in ascending order
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        return cls(offsets, data, order)
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def _bytes(self, row):
+        return self.data[self.offsets[row]:self.offsets[row + 1]].tobytes()
+
+    def __getitem__(self, row):
+        return self._bytes(row).decode('utf-8')
+
+    def find(self, value):
+        """
+        Return the first row containing the string value, or None if the table does not contain it.
+        """
+        # UTF-8 preserves the order of the code points, so comparing the bytes compares the strings
+        value = value.encode('utf-8')
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._bytes(self.order[middle]) < value:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.order) and self._bytes(self.order[low]) == value:
+            return int(self.order[low])
+        return None
+
+
+class IndexBundle:
+    """
+    A single file containing everything needed to answer queries: the feature matrix and the image IDs and
+    IIIF URLs of its rows.
+
+    The file starts with a magic number, the length of the header and a JSON header containing the format version,
+    the name of the model, the dimensions and number of rows, the build time and the type, shape and offset of every
+    array. The arrays follow the header, aligned to 64 bytes, so that the whole file can be memory-mapped and the
+    arrays used in place.
+
+    Usage Example:
+
+        # Write the bundle next to features.npy
+        IndexBundle.write('data/features/index.bundle', features, imageIDs, imageUrls, model='ViT-B/32')
+
+        # Load the bundle
+        bundle = IndexBundle.load('data/features/index.bundle')
+        bundle.features, bundle.imageIDs[0], bundle.imageUrls.find(url)
+    """
+
+    FILENAME = 'index.bundle'
+    MAGIC = b'SARICLIP'
+    VERSION = 1
+    ALIGNMENT = 64
+
+    def __init__(self, header, features, imageIDs, imageUrls):
+        """
+        Instantiate the bundle from its parts. Use IndexBundle.load to load a bundle.
+
+        params:
+            header: The header of the bundle.
+            features: The feature matrix, of shape (rows, dimensions).
+            imageIDs: A StringTable with the image ID of every row.
+            imageUrls: A StringTable with the IIIF URL of every row.
+        """
+        self.header = header
+        self.features = features
+        self.imageIDs = imageIDs
+        self.imageUrls = imageUrls
+
+    @property
+    def model(self):
+        return self.header['model']
+
+    @property
+    def rows(self):
+        return self.header['rows']
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a bundle by memory-mapping it. Only the header is read, the arrays are read from disk when they are used.
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise Exception(f"{path} is not an index bundle")
+            headerLength = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(headerLength))
+        if header['version'] > cls.VERSION:
+            raise Exception(f"{path} has version {header['version']}, this version of the software only reads bundles up to version {cls.VERSION}")
+
+        # Plain array views of the mapping are faster to slice than memmap objects
+        content = np.memmap(path, dtype=np.uint8, mode='r').view(np.ndarray)
+        dataStart = cls._align(len(cls.MAGIC) + 8 + headerLength)
+        arrays = {}
+        for name, section in header['sections'].items():
+            dtype = np.dtype(section['dtype'])
+            start = dataStart + section['offset']
+            size = int(np.prod(section['shape'])) * dtype.itemsize
+            arrays[name] = content[start:start + size].view(dtype).reshape(section['shape'])
+
+        return cls(
+            header,
+            arrays['features'],
+            StringTable(arrays['imageIdOffsets'], arrays['imageIdData'], arrays['imageIdOrder']),
+            StringTable(arrays['imageUrlOffsets'], arrays['imageUrlData'], arrays['imageUrlOrder'])
+        )
+
+    @classmethod
+    def write(cls, path, features, imageIDs, imageUrls, *, model, blockSize=65536):
+        """
+        Write a bundle. The file is written under a temporary name and renamed when it is complete,
+        so that a process loading the bundle never sees a partially written file.
+
+        params:
+            path: The path of the bundle.
+            features: The feature matrix, of shape (rows, dimensions). Can be memory-mapped, it is written in blocks.
+            imageIDs: The image ID of every row, as a StringTable or a sequence of strings.
+            imageUrls: The IIIF URL of every row, as a StringTable or a sequence of strings.
+            model: The name of the CLIP model that computed the features.
+            blockSize: The number of rows of the feature matrix written at once. Defaults to 65536.
+        """
+        if not isinstance(imageIDs, StringTable):
+            imageIDs = StringTable.fromStrings(imageIDs)
+        if not isinstance(imageUrls, StringTable):
+            imageUrls = StringTable.fromStrings(imageUrls)
+        if not len(imageIDs) == len(imageUrls) == features.shape[0]:
+            raise Exception(f"The bundle needs an image ID and URL for each of the {features.shape[0]} rows, got {len(imageIDs)} IDs and {len(imageUrls)} URLs")
+
+        arrays = {
+            'imageIdOffsets': imageIDs.offsets, 'imageIdData': imageIDs.data, 'imageIdOrder': imageIDs.order,
+            'imageUrlOffsets': imageUrls.offsets, 'imageUrlData': imageUrls.data, 'imageUrlOrder': imageUrls.order
+        }
+        shapes = {name: (array.dtype, array.shape) for name, array in arrays.items()}
+        shapes['features'] = (features.dtype, features.shape)
+
+        # The offsets of the arrays are relative to the start of the data, which follows the header
+        sections = {}
+        offset = 0
+        for name, (dtype, shape) in shapes.items():
+            sections[name] = {'dtype': dtype.str, 'shape': [int(size) for size in shape], 'offset': offset}
+            offset = cls._align(offset + int(np.prod(shape)) * dtype.itemsize)
+        header = {
+            'version': cls.VERSION,
+            'model': model,
+            'dimensions': int(features.shape[1]),
+            'rows': int(features.shape[0]),
+            'built': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'sections': sections
+        }
+        headerBytes = json.dumps(header).encode('utf-8')
+        dataStart = cls._align(len(cls.MAGIC) + 8 + len(headerBytes))
+
+        temporaryPath = f"{path}.tmp"
+        with open(temporaryPath, 'wb') as f:
+            f.write(cls.MAGIC)
+            f.write(len(headerBytes).to_bytes(8, 'little'))
+            f.write(headerBytes)
+            for name in shapes:
+                f.write(b'\0' * (dataStart + sections[name]['offset'] - f.tell()))
+                if name == 'features':
+                    for start in range(0, features.shape[0], blockSize):
+                        f.write(np.ascontiguousarray(features[start:start + blockSize]).tobytes())
+                else:
+                    f.write(np.ascontiguousarray(arrays[name]).tobytes())
+        os.replace(temporaryPath, path)
+
+    @classmethod
+    def _align(cls, offset):
+        return (offset + cls.ALIGNMENT - 1) // cls.ALIGNMENT * cls.ALIGNMENT
@@ -0,0 +1,203 @@
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+class _Flight:
+    """
+    A computation of a missing cache entry that other threads can wait for.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class LRUCache:
+    """
+    A thread-safe cache with least recently used eviction and single-flight computation of missing entries.
+
+    If several threads request the same missing key at the same time, only the first one computes
+    the value while the others wait for its result. Hits, misses, evictions and coalesced requests
+    are counted for monitoring.
+
+    By default every entry counts as 1 towards maxSize. With sizeOf, entries can have different sizes,
+    e.g. the number of bytes they use, and maxSize is the maximum total size. The most recently used
+    entry is always kept, even if it is larger than maxSize on its own. With ttl, entries expire that many
+    seconds after they have been stored.
+
+    Usage Example:
+
+        cache = LRUCache(1024)
+        value = cache.get(key, lambda: computeValue(key))
+    """
+
+    def __init__(self, maxSize, *, sizeOf=None, onEvict=None, ttl=None):
+        """
+        Instantiate the cache.
+
+        params:
+            maxSize: The maximum number of entries, or the maximum total size if sizeOf is given. With 0, no values are
+                     stored but concurrent identical requests are still coalesced. With None, the size is not limited.
+            sizeOf: A function returning the size of a value. Defaults to 1 for every value.
+            onEvict: A function called with the key and value of every evicted or expired entry, and of every value replaced by put.
+            ttl: The number of seconds after which an entry expires. If not set, entries do not expire.
+        """
+        self.maxSize = maxSize
+        self.sizeOf = sizeOf
+        self.onEvict = onEvict
+        self.ttl = ttl
+        self.totalSize = 0
+        self._sizes = {}
+        self._expires = {}
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, compute):
+        """
+        Return the cached value for key, computing and storing it with compute() if it is missing.
+        Exceptions raised by compute() are passed to all threads waiting for the key and nothing is stored.
+        """
+        with self._lock:
+            expired = self._expire(key)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        self._evicted(expired)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        evicted = []
+        try:
+            flight.value = compute()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None:
+                    evicted = self._store(key, flight.value)
+                del self._flights[key]
+            flight.done.set()
+            self._evicted(evicted)
+        return flight.value
+
+    def lookup(self, key):
+        """
+        Return the cached value for key, or None if it is missing. Counts as a hit or a miss.
+        """
+        with self._lock:
+            expired = self._expire(key)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        self._evicted(expired)
+        return None
+
+    def put(self, key, value):
+        """
+        Store a value that has been computed outside of get, e.g. as part of a batch.
+        """
+        with self._lock:
+            evicted = self._store(key, value)
+        self._evicted(evicted)
+
+    def _store(self, key, value):
+        # Must be called with the lock held, returns the evicted entries
+        if self.maxSize is not None and self.maxSize <= 0:
+            return []
+        evicted = []
+        if key in self._entries:
+            self.totalSize -= self._sizes[key]
+            if self._entries[key] is not value:
+                evicted.append((key, self._entries[key]))
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._sizes[key] = self.sizeOf(value) if self.sizeOf else 1
+        self.totalSize += self._sizes[key]
+        if self.ttl is not None:
+            self._expires[key] = time.monotonic() + self.ttl
+        while self.maxSize is not None and self.totalSize > self.maxSize and len(self._entries) > 1:
+            evicted.append(self._entries.popitem(last=False))
+            self.totalSize -= self._sizes.pop(evicted[-1][0])
+            self._expires.pop(evicted[-1][0], None)
+            self.evictions += 1
+        return evicted
+
+    def _expire(self, key):
+        # Must be called with the lock held, removes the entry for key if it has expired and returns it
+        if self.ttl is None or key not in self._entries or self._expires[key] > time.monotonic():
+            return []
+        self.totalSize -= self._sizes.pop(key)
+        del self._expires[key]
+        self.expirations += 1
+        return [(key, self._entries.pop(key))]
+
+    def _evicted(self, evicted):
+        # Called without the lock held, so that onEvict can use the cache
+        if self.onEvict:
+            for key, value in evicted:
+                self.onEvict(key, value)
+
+    def items(self):
+        """
+        Return a list of the cached keys and values, from the least to the most recently used. Does not count as hits.
+        """
+        with self._lock:
+            return list(self._entries.items())
+
+    def clear(self):
+        """
+        Remove all entries. Counters are not reset.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self.totalSize = 0
+
+    def stats(self):
+        """
+        Return the size and counters of the cache as a dictionary.
+        """
+        with self._lock:
+            stats = {
+                'size': len(self._entries),
+                'maxSize': self.maxSize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'coalesced': self.coalesced,
+                'hitRate': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0
+            }
+            if self.sizeOf:
+                stats['totalSize'] = self.totalSize
+            if self.ttl is not None:
+                stats['ttl'] = self.ttl
+                stats['expirations'] = self.expirations
+            return stats
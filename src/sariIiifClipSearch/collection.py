@@ -0,0 +1,219 @@
+import threading
+import time
+import numpy as np
+from types import SimpleNamespace
+from .iiifClipSearch import Query, indexVersion
+from .cache import LRUCache
+
+__all__ = ["Collections"]
+
+class Collections:
+    """
+    Serves several data directories, each processed by build.py, as named collections with a single CLIP model.
+
+    A collection is loaded with the first query that uses it. The first collection loads the CLIP model, all
+    others share it and only load their index. If a memory budget is set, the least recently used collections
+    are unloaded when the indexes held in memory exceed it, and loaded again when they are used next.
+
+    A collection can be reloaded while it is being queried, e.g. after build.py has added images. The new index is
+    loaded next to the current one and swapped in once it is complete. Queries that have already started finish
+    with the previous index. The version of the index files (Query.indexVersion) tells which index answered a query.
+
+    Usage Example:
+
+        collections = Collections({'paintings': 'data/paintings', 'photos': 'data/photos'}, default='paintings', mmap=True)
+        collections.get('photos').query('A mountain lake')
+        collections.query('A mountain lake', collections=['paintings', 'photos'])
+    """
+
+    def __init__(self, dataDirs, *, default=None, memoryBudget=None, onEvict=None, **queryOptions):
+        """
+        Instantiate the collections, without loading any of them.
+
+        params:
+            dataDirs: A dictionary from the name of each collection to its data directory.
+            default: The name of the collection used if no collection is given. Defaults to the first collection.
+            memoryBudget: The number of bytes the indexes of the loaded collections may use, as reported by
+                          Query.memoryUsage. Memory-mapped arrays and the model are not counted. The most recently
+                          used collection is always kept. If not set, collections are never unloaded.
+            onEvict: A function called with the name and the Query object of every unloaded or replaced collection.
+            queryOptions: The parameters passed to Query for every collection, e.g. mmap or nprobe.
+        """
+        if not dataDirs:
+            raise Exception("At least one collection is required")
+        if default is not None and default not in dataDirs:
+            raise Exception(f"Unknown default collection {default}, must be one of {', '.join(dataDirs)}")
+        self.dataDirs = dict(dataDirs)
+        self.default = default if default is not None else next(iter(self.dataDirs))
+        self.queryOptions = queryOptions
+        self.loads = 0
+        self.reloads = 0
+        self.reloadErrors = 0
+        self._reloading = set()
+        self._reloadLock = threading.Lock()
+        self._shared = None
+        self._modelLock = threading.Lock()
+        self._queries = LRUCache(memoryBudget, sizeOf=lambda query: query.memoryUsage(), onEvict=onEvict)
+
+    @property
+    def names(self):
+        return list(self.dataDirs)
+
+    def get(self, name=None):
+        """
+        Return the Query object of a collection, loading it if needed. Defaults to the default collection.
+        """
+        if name is None:
+            name = self.default
+        if name not in self.dataDirs:
+            raise KeyError(name)
+        return self._queries.get(name, lambda: self._load(name))
+
+    def _load(self, name):
+        print(f"Loading collection {name} from {self.dataDirs[name]}")
+        self.loads += 1
+        if self._shared is None:
+            with self._modelLock:
+                if self._shared is None:
+                    query = Query(dataDir=self.dataDirs[name], **self.queryOptions)
+                    # Keep only the model, so that the index of the first collection can be unloaded as well
+                    self._shared = SimpleNamespace(**{attribute: getattr(query, attribute) for attribute in Query.SHAREDATTRIBUTES})
+                    return query
+        return Query(dataDir=self.dataDirs[name], modelFrom=self._shared, **self.queryOptions)
+
+    def reload(self, name=None, *, wait=False):
+        """
+        Load the index of a collection again and swap it in once it is loaded. If loading fails, the current index
+        is kept. Returns False if the collection is already being reloaded.
+
+        params:
+            name: The name of the collection. Defaults to the default collection.
+            wait: Whether to wait for the reload to finish. By default, the index is loaded in a background thread.
+        """
+        if name is None:
+            name = self.default
+        if name not in self.dataDirs:
+            raise KeyError(name)
+        with self._reloadLock:
+            if name in self._reloading:
+                return False
+            self._reloading.add(name)
+        if wait:
+            self._reload(name)
+        else:
+            threading.Thread(target=self._reload, args=(name,), name=f'Reload {name}', daemon=True).start()
+        return True
+
+    def _reload(self, name):
+        try:
+            start = time.perf_counter()
+            try:
+                query = self._load(name)
+            except Exception as e:
+                self.reloadErrors += 1
+                print(f"Reloading collection {name} failed, keeping the current index: {e}")
+                return
+            # Replacing the entry passes the previous Query object to onEvict
+            self._queries.put(name, query)
+            self.reloads += 1
+            print(f"Reloaded collection {name} with index version {query.indexVersion} ({query.rows} images) in {time.perf_counter() - start:.2f}s")
+        finally:
+            with self._reloadLock:
+                self._reloading.discard(name)
+
+    def watch(self, interval=10):
+        """
+        Start a background thread that reloads the loaded collections whose index files have changed.
+        A change is only loaded once the files have not changed for interval seconds, so that an index
+        that is still being written is not loaded.
+
+        params:
+            interval: The number of seconds between two checks of the index files. Defaults to 10.
+        """
+        watcher = threading.Thread(target=self._watch, args=(interval,), name='Collections watcher', daemon=True)
+        watcher.start()
+        return watcher
+
+    def _watch(self, interval):
+        # The version seen at the previous check of every collection whose files have changed
+        changed = {}
+        while True:
+            time.sleep(interval)
+            for name, query in self._queries.items():
+                version = indexVersion(query.featuresDir, query.imageCSV)
+                if version == query.indexVersion:
+                    changed.pop(name, None)
+                elif changed.get(name) == version:
+                    del changed[name]
+                    self.reload(name, wait=True)
+                else:
+                    changed[name] = version
+
+    def stats(self):
+        """
+        Return the loaded collections and their memory usage for monitoring.
+        """
+        return {
+            'default': self.default,
+            'collections': self.names,
+            'loaded': {name: {'indexVersion': query.indexVersion, 'rows': query.rows, 'memoryUsage': query.memoryUsage(), 'startupTimes': query.startupTimes}
+                for name, query in self._queries.items()},
+            'loads': self.loads,
+            'reloads': self.reloads,
+            'reloadErrors': self.reloadErrors,
+            'cache': self._queries.stats()
+        }
+
+    def query(self, queryInput, *, collections=None, mode=Query.MODE_TEXT, numResults=5, minScore=0.2, nprobe=None):
+        """
+        Query several collections and merge their results. Every result has an additional key 'collection'.
+        params:
+            queryInput: The query, as for Query.query. In MODE_ID and MODE_URL, the stored features are taken from
+                        the first of the collections that indexes the image, which is excluded from its results in MODE_ID.
+            collections: The names of the collections to search. Defaults to all collections.
+            mode: MODE_TEXT, MODE_URL, MODE_IMAGE or MODE_ID. Default is MODE_TEXT.
+            numResults: The number of results to be returned, across all collections. Default is 5.
+            minScore: The minimum score. Default is 0.2.
+            nprobe: The number of lists of the approximate indexes to scan. Defaults to the nprobe of the collections.
+        """
+        return list(self.queryIter(queryInput, collections=collections, mode=mode, numResults=numResults, minScore=minScore, nprobe=nprobe))
+
+    def queryIter(self, queryInput, *, collections=None, mode=Query.MODE_TEXT, numResults=5, minScore=0.2, nprobe=None):
+        """
+        Query several collections like query(), but return a generator of the results. The search is run before
+        returning, the result dictionaries are built while they are consumed.
+        """
+        if collections is None:
+            collections = self.names
+        # Hold on to the Query objects, so that a collection unloaded during the query can still be searched
+        queries = [(name, self.get(name)) for name in collections]
+
+        # The query is encoded once, the model is shared by all collections
+        queryFeatures, source, row = None, None, None
+        for name, query in queries:
+            row = query._lookupRow(queryInput, mode)
+            if row is not None:
+                queryFeatures, source = np.asarray(query.imageFeatures[row]), name
+                break
+        if queryFeatures is None:
+            queryFeatures, row = queries[0][1]._queryFeatures(queryInput, mode)
+
+        indices, scores = [], []
+        for name, query in queries:
+            excludeRow = row if mode == Query.MODE_ID and name == source else None
+            collectionIndices, collectionScores = query._searchRows(queryFeatures, numResults, minScore, nprobe, excludeRow)
+            indices.append(np.asarray(collectionIndices))
+            scores.append(np.asarray(collectionScores))
+        owners = np.concatenate([np.full(len(collectionIndices), i) for i, collectionIndices in enumerate(indices)])
+        indices, scores = np.concatenate(indices), np.concatenate(scores)
+        # A stable sort keeps the order of the collections for equal scores
+        order = np.argsort(-scores, kind='stable')[:numResults]
+        return self._iterMerged(queries, owners[order], indices[order], scores[order])
+
+    @staticmethod
+    def _iterMerged(queries, owners, indices, scores):
+        for owner, row, score in zip(owners.tolist(), indices, scores):
+            name, query = queries[owner]
+            result = next(query._iterResults(np.array([row]), np.array([score])))
+            result['collection'] = name
+            yield result
@@ -0,0 +1,206 @@
+import csv
+import os
+import random
+import threading
+import time
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+__all__ = ["Downloader"]
+
+# Responses worth retrying: the server is overloaded, rate limits us or failed temporarily
+RETRYSTATUS = (408, 429, 500, 502, 503, 504)
+
+class _Host:
+    """
+    The limits and counters of a single image server.
+    """
+
+    def __init__(self, concurrency, rate):
+        self.slots = threading.Semaphore(concurrency)
+        self.interval = 1 / rate if rate else 0
+        self.nextRequest = 0.0
+        # Set from Retry-After headers, no request is sent to the host before
+        self.pausedUntil = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Reserve the next request slot of the host and wait for it
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.nextRequest, self.pausedUntil)
+            self.nextRequest = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+class Downloader:
+    """
+    Downloads images from IIIF image servers over persistent connections, without overloading the servers.
+
+    The number of concurrent requests and the number of requests per second are limited for every host, so that
+    many download threads do not get us rate limited by the image servers. Failed requests are retried with
+    exponential backoff and jitter, following Retry-After headers. The retries of a host are limited to a share of
+    its requests (retryBudget), so that a server that is down is not sent every request several times. Images are
+    written to a temporary file that is renamed once it is complete, so that an interrupted download never leaves
+    a partial image behind. The downloads that failed are listed in failures and can be written to a CSV file.
+
+    The downloader is thread-safe, a single downloader is shared by all download threads.
+
+    Usage Example:
+
+        downloader = Downloader(hostConcurrency=4, hostRate=10)
+        downloader.download('https://example.org/iiif/image1/full/640,/0/default.jpg', 'images/image1.jpg')
+        downloader.writeFailures('failures.csv')
+    """
+
+    def __init__(self, *, hostConcurrency=8, hostRate=None, retries=3, backoff=0.5, maxBackoff=30, retryBudget=0.2, timeout=(10, 60), poolSize=16):
+        """
+        Instantiate the downloader.
+
+        params:
+            hostConcurrency: The maximum number of concurrent requests to a host. Defaults to 8.
+            hostRate: The maximum number of requests per second to a host. Defaults to None, which does not limit the rate.
+            retries: The maximum number of retries of a request. Defaults to 3.
+            backoff: The base of the delay before a retry in seconds, doubled with every retry. Defaults to 0.5.
+            maxBackoff: The maximum delay before a retry in seconds. Defaults to 30.
+            retryBudget: The maximum number of retries of a host as a share of its requests, in addition to 10 retries
+                         that are always allowed. Defaults to 0.2.
+            timeout: The timeouts in seconds to connect and to receive data, as for requests. Defaults to (10, 60).
+            poolSize: The number of connections kept open per host. Should be at least the number of download threads. Defaults to 16.
+        """
+        self.hostConcurrency = hostConcurrency
+        self.hostRate = hostRate
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.retryBudget = retryBudget
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.failures = []
+        self.downloads = 0
+        self.bytes = 0
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = _Host(self.hostConcurrency, self.hostRate)
+            return self._hosts[host]
+
+    def download(self, url, path):
+        """
+        Download url to the file path. Returns True if the image has been downloaded, False if the download failed.
+        """
+        content = self._request(url, path)
+        return content is not None
+
+    def fetch(self, url):
+        """
+        Download url into memory. Returns the content, or None if the download failed.
+        """
+        return self._request(url, None)
+
+    def _request(self, url, path):
+        # Returns the content, or True if it has been written to path, or None if the download failed
+        host = self._host(url)
+        attempt = 0
+        while True:
+            status, error, retryAfter = None, None, None
+            with host.slots:
+                host.wait()
+                with host.lock:
+                    host.requests += 1
+                try:
+                    with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                        status = response.status_code
+                        if status == 200:
+                            return self._receive(response, path)
+                        error = f"HTTP {status}"
+                        retryAfter = self._retryAfter(response.headers.get('Retry-After'))
+                except (requests.RequestException, OSError) as e:
+                    error = f"{type(e).__name__}: {e}"
+
+            if status is not None and status not in RETRYSTATUS:
+                break
+            with host.lock:
+                # Retries of a host are limited to a share of its requests
+                allowed = attempt < self.retries and host.retries < 10 + self.retryBudget * host.requests
+                if allowed:
+                    host.retries += 1
+                    if retryAfter is not None:
+                        # All requests to the host wait, not only the retry
+                        host.pausedUntil = max(host.pausedUntil, time.monotonic() + min(retryAfter, self.maxBackoff))
+            if not allowed:
+                break
+            if retryAfter is None:
+                # Exponential backoff with full jitter, so that the retries of many threads do not arrive at the same time
+                time.sleep(random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt)))
+            attempt += 1
+
+        with self._lock:
+            self.failures.append({'url': url, 'status': status or '', 'error': error, 'attempts': attempt + 1})
+        return None
+
+    def _receive(self, response, path):
+        if path is None:
+            content = response.content
+        else:
+            temporaryPath = f"{path}.{threading.get_ident()}.tmp"
+            size = 0
+            try:
+                with open(temporaryPath, 'wb') as f:
+                    for chunk in response.iter_content(65536):
+                        f.write(chunk)
+                        size += len(chunk)
+                os.replace(temporaryPath, path)
+            finally:
+                if os.path.exists(temporaryPath):
+                    os.remove(temporaryPath)
+            content = True
+        with self._lock:
+            self.downloads += 1
+            self.bytes += len(content) if path is None else size
+        return content
+
+    @staticmethod
+    def _retryAfter(value):
+        # Retry-After is either a number of seconds or a date
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def writeFailures(self, path):
+        """
+        Write the failed downloads to a CSV file with the columns url, status, error and attempts.
+        """
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['url', 'status', 'error', 'attempts'])
+            writer.writeheader()
+            writer.writerows(self.failures)
+
+    def stats(self):
+        """
+        Return the number of downloads, bytes and failures, and the requests and retries of every host.
+        """
+        return {
+            'downloads': self.downloads,
+            'bytes': self.bytes,
+            'failures': len(self.failures),
+            'hosts': {host: {'requests': counters.requests, 'retries': counters.retries} for host, counters in self._hosts.items()}
+        }
@@ -0,0 +1,136 @@
+import json
+import math
+import re
+from urllib.parse import urlsplit
+from .cache import LRUCache
+
+__all__ = ["ImageServices"]
+
+class ImageServices:
+    """
+    Builds the URLs of IIIF image derivatives sized for the CLIP model, based on what every image server supports.
+
+    CLIP resizes the shortest edge of an image to its input resolution and crops the center, so a derivative only
+    needs a shortest edge of that size. The aspect ratio of an image is not known without requesting its info.json,
+    so the derivative is requested as the best fit into a square box (!w,h) of twice the input resolution: its
+    shortest edge is at least the input resolution for aspect ratios up to 2:1. Upscaling (^) is never requested.
+
+    The capabilities of a server, its IIIF version, compliance level, formats and maximum size, are read from the
+    info.json of the first image requested from it and kept for all further images of the server. !w,h is only
+    requested from servers of level 2 or that list sizeByConfinedWh. Other servers are asked for a width (w,) that
+    gives the first image the input resolution as its shortest edge, or for the fixed 640 pixels wide derivative if
+    the size of the first image is not known. Servers of compliance level 0 only serve the full image, and unknown
+    servers are assumed to be of level 1.
+
+    Usage Example:
+
+        services = ImageServices(downloader.fetch, size=224, formats=('webp', 'jpg'))
+        # On a level 2 server: 'https://example.org/iiif/image1/full/!448,448/0/default.webp'
+        services.url('https://example.org/iiif/image1')
+    """
+
+    def __init__(self, fetch, *, size=224, formats=('jpg',)):
+        """
+        Instantiate the image services.
+
+        params:
+            fetch: A function returning the content of a URL, or None if it cannot be fetched. Used to read info.json.
+            size: The input resolution of the model, the minimum shortest edge of the derivatives. Defaults to 224.
+            formats: The formats to request, in the order of preference. The first format supported by a server is
+                     requested. Defaults to ('jpg',), which every server supports.
+        """
+        self.fetch = fetch
+        self.size = size
+        self.formats = formats
+        self._services = LRUCache(None)
+
+    def url(self, iiifUrl):
+        """
+        Return the URL of the derivative of an image given by the URL of its image service.
+        """
+        iiifUrl = iiifUrl.rstrip('/')
+        host = urlsplit(iiifUrl).netloc
+        # Concurrent first requests to a server read its info.json only once
+        service = self._services.get(host, lambda: self._readService(iiifUrl))
+        box = 2 * self.size
+        if service['maxWidth']:
+            box = min(box, service['maxWidth'], service['maxHeight'] or service['maxWidth'])
+        if service['maxArea']:
+            box = min(box, math.isqrt(service['maxArea']))
+        if service['level'] == 0:
+            size = 'max' if service['version'] == 3 else 'full'
+        elif service['sizeByConfinedWh']:
+            size = f"!{box},{box}"
+        elif service['width'] and service['height']:
+            size = f"{self._width(service)},"
+        else:
+            size = '640,'
+        format = next((format for format in self.formats if format in service['formats']), 'jpg')
+        return f"{iiifUrl}/full/{size}/0/default.{format}"
+
+    def _width(self, service):
+        # Level 1 servers only scale by width, the aspect ratio of the first image is assumed for all images of the server
+        width, height = service['width'], service['height']
+        limits = [math.ceil(self.size * max(1, width / height)), width]
+        if service['maxWidth']:
+            limits.append(service['maxWidth'])
+        if service['maxArea']:
+            limits.append(math.isqrt(service['maxArea'] * width // height))
+        return max(1, min(limits))
+
+    def _readService(self, iiifUrl):
+        content = self.fetch(iiifUrl + '/info.json')
+        try:
+            info = json.loads(content) if content else None
+        except ValueError:
+            info = None
+        if not isinstance(info, dict):
+            print(f"Cannot read {iiifUrl}/info.json, assuming a IIIF level 1 image server")
+            info = {}
+        return self.parseService(info)
+
+    @staticmethod
+    def parseService(info):
+        """
+        Return the version, compliance level, formats, maximum size and whether !w,h is supported of an image server
+        from an info.json document, together with the size of the image it describes.
+        """
+        context = info.get('@context', '')
+        context = ' '.join(context) if isinstance(context, list) else context
+        version = 3 if 'image/3' in context else 2
+
+        # Version 2 gives the level as the URI of a profile, followed by descriptions of further features
+        profiles = info.get('profile', [])
+        profiles = profiles if isinstance(profiles, list) else [profiles]
+        level = 1
+        extraFormats = list(info.get('extraFormats', []))
+        features = set(info.get('extraFeatures', []))
+        limits = dict(info)
+        for profile in profiles:
+            if isinstance(profile, str):
+                match = re.search(r'level([012])', profile)
+                if match:
+                    level = int(match.group(1))
+            elif isinstance(profile, dict):
+                extraFormats += profile.get('formats', [])
+                features |= set(profile.get('supports', []))
+                limits.update(profile)
+
+        formats = {'jpg'} | ({'png'} if level == 2 else set()) | set(extraFormats)
+        return {
+            'version': version,
+            'level': level,
+            'formats': sorted(formats),
+            'maxWidth': limits.get('maxWidth'),
+            'maxHeight': limits.get('maxHeight'),
+            'maxArea': limits.get('maxArea'),
+            'sizeByConfinedWh': level == 2 or 'sizeByConfinedWh' in features,
+            'width': info.get('width'),
+            'height': info.get('height')
+        }
+
+    def stats(self):
+        """
+        Return the capabilities of every image server that has been requested.
+        """
+        return {host: service for host, service in self._services.items()}
@@ -3,10 +3,12 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'clip'))
 
 import csv
 import math
+import mmap
+import re
+import threading
+import time
 import numpy as np
-import pandas as pd
 import torch
-import urllib.request
 import requests
 from clip import clip
 from hashlib import blake2b
@@ -14,8 +16,24 @@ from pathlib import Path
 from PIL import Image
 from SPARQLWrapper import SPARQLWrapper, JSON
 from multiprocessing.pool import ThreadPool
+from .search import blockedTopK, blockedTopKBatch
+from .ann import IVFIndex
+from .quantization import QUANTIZERS
+from .cache import LRUCache
+from .bundle import IndexBundle, StringTable
+from .pipeline import FeaturePipeline
+from .download import Downloader
+from .iiif import ImageServices
 
 IDENTIFIERCOLUMN = 'localIdentifier'
+MODEL = 'ViT-B/32'
+# The input resolution of MODEL, known without loading it
+MODELRESOLUTION = 224
+IMAGEENCODERS = ('eager', 'lazy', 'none')
+MANIFESTFILE = 'manifest.csv'
+TOMBSTONESFILE = 'tombstones.npy'
+# The share of removed rows above which the features are rewritten without them instead of updated in place
+COMPACTIONRATIO = 0.2
 
 class Images:
     """
@@ -33,7 +51,15 @@ class Images:
         dataDir, 
         imageQuery=None, 
         threads=16,
-        batchSize=64):
+        batchSize=64,
+        quantization=None,
+        decodeProcesses=None,
+        hostConcurrency=8,
+        hostRate=None,
+        retries=3,
+        imageSize=None,
+        imageFormats=('jpg',),
+        storeImages=True):
 
         """
         Instantiate and initialise the class.
@@ -47,6 +73,15 @@ class Images:
             dataDir: The directory to save the images and features to.
             threads: The number of threads to use when downloading images. Defaults to 16.
             batchSize: The batch size of images to process on the GPU. Defaults to 16.
+            quantization: Additionally store the features in a compressed format, either 'int8' or 'pq'. Defaults to None.
+            decodeProcesses: The number of processes decoding and preprocessing images in downloadAndProcessImages. Defaults to half of the CPU cores.
+            hostConcurrency: The maximum number of concurrent downloads from an image server. Defaults to 8.
+            hostRate: The maximum number of requests per second to an image server. Defaults to None, which does not limit the rate.
+            retries: The maximum number of retries of a failed download. Defaults to 3.
+            imageSize: The minimum shortest edge of the downloaded images. Defaults to the input resolution of the CLIP model.
+            imageFormats: The image formats to download, in the order of preference, if the image server supports them. Defaults to ('jpg',).
+            storeImages: Store the downloaded images in the images subdirectory of dataDir. If False, downloadAndProcessImages decodes the
+                         images in memory and discards them once they are encoded, and downloadImages and processImages cannot be used. Defaults to True.
 
         Usage Example:
 
@@ -80,15 +115,30 @@ class Images:
                 raise Exception("imageQuery is required in SPARQL mode")
             if not endpoint:
                 raise Exception("endpoint is required in SPARQL mode")
+        if quantization and quantization not in QUANTIZERS:
+            raise Exception(f"Unknown quantization {quantization}, must be one of {', '.join(QUANTIZERS)}")
 
         self.mode = mode
         self.iiifColumn = iiifColumn
         self.threads = threads
         self.batchSize = batchSize
+        self.quantization = quantization
+        self.decodeProcesses = decodeProcesses
+        self.downloader = Downloader(hostConcurrency=hostConcurrency, hostRate=hostRate, retries=retries, poolSize=threads)
+        self.imageSize = imageSize
+        self.imageFormats = imageFormats
+        self.imageServices = None
+        self.storeImages = storeImages
+        # Whether the last merge has rewritten features.npy, and not only updated its changed rows
+        self.featuresRewritten = False
+        self._model = None
+        # The hashes of the content of the fetched images that have not been written to a batch yet
+        self._contentHashes = {}
 
+        self.dataDir = Path(dataDir)
         self.imageDir = Path(dataDir) / 'images'
         self.featuresDir = Path(dataDir) / 'features'
-        if not self.imageDir.exists():
+        if self.storeImages and not self.imageDir.exists():
             self.imageDir.mkdir(parents=True)
 
         if not self.featuresDir.exists():
@@ -108,19 +158,59 @@ class Images:
         h.update(inputString.encode())
         return h.hexdigest()
 
+    def _contentHash(self, image):
+        # The hash of the bytes of an image or of the file it has been downloaded to
+        h = blake2b(digest_size=16)
+        if isinstance(image, (bytes, bytearray)):
+            h.update(image)
+        else:
+            with open(image, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def _loadModel(self):
+        # The model is loaded once, it determines the size of the downloaded images and encodes them
+        if self._model is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model, preprocess = clip.load(MODEL, device=device)
+            self._model = (model, preprocess, device)
+        return self._model
+
+    def _getImageServices(self):
+        if self.imageServices is None:
+            size = self.imageSize or MODELRESOLUTION
+            print(f"Downloading images with a shortest edge of at least {size} pixels")
+            self.imageServices = ImageServices(self.downloader.fetch, size=size, formats=self.imageFormats)
+        return self.imageServices
+
     def _downloadImage(self, iiifUrl):
-        width = 640
-        url = iiifUrl + '/full/' + str(width) + ',/0/default.jpg'
         photoPath = self._getFilePathForImage(iiifUrl)
 
         # Only download a photo if it doesn't exist
         if not photoPath.exists():
-            try:
-                urllib.request.urlretrieve(url, photoPath)
-            except:
-                # Catch the exception if the download fails for some reason
+            # The file keeps the extension .jpg in other formats as well, images are opened by their content
+            url = self._getImageServices().url(iiifUrl)
+            if not self.downloader.download(url, photoPath):
                 print(f"Cannot download {url}")
-                pass
+
+    def _fetchImage(self, iiifUrl):
+        # Returns the path of the downloaded image, or its bytes if images are not stored, or None if it cannot be downloaded
+        photoPath = self._getFilePathForImage(iiifUrl)
+        if self.storeImages:
+            self._downloadImage(iiifUrl)
+            image = str(photoPath) if photoPath.exists() else None
+        elif photoPath.exists():
+            # Images downloaded by an earlier run that stored them are not downloaded again
+            image = str(photoPath)
+        else:
+            url = self._getImageServices().url(iiifUrl)
+            image = self.downloader.fetch(url)
+            if image is None:
+                print(f"Cannot download {url}")
+        if image is not None:
+            self._contentHashes[photoPath.stem] = self._contentHash(image)
+        return image
 
     def _getFilePathForImage(self, iiifUrl):
         photoId = self._customHash(iiifUrl)
@@ -147,19 +237,35 @@ class Images:
         Download the images from the CSV file.
         If SPARQL mode is used, the images need to be queried first and will then be automatically savedin a CSV file.
         """
+        if not self.storeImages:
+            raise Exception("downloadImages requires storeImages, use downloadAndProcessImages instead")
         urls = []
         with open(self.imageCSV, 'r') as f:
             reader = csv.DictReader(f)
             for row in reader:
                 urls.append(row[self.iiifColumn])
 
+        self.downloader.failures.clear()
+        self._getImageServices()
         pool = ThreadPool(self.threads)
         pool.map(self._downloadImage, urls)
+        self._writeDownloadFailures()
+
+    def _writeDownloadFailures(self):
+        # The failed downloads are listed in failures.csv, they are retried by the next run
+        self.downloader.writeFailures(self.dataDir / 'failures.csv')
+        if self.downloader.failures:
+            print(f"{len(self.downloader.failures)} images could not be downloaded, see {self.dataDir / 'failures.csv'}")
 
     def processImages(self):
         """
-        Compute the features of the images that have been downloaded.
+        Compute the features of the images that have been downloaded. Only images that are new or whose content has
+        changed since their features have been computed are encoded.
         """
+        if not self.storeImages:
+            raise Exception("processImages requires storeImages, use downloadAndProcessImages instead")
+
+        import pandas as pd
 
         def compute_clip_features(photos_batch):
             # Load all the photos from the files
@@ -176,45 +282,366 @@ class Images:
             # Transfer the feature vectors back to the CPU and convert to numpy
             return photos_features.cpu().numpy()
 
-        imageFiles = list(self.imageDir.glob('*.jpg'))
-        print(f"Found {len(imageFiles)} images")
+        # Images are identified by their ID, not by their position, so that adding or removing images does not affect others
+        processed = self._processedIdentifiers()
+        imageFiles, contentHashes = [], {}
+        for imageFile in sorted(self.imageDir.glob('*.jpg')):
+            photoID = imageFile.name.split(".")[0]
+            contentHash = self._contentHash(imageFile)
+            # Batches written before the content hashes were recorded have none, their images are considered unchanged
+            if processed.get(photoID) not in ('', contentHash):
+                imageFiles.append(imageFile)
+                contentHashes[photoID] = contentHash
+        print(f"Found {len(imageFiles)} new or changed images")
 
         # Load the open CLIP model
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model, preprocess = clip.load("ViT-B/32", device=device)
+        model, preprocess, device = self._loadModel()
         
         batches = math.ceil(len(imageFiles) / self.batchSize)
+        # New batches are numbered after the batches of earlier runs
+        firstBatch = self._nextBatch()
 
         for i in range(batches):
             print(f"Processing batch {i+1}/{batches}")
+            try:
+                # Get the batch of images
+                batchFiles = imageFiles[i*self.batchSize : (i+1)*self.batchSize]
+
+                # Compute the features for the batch and save them with the IDs of the images
+                photoIDs = [imageFile.name.split(".")[0] for imageFile in batchFiles]
+                self._writeBatch(firstBatch + i, photoIDs, compute_clip_features(batchFiles), [contentHashes[photoID] for photoID in photoIDs])
+            except:
+                # Catch the exception if the processing fails for some reason
+                print(f"Cannot process batch {i}")
+
+        self._mergeBatches()
+
+        return True
+
+    def downloadAndProcessImages(self):
+        """
+        Download the images and compute their features in a single pass, replacing downloadImages and processImages.
+        Downloading, decoding and encoding overlap (FeaturePipeline), so that the CPU is not idle while images are
+        downloaded and the network is not idle while they are encoded. Images whose features have been computed by
+        an earlier run are neither downloaded nor encoded again, so an interrupted run can be resumed. If storeImages
+        is False, the images are decoded from memory and never written to disk, and the features written after every
+        batch are the only checkpoint: a resumed run downloads only the images that have not been encoded yet.
+        If SPARQL mode is used, the images need to be queried first.
+        """
+        done = set(self._processedIdentifiers())
+        images = []
+        with open(self.imageCSV, 'r') as f:
+            for row in csv.DictReader(f):
+                identifier = self._customHash(row[self.iiifColumn])
+                if identifier not in done:
+                    done.add(identifier)
+                    images.append((identifier, row[self.iiifColumn]))
+        print(f"Found {len(images)} images to process")
+
+        # Load the open CLIP model
+        model, preprocess, device = self._loadModel()
+        self._getImageServices()
+
+        def encode(photos):
+            with torch.no_grad():
+                # Encode the photos batch to compute the feature vectors and normalize them
+                photosFeatures = model.encode_image(torch.from_numpy(photos).to(device))
+                photosFeatures /= photosFeatures.norm(dim=-1, keepdim=True)
+            return photosFeatures.cpu().numpy()
+
+        self.downloader.failures.clear()
+        pipeline = FeaturePipeline(fetch=self._fetchImage, preprocess=preprocess, encode=encode,
+            fetchThreads=self.threads, decodeProcesses=self.decodeProcesses, batchSize=self.batchSize)
+        # New batches are numbered after the batches of earlier runs
+        batch = self._nextBatch()
+        for identifiers, features in pipeline.run(images):
+            self._writeBatch(batch, identifiers, features, [self._contentHashes.pop(identifier, '') for identifier in identifiers])
+            batch += 1
+        print(pipeline.report())
+        self._writeDownloadFailures()
+
+        self._mergeBatches()
+
+        return True
+
+    def _batchFiles(self):
+        # The features of every batch, excluding features.npy
+        return sorted(self.featuresDir.glob('[0-9]' * 10 + '.npy'))
+
+    def _nextBatch(self):
+        # The number of the next batch, after the last batch of earlier runs
+        batchFiles = self._batchFiles()
+        return int(batchFiles[-1].stem) + 1 if batchFiles else 0
+
+    def _readBatchIds(self, featuresFile):
+        # The IDs and content hashes of the images of a batch, the hashes are empty for batches written without them
+        import pandas as pd
+
+        batchIds = pd.read_csv(featuresFile.with_suffix('.csv'), dtype=str, keep_default_na=False)
+        contentHashes = batchIds['content_hash'] if 'content_hash' in batchIds else [''] * len(batchIds)
+        return list(zip(batchIds['image_id'], contentHashes))
+
+    def _processedIdentifiers(self):
+        # The IDs of the images in the batches of earlier runs with the hash of the content their features were computed from
+        identifiers = {}
+        for featuresFile in self._batchFiles():
+            idsFile = featuresFile.with_suffix('.csv')
+            if idsFile.exists():
+                with open(idsFile, 'r') as f:
+                    for row in csv.DictReader(f):
+                        identifiers[row['image_id']] = row.get('content_hash') or ''
+        return identifiers
+
+    def _liveIdentifiers(self):
+        # The IDs of the images in the image CSV file
+        import pandas as pd
+
+        urls = pd.read_csv(self.imageCSV, usecols=[self.iiifColumn], dtype=str)[self.iiifColumn]
+        return set(map(self._customHash, urls))
+
+    def _writeBatch(self, i, photoIDs, batchFeatures, contentHashes=None):
+        import pandas as pd
+
+        # The IDs are written first, a batch only counts as processed once its features exist
+        columns = {"image_id": photoIDs}
+        if contentHashes is not None:
+            columns["content_hash"] = contentHashes
+        pd.DataFrame(columns).to_csv(self.featuresDir / f"{i:010d}.csv", index=False)
+        # The features are renamed when complete, an interrupted write does not leave a truncated batch behind
+        _saveArray(self.featuresDir / f"{i:010d}.npy", batchFeatures)
+
+    def _mergeBatches(self):
+        """
+        Merge the batches into features.npy and imageIds.csv, keeping the row of every image in manifest.csv.
+
+        Only the batches written since the last merge are merged: the features of new images are appended to
+        features.npy, those of changed images overwrite their row, and the rows of images that are no longer in the
+        image CSV file are zeroed and listed in tombstones.npy, which Query skips. Without a manifest, or once more
+        than COMPACTIONRATIO of the rows are removed, the files are rewritten from all batches without removed images.
+
+        The approximate nearest neighbour index and the quantized features are kept up to date with features.npy:
+        after an update only the changed rows are assigned to lists and encoded again, after a rewrite they are
+        computed again. The index bundle is removed by an update, as it could only be written again as a whole.
+        """
+        liveIdentifiers = self._liveIdentifiers()
+        manifest = self._readManifest()
+        self.featuresRewritten = manifest is None or not self._updateFeatures(manifest, liveIdentifiers)
+        if self.featuresRewritten:
+            self._rewriteFeatures(liveIdentifiers)
+
+    def _readManifest(self):
+        # The manifest of the last merge, or None if there is none or it does not match features.npy and imageIds.csv
+        import pandas as pd
+
+        manifestPath = self.featuresDir / MANIFESTFILE
+        featuresPath = self.featuresDir / 'features.npy'
+        idsPath = self.featuresDir / 'imageIds.csv'
+        if not (manifestPath.exists() and featuresPath.exists() and idsPath.exists()):
+            return None
+        manifest = pd.read_csv(manifestPath, dtype={'image_id': str, 'content_hash': str}, keep_default_na=False)
+        # An interrupted merge can leave more rows in features.npy or imageIds.csv than in the manifest
+        rows = np.load(featuresPath, mmap_mode='r').shape[0]
+        if not len(manifest) == rows == len(pd.read_csv(idsPath, dtype=str)):
+            print(f"Ignoring {manifestPath} as it does not match features.npy")
+            return None
+        return manifest.set_index('image_id')
+
+    def _writeManifest(self, manifest):
+        # Write the manifest and the removed rows, the files are renamed when complete
+        temporaryPath = self.featuresDir / (MANIFESTFILE + '.tmp')
+        manifest.reset_index().to_csv(temporaryPath, columns=['image_id', 'row', 'batch', 'content_hash', 'removed'], index=False)
+        os.replace(temporaryPath, self.featuresDir / MANIFESTFILE)
+
+        tombstonesPath = self.featuresDir / TOMBSTONESFILE
+        removedRows = np.sort(manifest['row'][manifest['removed']].to_numpy(dtype=np.int64))
+        if len(removedRows):
+            _saveArray(tombstonesPath, removedRows)
+        elif tombstonesPath.exists():
+            tombstonesPath.unlink()
+
+    def _updateFeatures(self, manifest, liveIdentifiers):
+        """
+        Merge the batches written since the last merge into features.npy and imageIds.csv in place.
+        Returns False if the features need to be rewritten instead.
+        """
+        import pandas as pd
+
+        # The features of the images of the new batches, later batches replace earlier ones
+        updates = {}
+        lastMerged = manifest['batch'].max()
+        for featuresFile in self._batchFiles():
+            batch = int(featuresFile.stem)
+            if batch <= lastMerged:
+                continue
+            batchFeatures = np.load(featuresFile)
+            for i, (identifier, contentHash) in enumerate(self._readBatchIds(featuresFile)):
+                if identifier in liveIdentifiers:
+                    updates[identifier] = (batch, contentHash, batchFeatures[i])
 
-            batchIdsPath = self.featuresDir / f"{i:010d}.csv"
-            batchFeaturesPath = self.featuresDir / f"{i:010d}.npy"
+        known = manifest.index.isin(liveIdentifiers)
+        removed = manifest.index[~known & ~manifest['removed']]
+        # Removed images that are in the image CSV file again get the features of the batch they were computed in back
+        restored = [identifier for identifier in manifest.index[known & manifest['removed']] if identifier not in updates]
+        for batch, identifiers in manifest.loc[restored].groupby('batch').groups.items():
+            batchFeatures = np.load(self.featuresDir / f"{batch:010d}.npy", mmap_mode='r')
+            rows = {identifier: i for i, (identifier, _) in enumerate(self._readBatchIds(self.featuresDir / f"{batch:010d}.npy"))}
+            for identifier in identifiers:
+                updates[identifier] = (batch, manifest.at[identifier, 'content_hash'], np.array(batchFeatures[rows[identifier]]))
 
-            # Only do the processing if the batch wasn't processed yet
-            if not batchFeaturesPath.exists():
-                try:
-                    # Get the batch of images
-                    batchFiles = imageFiles[i*self.batchSize : (i+1)*self.batchSize]
+        appended = [identifier for identifier in updates if identifier not in manifest.index]
+        removedRows = int((manifest['removed'] & ~manifest.index.isin(list(updates))).sum()) + len(removed)
+        if removedRows > COMPACTIONRATIO * (len(manifest) + len(appended)):
+            print(f"Rewriting the features without the {removedRows} removed images")
+            return False
+        if not updates and not len(removed):
+            print("The features are up to date")
+            self._updateIndexes([])
+            return True
 
-                    # Compute the features for the batch and save to a numpy file
-                    batchFeatures = compute_clip_features(batchFiles)
-                    np.save(batchFeaturesPath, batchFeatures)
+        # The bundle would still be loaded until it is older than features.npy
+        (self.featuresDir / IndexBundle.FILENAME).unlink(missing_ok=True)
+        featuresPath = self.featuresDir / 'features.npy'
+        if appended and not _appendRows(featuresPath, np.stack([updates[identifier][2] for identifier in appended])):
+            return False
+        with open(self.featuresDir / 'imageIds.csv', 'a', newline='') as f:
+            csv.writer(f).writerows([identifier] for identifier in appended)
 
-                    # Save the batch ID to a CSV file
-                    photoIDs = [imageFile.name.split(".")[0] for imageFile in batchFiles]
-                    photoIDsData = pd.DataFrame(photoIDs, columns=["image_id"])
-                    photoIDsData.to_csv(batchIdsPath, index=False)
-                except:
-                    # Catch the exception if the processing fails for some reason
-                    print(f"Cannot process batch {i}")
+        additions = pd.DataFrame({'row': np.arange(len(manifest), len(manifest) + len(appended)), 'batch': 0, 'content_hash': '', 'removed': False},
+            index=pd.Index(appended, name='image_id'))
+        manifest = pd.concat([manifest, additions])
+        identifiers = list(updates)
+        features = np.load(featuresPath, mmap_mode='r+')
+        if identifiers:
+            features[manifest.loc[identifiers, 'row'].to_numpy()] = np.stack([updates[identifier][2] for identifier in identifiers])
+            manifest.loc[identifiers, 'batch'] = [updates[identifier][0] for identifier in identifiers]
+            manifest.loc[identifiers, 'content_hash'] = [updates[identifier][1] for identifier in identifiers]
+            manifest.loc[identifiers, 'removed'] = False
+        # Removed images keep their row until the features are rewritten, a row of zeros matches no query
+        features[manifest.loc[removed, 'row'].to_numpy()] = 0
+        manifest.loc[removed, 'removed'] = True
+        features.flush()
+        del features
 
-        featuresList = [np.load(featuresFile) for featuresFile in sorted(self.featuresDir.glob("*.npy"))]
-        features = np.concatenate(featuresList)
-        np.save(self.featuresDir / "features.npy", features)
+        # The indexes are updated before the manifest, so that an interrupted merge updates them again
+        self._updateIndexes(manifest.loc[identifiers + list(removed), 'row'].to_numpy())
+        self._writeManifest(manifest)
+        print(f"Merged {len(appended)} new and {len(updates) - len(appended)} changed images, removed {len(removed)} images")
+        return True
+
+    def _rewriteFeatures(self, liveIdentifiers):
+        # Write features.npy and imageIds.csv from the last features of every image in the batches, without removed images
+        import pandas as pd
+
+        batchFiles = self._batchFiles()
+        latest = {}
+        for featuresFile in batchFiles:
+            for i, (identifier, _) in enumerate(self._readBatchIds(featuresFile)):
+                if identifier in liveIdentifiers:
+                    latest[identifier] = (int(featuresFile.stem), i)
+        if not latest:
+            raise Exception("There are no features of the images in the image CSV file")
+
+        # The features are copied batch by batch, so that they do not need to fit into memory
+        first = np.load(batchFiles[0], mmap_mode='r')
+        temporaryPath = self.featuresDir / 'features.npy.tmp'
+        features = np.lib.format.open_memmap(temporaryPath, mode='w+', dtype=first.dtype, shape=(len(latest), first.shape[1]))
+        entries = []
+        for featuresFile in batchFiles:
+            batch = int(featuresFile.stem)
+            selected = [(i, identifier, contentHash) for i, (identifier, contentHash) in enumerate(self._readBatchIds(featuresFile))
+                if latest.get(identifier) == (batch, i)]
+            if selected:
+                features[len(entries):len(entries) + len(selected)] = np.load(featuresFile)[[i for i, _, _ in selected]]
+                entries += [(identifier, len(entries) + j, batch, contentHash, False) for j, (_, identifier, contentHash) in enumerate(selected)]
+        features.flush()
+        del features
+        os.replace(temporaryPath, self.featuresDir / 'features.npy')
+
+        manifest = pd.DataFrame(entries, columns=['image_id', 'row', 'batch', 'content_hash', 'removed']).set_index('image_id')
+        manifest.reset_index()[['image_id']].to_csv(self.featuresDir / "imageIds.csv", index=False)
+        self._updateIndexes(None)
+        self._writeManifest(manifest)
+        print(f"Wrote the features of {len(manifest)} images")
+
+    def _updateIndexes(self, rows):
+        """
+        Bring the approximate nearest neighbour index and the quantized features that exist next to features.npy,
+        and those of the quantization of this object, up to date with features.npy.
+
+        params:
+            rows: The rows of features.npy that have changed, or None if it has been rewritten.
+        """
+        ivfPath = self.featuresDir / IVFIndex.FILENAME
+        quantizations = [name for name, quantizer in QUANTIZERS.items() if (self.featuresDir / quantizer.FILENAME).exists()]
+        if rows is None:
+            if ivfPath.exists():
+                self.buildIndex(lists=IVFIndex.load(ivfPath).lists)
+            for quantization in set(quantizations) | ({self.quantization} if self.quantization else set()):
+                self.quantizeFeatures(quantization)
+            return
+        if self.quantization and self.quantization not in quantizations:
+            self.quantizeFeatures(self.quantization)
+        if not len(rows):
+            return
+
+        features = np.load(self.featuresDir / 'features.npy', mmap_mode='r')
+        if ivfPath.exists():
+            index = IVFIndex.load(ivfPath)
+            try:
+                index.update(rows, features)
+                index.save(ivfPath)
+                print(f"Assigned {len(rows)} rows of the approximate nearest neighbour index again")
+            except Exception as e:
+                # An index of an earlier version of features.npy
+                print(f"Cannot update {ivfPath}, building it again: {e}")
+                self.buildIndex(lists=index.lists)
+        for quantization in quantizations:
+            path = self.featuresDir / QUANTIZERS[quantization].FILENAME
+            quantizer = QUANTIZERS[quantization].load(path)
+            try:
+                quantizer.update(rows, features)
+                quantizer.save(path)
+                print(f"Encoded {len(rows)} rows of the quantized features ({quantization}) again")
+            except Exception as e:
+                print(f"Cannot update {path}, computing it again: {e}")
+                self.quantizeFeatures(quantization)
+
+    def quantizeFeatures(self, quantization):
+        """
+        Compute a compressed representation of the features and store it next to features.npy.
+
+        Parameters:
+            quantization: The compression, either 'int8' (4 times smaller) or 'pq' (product quantization, 32 times smaller).
+        """
+        quantizer = QUANTIZERS[quantization]
+        features = np.load(self.featuresDir / "features.npy", mmap_mode='r')
+        print(f"Quantizing features of {features.shape[0]} images ({quantization})")
+        quantizer.train(features).save(self.featuresDir / quantizer.FILENAME)
+
+        return True
+
+    def buildIndex(self, lists=None):
+        """
+        Build an inverted file index (IVFIndex) for approximate nearest neighbour search over the computed features.
+        The index is stored next to features.npy and is used by Query if it is present.
+
+        Parameters:
+            lists: The number of lists of the index. Defaults to 4 * sqrt(number of images).
+        """
+        features = np.load(self.featuresDir / "features.npy", mmap_mode='r')
+        print(f"Building index for {features.shape[0]} images")
+        index = IVFIndex.train(features, lists=lists)
+        index.save(self.featuresDir / IVFIndex.FILENAME)
+        print(f"Saved index with {index.lists} lists")
+
+        return True
 
-        imageIDs = pd.concat([pd.read_csv(idsFile) for idsFile in sorted(self.featuresDir.glob("*.csv"))])
-        imageIDs.to_csv(self.featuresDir / "imageIds.csv", index=False)
+    def writeBundle(self):
+        """
+        Write the features, image IDs and IIIF URLs to an index bundle (IndexBundle), which Query loads instead of
+        features.npy, imageIds.csv and the image CSV file.
+        """
+        writeIndexBundle(self.featuresDir, imageCSV=self.imageCSV, iiifColumn=self.iiifColumn)
 
         return True
 
@@ -235,6 +662,114 @@ class Images:
         
         return True
         
+def _saveArray(path, array):
+    # Save an array to a .npy file under a temporary name and rename it when complete
+    temporaryPath = Path(f"{path}.tmp")
+    with open(temporaryPath, 'wb') as f:
+        np.save(f, array)
+    os.replace(temporaryPath, path)
+
+def _appendRows(path, rows):
+    """
+    Append rows to the matrix stored in a .npy file in place, by writing them to the end of the file and the new shape
+    to its header. Returns False if the file cannot be extended, because the header has no room for the new shape.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return False
+        dataStart = f.tell()
+        if fortranOrder or len(shape) != 2 or rows.shape[1] != shape[1]:
+            return False
+        # The header follows the magic string, the version and its length, and ends with a newline
+        headerStart = 8 + (2 if version == (1, 0) else 4)
+        header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (shape[0] + rows.shape[0], shape[1])})
+        if len(header) >= dataStart - headerStart:
+            return False
+        # The rows are written before the shape, an interrupted append leaves the file with its previous shape
+        f.seek(dataStart + shape[0] * shape[1] * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows, dtype=dtype).tobytes())
+        f.truncate()
+        f.flush()
+        f.seek(headerStart)
+        f.write((header.ljust(dataStart - headerStart - 1) + '\n').encode('latin1'))
+    return True
+
+def readRemovedRows(featuresDir):
+    """
+    Read the rows of features.npy whose images have been removed by an incremental build from tombstones.npy.
+    Returns a sorted array of row numbers, which is empty if no image has been removed.
+    """
+    tombstonesPath = Path(featuresDir) / TOMBSTONESFILE
+    if not tombstonesPath.exists():
+        return np.empty(0, dtype=np.int64)
+    return np.load(tombstonesPath)
+
+def readImageLookup(featuresDir, imageCSV, iiifColumn="iiif_url"):
+    """
+    Read the image ID of every row of features.npy from imageIds.csv and look up their IIIF URLs in the image CSV file.
+    Returns two lists of strings aligned with the rows of the feature matrix. Removed rows have an empty URL.
+    """
+    # pandas is only needed to read the CSV files, loading an index bundle does not import it
+    import pandas as pd
+
+    imageIDs = pd.read_csv(Path(featuresDir) / 'imageIds.csv', dtype=str)['image_id']
+    imageData = pd.read_csv(imageCSV, usecols=[IDENTIFIERCOLUMN, iiifColumn], dtype=str)
+
+    # Identifiers can occur several times in the CSV file, the first occurrence is used
+    imageData = imageData.drop_duplicates(subset=IDENTIFIERCOLUMN).set_index(IDENTIFIERCOLUMN)
+    imageUrls = imageData[iiifColumn].reindex(imageIDs)
+
+    # Removed images are no longer in the CSV file
+    removed = np.zeros(len(imageIDs), dtype=bool)
+    removed[readRemovedRows(featuresDir)] = True
+    imageUrls[removed] = ''
+
+    missing = imageIDs[imageUrls.isna().to_numpy()]
+    if len(missing) > 0:
+        raise Exception(f"{len(missing)} image IDs in imageIds.csv have no IIIF URL in {imageCSV}, e.g. {', '.join(missing[:5])}")
+
+    return imageIDs.tolist(), imageUrls.tolist()
+
+def writeIndexBundle(featuresDir, *, imageCSV, iiifColumn="iiif_url"):
+    """
+    Write the index bundle (IndexBundle) of a features directory containing features.npy and imageIds.csv.
+
+    Parameters:
+        featuresDir: The directory containing features.npy and imageIds.csv. The bundle is written to this directory.
+        imageCSV: The CSV file containing the IIIF URLs of the images.
+        iiifColumn: The column in the CSV file containing the IIIF URLs. Defaults to "iiif_url".
+    """
+    features = np.load(Path(featuresDir) / 'features.npy', mmap_mode='r')
+    imageIDs, imageUrls = readImageLookup(featuresDir, imageCSV, iiifColumn)
+    if len(imageIDs) != features.shape[0]:
+        raise Exception(f"imageIds.csv contains {len(imageIDs)} image IDs but features.npy contains {features.shape[0]} rows")
+    print(f"Writing index bundle of {features.shape[0]} images")
+    IndexBundle.write(Path(featuresDir) / IndexBundle.FILENAME, features, imageIDs, imageUrls, model=MODEL)
+
+def indexVersion(featuresDir, imageCSV):
+    """
+    Return a short identifier of the index files in a features directory, derived from the size and modification
+    time of every file a Query object reads. It changes whenever one of these files is written.
+
+    Parameters:
+        featuresDir: The directory containing the features.
+        imageCSV: The CSV file containing the IIIF URLs of the images.
+    """
+    featuresDir = Path(featuresDir)
+    files = [featuresDir / name for name in ('features.npy', 'imageIds.csv', TOMBSTONESFILE, IndexBundle.FILENAME, IVFIndex.FILENAME)]
+    files += [featuresDir / quantizer.FILENAME for quantizer in QUANTIZERS.values()] + [Path(imageCSV)]
+    version = blake2b(digest_size=6)
+    for path in files:
+        if path.exists():
+            stat = path.stat()
+            version.update(f"{path.name} {stat.st_size} {stat.st_mtime_ns}\n".encode('utf-8'))
+    return version.hexdigest()
+
 class Query:
     """
     This class can be used to query the previously processed image using CLIP
@@ -243,17 +778,37 @@ class Query:
     MODE_TEXT = 1
     MODE_URL = 2
     MODE_IMAGE = 3
+    MODE_ID = 4
+
+    # The attributes holding the CLIP model, which are shared by Query objects created with modelFrom
+    SHAREDATTRIBUTES = ('device', 'imageEncoder', 'imageEncoderLock', 'model', 'preprocess', 'textCache')
 
-    def __init__(self, *, dataDir, imageCSV=None, iiifColumn="iiif_url"):
+    def __init__(self, *, dataDir, imageCSV=None, iiifColumn="iiif_url", mmap=False, blockSize=None, nprobe=None, quantization=None, rerank=1000, textCacheSize=1024, imageEncoder="eager", modelFrom=None):
         """
         Initialize the query object.
         params:
             dataDir: The directory where the features and image IDs are stored.
             imageCSV: The CSV file containing the image IDs. Only needs to be used if CSV mode has been used to process the images
             iiifColumn: The column in the CSV file or the variable in the SPARQL query containing the IIIF URLs.
+            mmap: Whether to memory-map features.npy instead of loading it into memory. Defaults to False.
+            blockSize: The number of feature rows to scan at once when searching. If not set, all rows are scanned at once.
+            nprobe: The default number of lists to scan if an approximate nearest neighbour index (ivf.npz) is present.
+                    If not set, queries use exact search unless nprobe is passed to query().
+            quantization: Search the compressed features computed by Images.quantizeFeatures, either 'int8' or 'pq',
+                          and re-rank a shortlist with the full precision features. Best combined with mmap=True. Defaults to None.
+            rerank: The number of results re-ranked with the full precision features when quantization is used. Defaults to 1000.
+            textCacheSize: The number of text query embeddings kept in memory. Defaults to 1024.
+            imageEncoder: When to load the image encoder of the CLIP model, which is only needed for queries by image
+                          or by the URL of an image that has not been indexed. 'eager' loads it at start up, 'lazy' with
+                          the first query that needs it and 'none' never, such queries then raise an exception. Defaults to 'eager'.
+            modelFrom: Another Query object, whose CLIP model, text cache and image encoder setting are used instead of
+                       loading the model again, so that several data directories can be served with one model.
+                       textCacheSize and imageEncoder are then ignored.
         """
         if not dataDir:
             raise Exception("dataDir is required")
+        if imageEncoder not in IMAGEENCODERS:
+            raise Exception(f"Unknown imageEncoder {imageEncoder}, must be one of {', '.join(IMAGEENCODERS)}")
 
         self.iiifColumn = iiifColumn
         self.imageDir = Path(dataDir) / 'images'
@@ -263,66 +818,462 @@ class Query:
         else:
             self.imageCSV = Path(imageCSV)
 
-        self.imageFeatures = np.load(self.featuresDir / 'features.npy')
-        self.imageIDs = pd.read_csv(self.featuresDir / 'imageIds.csv')
-        self.imageData = pd.read_csv(self.imageCSV)
+        self.startupTimes = {}
+        start = time.perf_counter()
+        # Taken before loading, so that files written while loading lead to a different version
+        self.indexVersion = indexVersion(self.featuresDir, self.imageCSV)
 
-        # Load the open CLIP model
+        self.blockSize = blockSize
+        self.bundle = self._loadBundle()
+        if self.bundle:
+            self.imageFeatures = self.bundle.features if mmap else np.array(self.bundle.features)
+            self.imageIDs, self.imageUrls = self.bundle.imageIDs, self.bundle.imageUrls
+            start = self._startupPhase('bundle', start)
+        else:
+            self.imageFeatures = np.load(self.featuresDir / 'features.npy', mmap_mode='r' if mmap else None)
+            start = self._startupPhase('features', start)
+            self.imageIDs, self.imageUrls = self._loadImageLookup()
+            start = self._startupPhase('imageLookup', start)
+        self.removedRows = self._loadRemovedRows()
+        self.removedCount = 0 if self.removedRows is None else int(self.removedRows.sum())
+
+        self.nprobe = nprobe
+        self.ivfIndex = None
+        ivfPath = self.featuresDir / IVFIndex.FILENAME
+        if ivfPath.exists():
+            self.ivfIndex = IVFIndex.load(ivfPath)
+            if self.ivfIndex.listRows.shape[0] != self.imageFeatures.shape[0]:
+                print(f"Ignoring {ivfPath} as it does not match features.npy, rebuild it to use approximate search")
+                self.ivfIndex = None
+
+        self.rerank = rerank
+        self.quantizer = None
+        if quantization:
+            if quantization not in QUANTIZERS:
+                raise Exception(f"Unknown quantization {quantization}, must be one of {', '.join(QUANTIZERS)}")
+            quantizerPath = self.featuresDir / QUANTIZERS[quantization].FILENAME
+            if not quantizerPath.exists():
+                raise Exception(f"{quantizerPath} not found, compute it with Images.quantizeFeatures")
+            self.quantizer = QUANTIZERS[quantization].load(quantizerPath)
+            if self.quantizer.rows != self.imageFeatures.shape[0]:
+                raise Exception(f"{quantizerPath} does not match features.npy, compute it again with Images.quantizeFeatures")
+        start = self._startupPhase('index', start)
+
+        if modelFrom is not None:
+            for attribute in self.SHAREDATTRIBUTES:
+                setattr(self, attribute, getattr(modelFrom, attribute))
+            return
+
+        self.textCache = LRUCache(textCacheSize)
+
+        # Load the open CLIP model, without the image encoder unless it is loaded eagerly
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model, self.preprocess = clip.load("ViT-B/32", device=self.device)
+        self.imageEncoder = imageEncoder
+        self.imageEncoderLock = threading.Lock()
+        # Download the model or verify the checksum of the downloaded file
+        clip.download(MODEL)
+        start = self._startupPhase('modelVerification', start)
+        self.model, self.preprocess = clip.load(MODEL, device=self.device, visual=imageEncoder == "eager")
+        self._startupPhase('model', start)
+
+    def _startupPhase(self, phase, start):
+        """
+        Record and print the time taken by a phase of the start up that began at start.
+        Returns the time the phase ended, which is the start of the next phase.
+        """
+        end = time.perf_counter()
+        self.startupTimes[phase] = round(end - start, 3)
+        print(f"Start up phase {phase} took {end - start:.2f}s")
+        return end
+
+    def warmUp(self):
+        """
+        Run the encoders once, so that the first query does not pay for the lazy initialisation done by torch
+        on the first forward pass. The image encoder is only run if it has been loaded.
+        """
+        start = time.perf_counter()
+        self._encodeTexts(["warm up"])
+        if self.model.visual is not None:
+            self._encodeImages([Image.new('RGB', (self.model.image_resolution, self.model.image_resolution))])
+        self._startupPhase('warmUp', start)
+
+    @property
+    def rows(self):
+        return self.imageFeatures.shape[0]
+
+    def memoryUsage(self):
+        """
+        Return the number of bytes of the index held in memory, that is the features, image lookup and
+        approximate index arrays, excluding memory-mapped arrays and the CLIP model.
+        """
+        arrays = [self.imageFeatures]
+        if self.removedRows is not None:
+            arrays.append(self.removedRows)
+        for table in (self.imageIDs, self.imageUrls):
+            arrays += [table.offsets, table.data, table.order]
+        if self.ivfIndex is not None:
+            arrays += [self.ivfIndex.centroids, self.ivfIndex.listOffsets, self.ivfIndex.listRows]
+        if self.quantizer is not None:
+            arrays += list(self.quantizer._arrays().values())
+        return sum(array.nbytes for array in arrays if not self._isMapped(array))
+
+    @staticmethod
+    def _isMapped(array):
+        # Arrays of a mapping are views whose chain of bases ends with the memmap or the mmap object
+        while array is not None:
+            if isinstance(array, (np.memmap, mmap.mmap)):
+                return True
+            array = getattr(array, 'base', None)
+        return False
+
+    def _loadBundle(self):
+        """
+        Load the index bundle written by build.py or convertIndex.py, if there is one that is not older than features.npy.
+        """
+        bundlePath = self.featuresDir / IndexBundle.FILENAME
+        if not bundlePath.exists():
+            return None
+        featuresPath = self.featuresDir / 'features.npy'
+        if featuresPath.exists() and featuresPath.stat().st_mtime > bundlePath.stat().st_mtime:
+            print(f"Ignoring {bundlePath} as it is older than features.npy, convert it again with convertIndex.py to use it")
+            return None
+        bundle = IndexBundle.load(bundlePath)
+        if bundle.model != MODEL:
+            raise Exception(f"{bundlePath} contains features of the model {bundle.model}, but {MODEL} is used")
+        return bundle
+
+    def _loadRemovedRows(self):
+        """
+        Load the rows of images removed by an incremental build, which are skipped by queries.
+        Returns a boolean mask of the removed rows, or None if no image has been removed.
+        """
+        rows = readRemovedRows(self.featuresDir)
+        if len(rows) == 0:
+            return None
+        if rows[-1] >= self.rows:
+            raise Exception(f"{self.featuresDir / TOMBSTONESFILE} does not match features.npy")
+        removedRows = np.zeros(self.rows, dtype=bool)
+        removedRows[rows] = True
+        return removedRows
+
+    def _loadImageLookup(self):
+        """
+        Build the lookup from a row in features.npy to the image ID and IIIF URL of the image.
+        Returns two StringTables aligned with the rows of the feature matrix.
+        """
+        imageIDs, imageUrls = readImageLookup(self.featuresDir, self.imageCSV, self.iiifColumn)
+        if len(imageIDs) != self.imageFeatures.shape[0]:
+            raise Exception(f"imageIds.csv contains {len(imageIDs)} image IDs but features.npy contains {self.imageFeatures.shape[0]} rows")
+        return StringTable.fromStrings(imageIDs), StringTable.fromStrings(imageUrls)
+
+    def _buildResults(self, indices, scores):
+        """
+        Assemble the result dictionaries for the given rows of the feature matrix.
+        """
+        return list(self._iterResults(indices, scores))
+
+    def _iterResults(self, indices, scores):
+        """
+        Generate the result dictionaries for the given rows of the feature matrix one by one.
+        """
+        for score, row in zip(scores.tolist(), indices.tolist()):
+            yield {
+                'score': score,
+                'imageId': self.imageIDs[row],
+                'url': self.imageUrls[row]
+            }
+
+    @staticmethod
+    def _textCacheKey(queryString):
+        # The tokenizer ignores case and repeated whitespace, so these variants share the same embedding
+        return ' '.join(queryString.split()).lower()
+
+    def _encodeTexts(self, queryStrings):
+        """
+        Encode and normalize a list of query strings using CLIP in a single forward pass.
+        Returns an array of shape (len(queryStrings), dimensions).
+        """
+        with torch.no_grad():
+            textEncoded = self.model.encode_text(clip.tokenize(queryStrings).to(self.device))
+            textEncoded /= textEncoded.norm(dim=-1, keepdim=True)
+        return textEncoded.cpu().numpy()
+
+    def _encodeText(self, queryString):
+        """
+        Encode and normalize a query string using CLIP. The embedding is cached, keyed on the normalized query string.
+        """
+        def encode():
+            textFeatures = self._encodeTexts([queryString])
+            # The cached array is shared between requests
+            textFeatures.flags.writeable = False
+            return textFeatures
+
+        return self.textCache.get(self._textCacheKey(queryString), encode)
+
+    def _encodeCachedTexts(self, queryStrings):
+        """
+        Encode a list of query strings, taking cached embeddings from the cache and encoding all others in one batch.
+        Returns an array of shape (len(queryStrings), dimensions).
+        """
+        keys = [self._textCacheKey(queryString) for queryString in queryStrings]
+        embeddings = {}
+        for key in set(keys):
+            cached = self.textCache.lookup(key)
+            if cached is not None:
+                embeddings[key] = cached[0]
+        missing = {key: queryString for key, queryString in zip(keys, queryStrings) if key not in embeddings}
+        if missing:
+            for key, textFeatures in zip(missing, self._encodeTexts(list(missing.values()))):
+                textFeatures = textFeatures[None, :]
+                textFeatures.flags.writeable = False
+                self.textCache.put(key, textFeatures)
+                embeddings[key] = textFeatures[0]
+        return np.stack([embeddings[key] for key in keys])
+
+    def _lookupRow(self, queryInput, mode):
+        """
+        Return the row of the feature matrix for a MODE_ID query, or for a MODE_URL query whose URL is
+        an indexed IIIF image (either its base URI, info.json or an image request). Returns None otherwise.
+        """
+        row = self._findRow(queryInput, mode)
+        if row is not None and self.removedRows is not None and self.removedRows[row]:
+            return None
+        return row
+
+    def _findRow(self, queryInput, mode):
+        if mode == self.MODE_ID:
+            row = self.imageIDs.find(queryInput)
+            if row is not None:
+                return row
+            # The IIIF URL of an indexed image can be used as well
+            mode = self.MODE_URL
+        if mode == self.MODE_URL and isinstance(queryInput, str):
+            url = queryInput.rstrip('/')
+            row = self._findUrl(url)
+            if row is not None:
+                return row
+            # info.json is removed on its own, as the image request pattern would also match the end of
+            # an identifier followed by info.json if the identifier is a number
+            base = re.sub(r'/info\.json$', '', url)
+            if base == url:
+                # Only requests of the whole image in its colours show what the stored features have been computed from,
+                # crops, rotations and other qualities are encoded
+                base = re.sub(r'/(full|square)/[^/]+/0/(default|color)\.[a-z0-9]+$', '', url)
+                if base == url:
+                    return None
+            return self._findUrl(base)
+        return None
+
+    def _findUrl(self, url):
+        # The indexed URL may end with a slash
+        row = self.imageUrls.find(url)
+        return row if row is not None else self.imageUrls.find(url + '/')
+
+    def hasImage(self, imageId):
+        """
+        Return whether an image, given by its ID or IIIF URL, is indexed and can be used in MODE_ID.
+        """
+        return self._lookupRow(imageId, self.MODE_ID) is not None
 
-    def query(self, queryInput, *, mode=MODE_TEXT, numResults=5, minScore=0.2):
+    def _loadImage(self, queryInput, mode):
+        """
+        Return the query image of a MODE_URL or MODE_IMAGE query as a PIL image.
+        """
+        if mode == self.MODE_URL:
+            # Load the image from the URL into a PIL image
+            return Image.open(requests.get(queryInput, stream=True).raw)
+        # Image is passed as PIL image in queryInput
+        return queryInput
+
+    def canQuery(self, queryInput, mode):
+        """
+        Return whether a query can be answered, which is not the case for queries that need the image encoder
+        if it is disabled. Queries by the URL of an indexed image use the stored features and are always supported.
+        """
+        if self.imageEncoder != "none" or mode in (self.MODE_TEXT, self.MODE_ID):
+            return True
+        return mode == self.MODE_URL and self._lookupRow(queryInput, mode) is not None
+
+    def _loadImageEncoder(self):
+        """
+        Load the image encoder of the CLIP model if it has not been loaded yet.
+        """
+        if self.model.visual is not None:
+            return
+        if self.imageEncoder == "none":
+            raise Exception("Queries by image are not supported as the image encoder is disabled")
+        with self.imageEncoderLock:
+            if self.model.visual is None:
+                print("Loading the CLIP image encoder")
+                clip.load_visual(self.model, MODEL)
+
+    def _encodeImages(self, images):
+        """
+        Encode and normalize a list of PIL images using CLIP in a single forward pass.
+        Returns an array of shape (len(images), dimensions).
+        """
+        self._loadImageEncoder()
+        imagesPreprocessed = torch.stack([self.preprocess(image) for image in images]).to(self.device)
+
+        with torch.no_grad():
+            # Encode the photos batch to compute the feature vectors and normalize them
+            photoFeatures = self.model.encode_image(imagesPreprocessed)
+            photoFeatures /= photoFeatures.norm(dim=-1, keepdim=True)
+
+        return photoFeatures.cpu().numpy()
+
+    def stats(self):
+        """
+        Return counters of the query object for monitoring.
+        """
+        return {
+            'indexVersion': self.indexVersion,
+            'rows': self.rows,
+            'removedRows': self.removedCount,
+            'startupTimes': self.startupTimes,
+            'textCache': self.textCache.stats()
+        }
+
+    def _searchK(self, numResults, minScore):
+        """
+        Return the number of rows to select for numResults results. The features of removed rows are zero, so they
+        score 0 and more rows are only selected if minScore does not exclude them.
+        """
+        if self.removedRows is not None and (minScore is None or minScore <= 0):
+            return numResults + self.removedCount
+        return numResults
+
+    def _dropRemoved(self, indices, scores, numResults):
+        if self.removedRows is None:
+            return indices, scores
+        keep = ~self.removedRows[indices]
+        return indices[keep][:numResults], scores[keep][:numResults]
+
+    def _search(self, queryFeatures, numResults, minScore, nprobe):
+        """
+        Select the best rows of the feature matrix for the query vector, using the approximate index if requested.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        k = self._searchK(numResults, minScore)
+        if nprobe and self.ivfIndex is not None:
+            results = self.ivfIndex.search(queryFeatures, self.imageFeatures, k, nprobe=nprobe, minScore=minScore)
+        elif self.quantizer is not None:
+            results = self.quantizer.search(queryFeatures, self.imageFeatures, k, minScore=minScore, rerank=self.rerank)
+        else:
+            results = blockedTopK(queryFeatures, self.imageFeatures, k, minScore=minScore, blockSize=self.blockSize)
+        return self._dropRemoved(*results, numResults)
+
+    def _searchBatch(self, queryFeatures, ks, minScores, nprobe):
+        """
+        Select the best rows of the feature matrix for several query vectors.
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        if (nprobe and self.ivfIndex is not None) or self.quantizer is not None:
+            # The approximate searches scan different rows for every query
+            return [self._search(features, k, minScore, nprobe) for features, k, minScore in zip(queryFeatures, ks, minScores)]
+        results = blockedTopKBatch(queryFeatures, self.imageFeatures, [self._searchK(k, minScore) for k, minScore in zip(ks, minScores)], minScores=minScores, blockSize=self.blockSize)
+        return [self._dropRemoved(indices, scores, k) for (indices, scores), k in zip(results, ks)]
+
+    def _queryFeatures(self, queryInput, mode):
+        """
+        Return the query vector and the row of the query image if it is indexed, or None.
+        """
+        row = self._lookupRow(queryInput, mode)
+        if mode == self.MODE_ID and row is None:
+            raise Exception(f"Image {queryInput} is not indexed")
+
+        if row is not None:
+            # Indexed images are searched with their stored features instead of encoding them again
+            return np.asarray(self.imageFeatures[row]), row
+        if mode == self.MODE_TEXT:
+            return self._encodeText(queryInput), row
+        if mode == self.MODE_URL or mode == self.MODE_IMAGE:
+            return self._encodeImages([self._loadImage(queryInput, mode)]), row
+        raise Exception("Unknown query mode")
+
+    def _searchRows(self, queryFeatures, numResults, minScore, nprobe, excludeRow=None):
+        """
+        Search with a query vector and return the best rows and their scores, excluding excludeRow if it is not None.
+        """
+        if excludeRow is not None:
+            indices, scores = self._search(queryFeatures, numResults + 1, minScore, nprobe)
+            return self._excludeRow(indices, scores, excludeRow, numResults)
+
+        # Compute the Cosine similarity between the query and each photo and select the best images
+        return self._search(queryFeatures, numResults, minScore, nprobe)
+
+    def query(self, queryInput, *, mode=MODE_TEXT, numResults=5, minScore=0.2, nprobe=None):
         """
         Query the images using the query string.
         params:
-            queryInput: The query string to be used for the query.
+            queryInput: The query string to be used for the query. In MODE_URL the URL of an image, in MODE_IMAGE a PIL image
+                        and in MODE_ID the ID or IIIF URL of an indexed image, whose stored features are used.
+            mode: MODE_TEXT, MODE_URL, MODE_IMAGE or MODE_ID. Default is MODE_TEXT.
+                  In MODE_ID, the query image itself is excluded from the results.
             numResults: The number of results to be returned. Default is 5.
+            nprobe: The number of lists of the approximate index to scan. 0 forces an exact search. Defaults to the nprobe of the Query object.
         """
-        if mode == self.MODE_TEXT:
-            with torch.no_grad():
-                # Encode and normalize the description using CLIP
-                textEncoded = self.model.encode_text(clip.tokenize(queryInput).to(self.device))
-                textEncoded /= textEncoded.norm(dim=-1, keepdim=True)
+        return list(self.queryIter(queryInput, mode=mode, numResults=numResults, minScore=minScore, nprobe=nprobe))
+
+    def queryIter(self, queryInput, *, mode=MODE_TEXT, numResults=5, minScore=0.2, nprobe=None):
+        """
+        Run a query like query(), but return a generator of the results. The search is run before returning,
+        the result dictionaries are built while they are consumed, e.g. to stream them to a client.
+        """
+        queryFeatures, row = self._queryFeatures(queryInput, mode)
+        # In MODE_ID, the query image itself is excluded from the results
+        return self._iterResults(*self._searchRows(queryFeatures, numResults, minScore, nprobe, row if mode == self.MODE_ID else None))
 
-            # Retrieve the description vector and the photo vectors
-            textFeatures = textEncoded.cpu().numpy()
+    @staticmethod
+    def _excludeRow(indices, scores, row, numResults):
+        keep = indices != row
+        return indices[keep][:numResults], scores[keep][:numResults]
 
-            # Compute the similarity between the descrption and each photo using the Cosine similarity
-            similarities = list((textFeatures @ self.imageFeatures.T).squeeze(0))
-        elif mode == self.MODE_URL or mode == self.MODE_IMAGE:
-            if mode == self.MODE_URL:
-                # Load the image from the URL into a PIL image
-                images = [Image.open(requests.get(queryInput, stream=True).raw)]
-            elif mode == self.MODE_IMAGE:
-                # Image is passed as PIL image in queryInput
-                images = [queryInput]
+    def queryBatch(self, queries, *, numResults=5, minScore=0.2, nprobe=None):
+        """
+        Run several queries at once. All text queries are encoded in one forward pass, all image
+        queries in another one, and the similarities of all queries are computed together.
+        params:
+            queries: A list of queries. Every query is a dictionary with the keys 'input' and optionally
+                     'mode' (defaults to MODE_TEXT), 'numResults' and 'minScore', as for query().
+            numResults: The number of results to be returned for queries without numResults. Default is 5.
+            minScore: The minimum score for queries without minScore. Default is 0.2.
+            nprobe: The number of lists of the approximate index to scan. Defaults to the nprobe of the Query object.
+        returns:
+            A list with the results of every query, in the order of the queries.
+        """
+        if not queries:
+            return []
+        queryFeatures = [None] * len(queries)
 
-            imagesPreprocessed = torch.stack([self.preprocess(image) for image in images]).to(self.device)
+        # Indexed images use their stored features
+        rows = [self._lookupRow(query['input'], query.get('mode', self.MODE_TEXT)) for query in queries]
+        for i, (query, row) in enumerate(zip(queries, rows)):
+            if row is not None:
+                queryFeatures[i] = np.asarray(self.imageFeatures[row])
+            elif query.get('mode') == self.MODE_ID:
+                raise Exception(f"Image {query['input']} is not indexed")
 
-            with torch.no_grad():
-                # Encode the photos batch to compute the feature vectors and normalize them
-                photoFeatures = self.model.encode_image(imagesPreprocessed)
-                photoFeatures /= photoFeatures.norm(dim=-1, keepdim=True)
-            
-            photoFeatures = photoFeatures.cpu().numpy()
-
-            similarities = list((photoFeatures @ self.imageFeatures.T).squeeze(0))
-
-        # Sort the images by their similarity score
-        bestImages = sorted(zip(similarities, range(self.imageFeatures.shape[0])), key=lambda x: x[0], reverse=True)
-
-        # Get the top images
-        results = []
-        for image in bestImages[:numResults]:
-            score = float(image[0])
-            if score < minScore:
-                break
-            imageId = self.imageIDs.iloc[image[1]]['image_id']
-            imageUrl = self.imageData.loc[self.imageData[IDENTIFIERCOLUMN] == imageId][self.iiifColumn].values[0]
-            result = {
-                'score': score,
-                'imageId': str(imageId),
-                'url': str(imageUrl)
-            }
-            results.append(result)
-        return results
+        textQueries = [i for i, query in enumerate(queries) if query.get('mode', self.MODE_TEXT) == self.MODE_TEXT]
+        if textQueries:
+            textFeatures = self._encodeCachedTexts([queries[i]['input'] for i in textQueries])
+            for i, features in zip(textQueries, textFeatures):
+                queryFeatures[i] = features
+
+        imageQueries = [i for i, query in enumerate(queries) if query.get('mode', self.MODE_TEXT) in (self.MODE_URL, self.MODE_IMAGE) and rows[i] is None]
+        if imageQueries:
+            images = [self._loadImage(queries[i]['input'], queries[i]['mode']) for i in imageQueries]
+            for i, features in zip(imageQueries, self._encodeImages(images)):
+                queryFeatures[i] = features
+
+        if any(features is None for features in queryFeatures):
+            raise Exception("Unknown query mode")
+
+        ks = [query.get('numResults', numResults) for query in queries]
+        minScores = [query.get('minScore', minScore) for query in queries]
+        excluded = [row if query.get('mode') == self.MODE_ID else None for query, row in zip(queries, rows)]
+        results = self._searchBatch(np.stack(queryFeatures), [k + (row is not None) for k, row in zip(ks, excluded)], minScores, nprobe)
+        return [self._buildResults(*(self._excludeRow(indices, scores, row, k) if row is not None else (indices, scores)))
+            for (indices, scores), k, row in zip(results, ks, excluded)]
@@ -0,0 +1,325 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image
+
+__all__ = ["FeaturePipeline"]
+
+# Marks the end of the items in a queue
+_DONE = object()
+
+# The preprocessing function of a decode worker process, set when the process starts
+_workerPreprocess = None
+
+def _initDecodeWorker(preprocess):
+    global _workerPreprocess
+    _workerPreprocess = preprocess
+    # Every worker preprocesses one image at a time, more threads per process would only compete for the cores
+    import torch
+    torch.set_num_threads(1)
+
+def _decodeImage(source, preprocess=None):
+    """
+    Open an image from a file path or from its bytes and preprocess it. Returns None if the image cannot be decoded.
+    """
+    try:
+        with Image.open(BytesIO(source) if isinstance(source, (bytes, bytearray)) else source) as image:
+            return np.asarray((preprocess or _workerPreprocess)(image), dtype=np.float32)
+    except Exception:
+        return None
+
+class _Stage:
+    """
+    The counters of a stage of the pipeline.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        # The time spent working, waiting for input and waiting for room in the next queue, summed over the workers
+        self.busy = 0.0
+        self.waitingInput = 0.0
+        self.waitingOutput = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, *, items=0, failed=0, busy=0.0, waitingInput=0.0, waitingOutput=0.0):
+        with self._lock:
+            self.items += items
+            self.failed += failed
+            self.busy += busy
+            self.waitingInput += waitingInput
+            self.waitingOutput += waitingOutput
+
+    def stats(self, elapsed):
+        total = elapsed * self.workers if elapsed > 0 else 0
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'failed': self.failed,
+            'itemsPerSecond': self.items / elapsed if elapsed > 0 else 0,
+            'busy': self.busy / total if total else 0,
+            'waitingInput': self.waitingInput / total if total else 0,
+            'waitingOutput': self.waitingOutput / total if total else 0
+        }
+
+class _Occupancy:
+    """
+    The occupancy of a bounded queue, sampled at regular intervals.
+    """
+
+    def __init__(self, queue, maxSize):
+        self.queue = queue
+        self.maxSize = maxSize
+        self.samples = 0
+        self.total = 0
+        self.max = 0
+
+    def sample(self):
+        size = self.queue.qsize()
+        self.samples += 1
+        self.total += size
+        self.max = max(self.max, size)
+
+    def stats(self):
+        return {
+            'size': self.maxSize,
+            'average': self.total / self.samples if self.samples else 0,
+            'max': self.max
+        }
+
+class FeaturePipeline:
+    """
+    Computes the features of images in overlapping stages, so that the network, the CPU cores and the model are
+    busy at the same time instead of one after the other:
+
+        fetch (threads) -> decode and preprocess (processes) -> encode (calling thread, in batches)
+
+    The stages are connected by bounded queues. A stage that is faster than the next one blocks when the queue to
+    the next stage is full, so the number of images in memory is bounded however many images are processed. The
+    throughput of every stage, the share of the time its workers were busy or waiting for input or for the next
+    stage, and the occupancy of the queues are reported by stats(). If the encoder spends much of its time waiting
+    for input, the earlier stages need more workers.
+
+    Usage Example:
+
+        pipeline = FeaturePipeline(fetch=downloadImage, preprocess=preprocess, encode=encodeImages, batchSize=64)
+        for identifiers, features in pipeline.run((identifier, url) for identifier, url in images):
+            ...
+        print(pipeline.stats())
+    """
+
+    def __init__(self, *, fetch, preprocess, encode, fetchThreads=16, decodeProcesses=None, batchSize=64, queueSize=None, reportInterval=10):
+        """
+        Instantiate the pipeline.
+
+        params:
+            fetch: A function called with the source of an image, e.g. its IIIF URL, in a fetch thread. Returns the path of
+                   the image file or the bytes of the image, or None if the image cannot be fetched.
+            preprocess: The preprocessing function of the CLIP model, called with a PIL image in a decode process.
+                        Must be picklable if decodeProcesses is not 0.
+            encode: A function called with a batch of preprocessed images, as an array of shape (images, channels, height,
+                    width), returning their normalized features.
+            fetchThreads: The number of threads fetching images. Defaults to 16.
+            decodeProcesses: The number of processes decoding and preprocessing images. 0 decodes in threads of the calling
+                             process. Defaults to half of the CPU cores, the other half is left to the encoder.
+            batchSize: The number of images encoded at once. Defaults to 64.
+            queueSize: The maximum number of images in each of the queues between the stages. Defaults to 4 batches.
+            reportInterval: The number of seconds between two progress reports. 0 disables them. Defaults to 10.
+        """
+        if decodeProcesses is None:
+            # With a single core, starting processes costs more than it gains
+            decodeProcesses = (os.cpu_count() or 1) // 2
+        self.fetch = fetch
+        self.preprocess = preprocess
+        self.encode = encode
+        self.fetchThreads = fetchThreads
+        self.decodeProcesses = decodeProcesses
+        self.batchSize = batchSize
+        self.queueSize = queueSize or 4 * batchSize
+        self.reportInterval = reportInterval
+        self._stages = {}
+        self._queues = {}
+        self._elapsed = 0.0
+
+    def run(self, items):
+        """
+        Fetch, decode and encode the images and yield the features of every batch of images as they are computed.
+        The order of the images within and across batches is the order in which they are ready, not the order of items.
+        Images that cannot be fetched or decoded are left out.
+
+        params:
+            items: An iterable of (identifier, source) pairs, where source is passed to fetch.
+
+        Yields (identifiers, features) tuples, with the identifiers of the images of the batch and their features.
+        """
+        # The decode stage runs as threads that each hand one image at a time to the process pool
+        decodeThreads = 2 * self.decodeProcesses if self.decodeProcesses else max(1, (os.cpu_count() or 2) // 2)
+        self._stages = {
+            'fetch': _Stage('fetch', self.fetchThreads),
+            'decode': _Stage('decode', decodeThreads),
+            'encode': _Stage('encode', 1)
+        }
+        fetched = queue.Queue(self.queueSize)
+        decoded = queue.Queue(self.queueSize)
+        self._queues = {'fetched': _Occupancy(fetched, self.queueSize), 'decoded': _Occupancy(decoded, self.queueSize)}
+        stop = threading.Event()
+        executor = None
+        if self.decodeProcesses:
+            # Worker processes are spawned, forking a process that has already run the model can deadlock its threads
+            executor = ProcessPoolExecutor(self.decodeProcesses, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_initDecodeWorker, initargs=(self.preprocess,))
+
+        items = iter(items)
+        itemsLock = threading.Lock()
+        remaining = {'fetch': self.fetchThreads, 'decode': decodeThreads}
+        remainingLock = threading.Lock()
+        # Errors of the workers other than images that cannot be fetched or decoded, raised in the calling thread
+        errors = []
+
+        def put(target, item, stage):
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self._stages[stage].add(waitingOutput=time.perf_counter() - start)
+
+        def get(source, stage):
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    item = source.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+            else:
+                item = _DONE
+            self._stages[stage].add(waitingInput=time.perf_counter() - start)
+            return item
+
+        def finish(stage, target, count):
+            # The last worker of a stage tells the workers of the next stage that there are no more items
+            with remainingLock:
+                remaining[stage] -= 1
+                last = remaining[stage] == 0
+            if last:
+                for _ in range(count):
+                    put(target, _DONE, stage)
+
+        def fetchWorker():
+            try:
+                while not stop.is_set():
+                    start = time.perf_counter()
+                    with itemsLock:
+                        item = next(items, _DONE)
+                    self._stages['fetch'].add(waitingInput=time.perf_counter() - start)
+                    if item is _DONE:
+                        break
+                    identifier, source = item
+                    start = time.perf_counter()
+                    try:
+                        image = self.fetch(source)
+                    except Exception as e:
+                        print(f"Cannot fetch image {identifier}: {e}")
+                        image = None
+                    self._stages['fetch'].add(items=1, failed=int(image is None), busy=time.perf_counter() - start)
+                    if image is not None:
+                        put(fetched, (identifier, image), 'fetch')
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                finish('fetch', fetched, decodeThreads)
+
+        def decodeWorker():
+            try:
+                while True:
+                    item = get(fetched, 'decode')
+                    if item is _DONE:
+                        break
+                    identifier, image = item
+                    start = time.perf_counter()
+                    if executor:
+                        pixels = executor.submit(_decodeImage, image).result()
+                    else:
+                        pixels = _decodeImage(image, self.preprocess)
+                    self._stages['decode'].add(items=1, failed=int(pixels is None), busy=time.perf_counter() - start)
+                    if pixels is None:
+                        print(f"Cannot decode image {identifier}")
+                    else:
+                        put(decoded, (identifier, pixels), 'decode')
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                finish('decode', decoded, 1)
+
+        def monitor():
+            lastReport = time.perf_counter()
+            while not stop.wait(0.1):
+                for occupancy in self._queues.values():
+                    occupancy.sample()
+                if self.reportInterval and time.perf_counter() - lastReport >= self.reportInterval:
+                    lastReport = time.perf_counter()
+                    self._elapsed = time.perf_counter() - started
+                    print(self.report())
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=fetchWorker, name='Fetch', daemon=True) for _ in range(self.fetchThreads)]
+        threads += [threading.Thread(target=decodeWorker, name='Decode', daemon=True) for _ in range(decodeThreads)]
+        threads.append(threading.Thread(target=monitor, name='Pipeline monitor', daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            identifiers, images = [], []
+            while True:
+                item = get(decoded, 'encode')
+                if item is not _DONE:
+                    identifiers.append(item[0])
+                    images.append(item[1])
+                if images and (len(images) == self.batchSize or item is _DONE):
+                    start = time.perf_counter()
+                    features = self.encode(np.stack(images))
+                    self._stages['encode'].add(items=len(images), busy=time.perf_counter() - start)
+                    yield identifiers, features
+                    identifiers, images = [], []
+                if item is _DONE:
+                    break
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            self._elapsed = time.perf_counter() - started
+
+    def stats(self):
+        """
+        Return the throughput and utilization of every stage and the occupancy of the queues of the last run.
+        """
+        return {
+            'elapsed': self._elapsed,
+            'stages': {name: stage.stats(self._elapsed) for name, stage in self._stages.items()},
+            'queues': {name: occupancy.stats() for name, occupancy in self._queues.items()}
+        }
+
+    def report(self):
+        """
+        Return a one-line summary of the progress of the last or current run.
+        """
+        stats = self.stats()
+        stages = ', '.join(f"{name} {stage['items']} ({stage['itemsPerSecond']:.1f}/s, {stage['busy']:.0%} busy)" for name, stage in stats['stages'].items())
+        queues = ', '.join(f"{name} {occupancy['average']:.0f}/{occupancy['size']}" for name, occupancy in stats['queues'].items())
+        return f"{stats['elapsed']:.0f}s: {stages}; queues {queues}"
@@ -0,0 +1,235 @@
+import numpy as np
+from .search import topK
+
+__all__ = ["ScalarQuantizer", "ProductQuantizer", "QUANTIZERS"]
+
+class Quantizer:
+    """
+    Base class for compressed representations of the feature matrix.
+
+    A quantizer stores one compact code per row of features.npy. A search scans the codes to
+    compute approximate scores for all rows, keeps a shortlist of the best rows and re-ranks the
+    shortlist with the full precision vectors. As only the shortlisted rows of the full precision
+    matrix are read, it can be memory-mapped and does not need to be held in memory.
+    """
+
+    FILENAME = None
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    @property
+    def rows(self):
+        return self.codes.shape[0]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a quantizer saved with save.
+        """
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def save(self, path):
+        """
+        Save the quantizer and its codes to a .npz file.
+        """
+        with open(path, 'wb') as f:
+            np.savez(f, **self._arrays())
+
+    def update(self, rows, features, *, blockSize=65536):
+        """
+        Encode rows of the feature matrix again with the trained parameters, e.g. after an incremental build changed
+        or appended them. Rows beyond the rows of the codes are added to them and must all be given.
+
+        params:
+            rows: The row numbers whose feature vectors have changed.
+            features: The feature matrix the codes are computed from.
+            blockSize: The number of rows encoded at once. Defaults to 65536.
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if np.count_nonzero(rows >= self.rows) != features.shape[0] - self.rows:
+            raise Exception("All rows appended to the feature matrix need to be encoded")
+        if features.shape[0] > self.rows:
+            self.codes = np.concatenate([self.codes, np.zeros((features.shape[0] - self.rows,) + self.codes.shape[1:], dtype=self.codes.dtype)])
+        for start in range(0, len(rows), blockSize):
+            block = rows[start:start + blockSize]
+            self.codes[block] = self._encode(np.asarray(features[block], dtype=np.float32))
+
+    def search(self, queryFeatures, features, k, *, minScore=None, rerank=1000, blockSize=65536):
+        """
+        Select the k best rows for a query vector by scanning the codes and re-ranking a shortlist.
+
+        params:
+            queryFeatures: The normalised query vector, of shape (dimensions,).
+            features: The full precision feature matrix the codes were computed from.
+            k: The maximum number of results to return.
+            minScore: Optional minimum score. It is applied to the exact scores after re-ranking.
+            rerank: The number of rows re-ranked with the full precision vectors. At least k rows are re-ranked. Defaults to 1000.
+            blockSize: The number of codes scanned at once. Defaults to 65536.
+
+        returns:
+            A tuple (indices, scores) of arrays sorted by descending score.
+        """
+        queryFeatures = np.asarray(queryFeatures, dtype=np.float32).reshape(-1)
+        shortlistSize = max(rerank, k)
+        scorer = self._scorer(queryFeatures)
+
+        shortlist = np.empty(0, dtype=np.int64)
+        shortlistScores = np.empty(0, dtype=np.float32)
+        for start in range(0, self.rows, blockSize):
+            blockIndices, blockScores = topK(scorer(self.codes[start:start + blockSize]), shortlistSize)
+            candidates = np.concatenate([shortlist, blockIndices + start])
+            selected, shortlistScores = topK(np.concatenate([shortlistScores, blockScores]), shortlistSize)
+            shortlist = candidates[selected]
+
+        # Re-rank the shortlist with the full precision vectors, reading the rows in file order
+        shortlist.sort()
+        selected, scores = topK(np.asarray(features[shortlist]) @ queryFeatures, k, minScore=minScore)
+        return shortlist[selected], scores
+
+class ScalarQuantizer(Quantizer):
+    """
+    Stores every dimension of the feature vectors as an 8 bit code, using 4 times less memory than float32.
+
+    Every dimension is mapped linearly from its minimum and maximum value in the feature matrix to the codes 0 to 255.
+
+    Usage Example:
+
+        quantizer = ScalarQuantizer.train(features)
+        quantizer.save('data/features/' + ScalarQuantizer.FILENAME)
+        indices, scores = quantizer.search(queryFeatures, features, 10)
+    """
+
+    FILENAME = 'features_int8.npz'
+
+    def __init__(self, codes, offset, scale):
+        super().__init__(codes)
+        self.offset = offset
+        self.scale = scale
+
+    @classmethod
+    def train(cls, features, *, blockSize=65536):
+        """
+        Compute the value range of every dimension and encode the feature matrix.
+        """
+        minimum = np.full(features.shape[1], np.inf, dtype=np.float32)
+        maximum = np.full(features.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, features.shape[0], blockSize):
+            block = np.asarray(features[start:start + blockSize], dtype=np.float32)
+            minimum = np.minimum(minimum, block.min(axis=0))
+            maximum = np.maximum(maximum, block.max(axis=0))
+        scale = np.maximum(maximum - minimum, np.finfo(np.float32).eps) / 255
+
+        quantizer = cls(np.empty(features.shape, dtype=np.uint8), minimum, scale.astype(np.float32))
+        for start in range(0, features.shape[0], blockSize):
+            quantizer.codes[start:start + blockSize] = quantizer._encode(np.asarray(features[start:start + blockSize], dtype=np.float32))
+        return quantizer
+
+    def _encode(self, vectors):
+        # Values outside of the trained range, e.g. of rows encoded by update, are clipped
+        return np.clip(np.rint((vectors - self.offset) / self.scale), 0, 255)
+
+    def _arrays(self):
+        return {'codes': self.codes, 'offset': self.offset, 'scale': self.scale}
+
+    def _scorer(self, queryFeatures):
+        # q . x = q . offset + (q * scale) . code
+        bias = float(queryFeatures @ self.offset)
+        scaledQuery = queryFeatures * self.scale
+        return lambda codes: codes.astype(np.float32) @ scaledQuery + bias
+
+class ProductQuantizer(Quantizer):
+    """
+    Splits the feature vectors into subvectors and stores every subvector as the 8 bit index of its
+    nearest centroid in a codebook trained with k-means. With 512 dimensions and 64 subvectors, a
+    vector takes 64 bytes instead of 2 KB.
+
+    Usage Example:
+
+        quantizer = ProductQuantizer.train(features, subvectors=64)
+        quantizer.save('data/features/' + ProductQuantizer.FILENAME)
+        indices, scores = quantizer.search(queryFeatures, features, 10)
+    """
+
+    FILENAME = 'features_pq.npz'
+    CENTROIDS = 256
+
+    def __init__(self, codes, codebooks):
+        super().__init__(codes)
+        self.codebooks = codebooks
+
+    @classmethod
+    def train(cls, features, *, subvectors=64, iterations=20, sampleSize=65536, blockSize=65536, seed=0):
+        """
+        Train a codebook per subvector and encode the feature matrix.
+
+        params:
+            features: The normalised feature matrix, of shape (rows, dimensions).
+            subvectors: The number of subvectors, which is also the number of bytes per code. Must divide the dimensions. Defaults to 64.
+            iterations: The number of k-means iterations per codebook. Defaults to 20.
+            sampleSize: The number of rows used to train the codebooks. Defaults to 65536.
+            blockSize: The number of rows encoded at once. Defaults to 65536.
+            seed: The seed of the random number generator. Defaults to 0.
+        """
+        rows, dimensions = features.shape
+        if dimensions % subvectors != 0:
+            raise Exception(f"The number of subvectors ({subvectors}) must divide the number of dimensions ({dimensions})")
+        subDimensions = dimensions // subvectors
+        centroids = min(cls.CENTROIDS, rows)
+
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(rows, size=min(sampleSize, rows), replace=False))
+        trainingFeatures = np.asarray(features[sample], dtype=np.float32).reshape(-1, subvectors, subDimensions)
+
+        codebooks = np.zeros((subvectors, cls.CENTROIDS, subDimensions), dtype=np.float32)
+        for subvector in range(subvectors):
+            codebooks[subvector, :centroids] = cls._kmeans(trainingFeatures[:, subvector], centroids, iterations, rng)
+
+        quantizer = cls(np.empty((rows, subvectors), dtype=np.uint8), codebooks)
+        for start in range(0, rows, blockSize):
+            quantizer.codes[start:start + blockSize] = quantizer._encode(np.asarray(features[start:start + blockSize], dtype=np.float32))
+        return quantizer
+
+    def _encode(self, vectors):
+        subvectors, _, subDimensions = self.codebooks.shape
+        # Codebooks trained on fewer rows than CENTROIDS are padded with zero centroids, which are not used for codes
+        centroids = max(1, int(np.any(self.codebooks != 0, axis=(0, 2)).nonzero()[0].max(initial=0)) + 1)
+        vectors = vectors.reshape(-1, subvectors, subDimensions)
+        codes = np.empty((vectors.shape[0], subvectors), dtype=np.uint8)
+        for subvector in range(subvectors):
+            codes[:, subvector] = self._nearest(vectors[:, subvector], self.codebooks[subvector, :centroids])
+        return codes
+
+    @staticmethod
+    def _nearest(vectors, centroids):
+        # argmin ||v - c||^2 = argmax (v . c - ||c||^2 / 2)
+        return np.argmax(vectors @ centroids.T - 0.5 * (centroids ** 2).sum(axis=1), axis=1)
+
+    @classmethod
+    def _kmeans(cls, vectors, centroids, iterations, rng):
+        means = vectors[rng.choice(vectors.shape[0], size=centroids, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = cls._nearest(vectors, means)
+            order = np.argsort(assignment, kind='stable')
+            counts = np.bincount(assignment, minlength=centroids)
+            # Centroids that lost all their vectors keep their previous position
+            used = counts > 0
+            offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])[used]
+            means[used] = np.add.reduceat(vectors[order], offsets, axis=0) / counts[used][:, None]
+        return means
+
+    def _arrays(self):
+        return {'codes': self.codes, 'codebooks': self.codebooks}
+
+    def _scorer(self, queryFeatures):
+        # Asymmetric distance computation: the dot products of the query subvectors with all
+        # centroids are computed once and the score of a code is the sum of its table entries
+        subvectors, _, subDimensions = self.codebooks.shape
+        tables = np.einsum('mkd,md->mk', self.codebooks, queryFeatures.reshape(subvectors, subDimensions))
+        return lambda codes: tables[np.arange(subvectors), codes].sum(axis=1)
+
+QUANTIZERS = {
+    'int8': ScalarQuantizer,
+    'pq': ProductQuantizer
+}
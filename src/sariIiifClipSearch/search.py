@@ -0,0 +1,113 @@
+import numpy as np
+
+__all__ = ["topK", "blockedTopK", "blockedTopKBatch"]
+
+def topK(scores, k, *, minScore=None):
+    """
+    Select the k highest scores from a one dimensional array of similarity scores.
+
+    Instead of sorting all N scores, the candidates are first filtered with a vectorised
+    minScore mask, then the k best survivors are selected with a partial selection
+    (np.argpartition) and only those k values are sorted. Equal scores are returned in row order.
+
+    params:
+        scores: One dimensional array of similarity scores, one per indexed image.
+        k: The maximum number of results to return.
+        minScore: Optional minimum score. Scores below this value are never returned.
+
+    returns:
+        A tuple (indices, scores) of arrays sorted by descending score.
+    """
+    scores = np.asarray(scores).reshape(-1)
+    if k is None or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+
+    if minScore is not None:
+        candidates = np.flatnonzero(scores >= minScore)
+        candidateScores = scores[candidates]
+    else:
+        candidates = None
+        candidateScores = scores
+
+    if k < candidateScores.shape[0]:
+        selected = np.argpartition(-candidateScores, k - 1)[:k]
+        # Restore index order so that the stable sort below breaks ties by row index
+        selected.sort()
+    else:
+        selected = np.arange(candidateScores.shape[0])
+
+    order = selected[np.argsort(-candidateScores[selected], kind='stable')]
+    indices = order if candidates is None else candidates[order]
+    return indices.astype(np.int64, copy=False), scores[indices]
+
+def blockedTopK(queryFeatures, features, k, *, minScore=None, blockSize=None):
+    """
+    Compute the similarity between a query vector and the rows of a feature matrix and select the k best rows.
+
+    The feature matrix is scanned in blocks of blockSize rows and the best rows of each block are
+    merged into a running top-k, so that the memory used per query is bounded by the block size
+    and not by the number of rows. This allows to search memory-mapped feature matrices that are
+    larger than the available memory.
+
+    params:
+        queryFeatures: The normalised query vector, of shape (dimensions,).
+        features: The normalised feature matrix, of shape (rows, dimensions). Can be a np.memmap.
+        k: The maximum number of results to return.
+        minScore: Optional minimum score. Scores below this value are never returned.
+        blockSize: The number of rows scanned at once. If not set, the whole matrix is scanned at once.
+
+    returns:
+        A tuple (indices, scores) of arrays sorted by descending score.
+    """
+    queryFeatures = np.asarray(queryFeatures).reshape(-1)
+    rows = features.shape[0]
+    if not blockSize or blockSize >= rows:
+        return topK(features @ queryFeatures, k, minScore=minScore)
+
+    bestIndices = np.empty(0, dtype=np.int64)
+    bestScores = np.empty(0, dtype=np.float32)
+    for start in range(0, rows, blockSize):
+        blockIndices, blockScores = topK(features[start:start + blockSize] @ queryFeatures, k, minScore=minScore)
+        # Merge the best rows of the block into the running top-k. Rows of earlier blocks come first
+        # so that equal scores are still returned in row order.
+        candidateIndices = np.concatenate([bestIndices, blockIndices + start])
+        candidateScores = np.concatenate([bestScores, blockScores])
+        selected, bestScores = topK(candidateScores, k)
+        bestIndices = candidateIndices[selected]
+    return bestIndices, bestScores
+
+def blockedTopKBatch(queryFeatures, features, ks, *, minScores=None, blockSize=None):
+    """
+    Select the best rows of a feature matrix for several query vectors at once.
+
+    The similarities of all queries are computed with a single matrix product per block of rows,
+    and every query keeps its own running top-k as in blockedTopK.
+
+    params:
+        queryFeatures: The normalised query vectors, of shape (queries, dimensions).
+        features: The normalised feature matrix, of shape (rows, dimensions). Can be a np.memmap.
+        ks: The maximum number of results to return for every query.
+        minScores: Optional minimum score for every query.
+        blockSize: The number of rows scanned at once. If not set, the whole matrix is scanned at once.
+
+    returns:
+        A list with a tuple (indices, scores) of arrays sorted by descending score for every query.
+    """
+    queryFeatures = np.asarray(queryFeatures).reshape(len(ks), -1)
+    if minScores is None:
+        minScores = [None] * len(ks)
+    rows = features.shape[0]
+    if not blockSize:
+        # An empty matrix is scanned as a single empty block
+        blockSize = rows or 1
+
+    results = [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in ks]
+    for start in range(0, rows, blockSize):
+        similarities = features[start:start + blockSize] @ queryFeatures.T
+        for i, (k, minScore) in enumerate(zip(ks, minScores)):
+            blockIndices, blockScores = topK(similarities[:, i], k, minScore=minScore)
+            bestIndices, bestScores = results[i]
+            candidateIndices = np.concatenate([bestIndices, blockIndices + start])
+            selected, bestScores = topK(np.concatenate([bestScores, blockScores]), k)
+            results[i] = (candidateIndices[selected], bestScores)
+    return results
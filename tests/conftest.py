@@ -2,7 +2,7 @@ import pytest
 import sys
 import shutil
 sys.path.append('src')
-from sariIiifClipSearch import Images
+from sariIiifClipSearch import Images, Query, StringTable
 
 @pytest.fixture(scope='module')
 def temp_data_dir(tmpdir_factory):
@@ -21,4 +21,18 @@ def images_from_csv(temp_data_dir) -> Images:
         imageCSV='tests/test_images.csv',
         threads=16,
         batchSize=64
-    )
\ No newline at end of file
+    )
+
+@pytest.fixture
+def indexed_query():
+    def create(features, imageIDs, imageUrls):
+        # A Query over the given features, without loading files or the CLIP model
+        clipQuery = Query.__new__(Query)
+        clipQuery.imageFeatures = features
+        clipQuery.imageIDs, clipQuery.imageUrls = StringTable.fromStrings(imageIDs), StringTable.fromStrings(imageUrls)
+        clipQuery.removedRows, clipQuery.removedCount = None, 0
+        clipQuery.blockSize, clipQuery.nprobe, clipQuery.ivfIndex, clipQuery.quantizer = None, None, None, None
+        clipQuery.imageEncoder = 'none'
+        clipQuery.indexVersion = 'test'
+        return clipQuery
+    return create
@@ -0,0 +1,41 @@
+import threading
+import pytest
+from sariIiifClipSearch import AdmissionLimiter, Overloaded
+
+def test_queries_beyond_the_queue_are_rejected():
+    limiter = AdmissionLimiter(1, maxQueued=1, maxWait=5)
+    release = threading.Event()
+    admitted = []
+    def run(name):
+        with limiter:
+            admitted.append(name)
+            release.wait()
+    running = threading.Thread(target=run, args=('running',))
+    running.start()
+    while limiter.running == 0:
+        pass
+    waiting = threading.Thread(target=run, args=('waiting',))
+    waiting.start()
+    while limiter.queued == 0:
+        pass
+    with pytest.raises(Overloaded) as e:
+        limiter.acquire()
+    assert e.value.retryAfter >= 1
+    release.set()
+    running.join()
+    waiting.join()
+    assert admitted == ['running', 'waiting']
+    stats = limiter.stats()
+    assert stats['admitted'] == 2 and stats['rejectedQueueFull'] == 1 and stats['maxQueuedSeen'] == 1
+    assert stats['running'] == 0 and stats['queued'] == 0
+
+def test_queries_not_admitted_in_time_are_rejected():
+    limiter = AdmissionLimiter(1, maxQueued=4, maxWait=0.05)
+    started = limiter.acquire()
+    with pytest.raises(Overloaded):
+        limiter.acquire()
+    limiter.release(started)
+    with limiter:
+        pass
+    assert limiter.stats()['rejectedDeadline'] == 1
+    assert limiter.stats()['queued'] == 0
@@ -0,0 +1,97 @@
+import json
+import os
+import numpy as np
+import pytest
+
+@pytest.fixture(scope='module')
+def api(tmp_path_factory):
+    # The service is started without an index, the collection is replaced by a Query over synthetic features
+    os.environ['CLIP_DATA_DIRECTORY'] = str(tmp_path_factory.mktemp('collection'))
+    os.environ['CLIP_RANKING_DEPTH'] = '10'
+    import api
+    api.loader.join()
+    return api
+
+@pytest.fixture
+def client(api, indexed_query):
+    from sariIiifClipSearch import Collections
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(100, 16)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    clipQuery = indexed_query(features, [f"id{i}" for i in range(100)], [f"https://example.org/iiif/{i}" for i in range(100)])
+    api.collections = Collections({'test': '.'})
+    api.collections._queries.put('test', clipQuery)
+    api.searchers.clear()
+    api.resultCache.clear()
+    api.rankingCache.clear()
+    api.ready.set()
+    return api.app.test_client()
+
+def test_query_by_unknown_image_id(client):
+    response = client.get('/query?imageId=unknown')
+    assert response.status_code == 404
+    response = client.post('/query/batch', json={'queries': [{'imageId': 'id1'}, {'imageId': 'unknown'}]})
+    assert response.status_code == 404
+    response = client.get('/query?imageId=id1&minScore=-1&limit=5')
+    assert response.status_code == 200
+    results = json.loads(response.data)
+    assert len(results) == 5 and 'id1' not in [result['imageId'] for result in results]
+
+def test_offset_paging(api, client, monkeypatch):
+    depths = []
+    runQuery = api.runQuery
+    def countingRunQuery(*args, **kwargs):
+        depths.append(kwargs['numResults'])
+        return runQuery(*args, **kwargs)
+    monkeypatch.setattr(api, 'runQuery', countingRunQuery)
+
+    def page(offset, limit=5):
+        response = client.get(f'/query?imageId=id0&minScore=-1&limit={limit}&offset={offset}')
+        assert response.status_code == 200
+        return [result['imageId'] for result in json.loads(response.data)], response.headers.get('Link')
+
+    first, link = page(0)
+    assert depths == [10]
+    assert 'offset=5' in link and 'rel="next"' in link
+    # The following page is sliced from the cached ranking
+    second, _ = page(5)
+    assert depths == [10]
+    # Pages beyond the cached ranking run the query again to a larger depth
+    third, _ = page(8)
+    assert depths == [10, 20]
+    ranking, _ = page(0, limit=20)
+    assert depths == [10, 20]
+    assert first + second == ranking[:10] and third == ranking[8:13]
+    # The last page is not full and has no link to a next page
+    last, link = page(97)
+    assert len(last) == 2 and link is None
+    assert client.get('/query?imageId=id0&offset=-1').status_code == 400
+
+def test_sparql_query_without_options(client):
+    query = """
+        PREFIX clip: <https://service.swissartresearch.net/clip/>
+        SELECT ?id ?score WHERE {
+            ?request a clip:Request ;
+                clip:queryImageId "id0" ;
+                clip:imageId ?id ;
+                clip:score ?score .
+        }
+    """
+    response = client.get('/sparql', query_string={'query': query})
+    assert response.status_code == 200
+    assert 'bindings' in json.loads(response.data)['results']
+
+def test_negative_nprobe(client):
+    assert client.get('/query?imageId=id0&nprobe=-1').status_code == 400
+    assert client.post('/query/batch', json={'queries': [{'imageId': 'id0'}], 'nprobe': -1}).status_code == 400
+    query = """
+        PREFIX clip: <https://service.swissartresearch.net/clip/>
+        SELECT ?id WHERE {
+            ?request a clip:Request ;
+                clip:queryImageId "id0" ;
+                clip:nprobe "-1" ;
+                clip:imageId ?id .
+        }
+    """
+    response = client.get('/sparql', query_string={'query': query})
+    assert json.loads(response.data) == {'error': 'nprobe must not be negative'}
@@ -0,0 +1,29 @@
+import threading
+from sariIiifClipSearch import MicroBatcher, Query
+
+class EchoQuery:
+    MODE_TEXT = Query.MODE_TEXT
+    MODE_URL = Query.MODE_URL
+    MODE_IMAGE = Query.MODE_IMAGE
+
+    def queryBatch(self, queries, *, nprobe=None):
+        if any(query['input'] == 'fail' for query in queries):
+            raise ValueError('fail')
+        return [[query['input']] * query['numResults'] for query in queries]
+
+def test_concurrent_queries_are_batched():
+    batcher = MicroBatcher(EchoQuery(), maxWait=0.2, maxBatch=4)
+    results = {}
+    errors = []
+    def run(queryString):
+        try:
+            results[queryString] = batcher.query(queryString, numResults=2)
+        except ValueError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(queryString,)) for queryString in ['a', 'b', 'fail', 'd']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {'a': ['a', 'a'], 'b': ['b', 'b'], 'd': ['d', 'd']}
+    assert len(errors) == 1
@@ -0,0 +1,52 @@
+import threading
+import time
+from sariIiifClipSearch import LRUCache
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.get('a', lambda: 1)
+    cache.get('b', lambda: 2)
+    assert cache.get('a', lambda: None) == 1
+    cache.get('c', lambda: 3)
+    assert cache.get('b', lambda: 'recomputed') == 'recomputed'
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 4 and stats['evictions'] == 2
+
+def test_concurrent_requests_are_coalesced():
+    cache = LRUCache(10)
+    calls = []
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'value'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('key', compute))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ['value'] * 5
+    assert cache.stats()['coalesced'] == 4
+
+def test_eviction_by_size():
+    evicted = []
+    cache = LRUCache(10, sizeOf=len, onEvict=lambda key, value: evicted.append(key))
+    cache.get('a', lambda: 'x' * 4)
+    cache.get('b', lambda: 'x' * 4)
+    cache.get('c', lambda: 'x' * 4)
+    assert evicted == ['a'] and cache.stats()['totalSize'] == 8
+    # The most recent entry is kept even if it exceeds the maximum size on its own
+    cache.get('d', lambda: 'x' * 20)
+    assert evicted == ['a', 'b', 'c'] and [key for key, value in cache.items()] == ['d']
+    # Replacing a value passes the previous one on as well
+    cache.put('d', 'y')
+    assert evicted == ['a', 'b', 'c', 'd'] and cache.lookup('d') == 'y'
+
+def test_entries_expire_after_ttl():
+    cache = LRUCache(10, ttl=0.05)
+    cache.put('a', 1)
+    assert cache.lookup('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a', lambda: 2) == 2
+    assert cache.stats()['expirations'] == 1
@@ -0,0 +1,79 @@
+import csv
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from sariIiifClipSearch import Downloader
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for a IIIF image server: /image answers an image, /flaky fails twice with 503 before answering
+    and /missing answers 404. The server records the client ports and the concurrent requests.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.maxActive = max(server.maxActive, server.active)
+            server.ports.add(self.client_address[1])
+            server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            count = server.requests[self.path]
+        time.sleep(0.02)
+        with server.lock:
+            server.active -= 1
+        if self.path == '/missing' or (self.path == '/flaky' and count <= 2):
+            status, body = (404 if self.path == '/missing' else 503), b''
+        else:
+            status, body = 200, b'image' + self.path.encode()
+        self.send_response(status)
+        if status == 503:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.lock = threading.Lock()
+    server.active = server.maxActive = 0
+    server.ports = set()
+    server.requests = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+def test_downloads_are_retried_and_failures_recorded(server, tmp_path):
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    downloader = Downloader(retries=3, backoff=0.01)
+    assert downloader.download(url + '/flaky', tmp_path / 'flaky.jpg')
+    assert (tmp_path / 'flaky.jpg').read_bytes() == b'image/flaky'
+    assert not downloader.download(url + '/missing', tmp_path / 'missing.jpg')
+    assert not (tmp_path / 'missing.jpg').exists()
+    assert list(tmp_path.iterdir()) == [tmp_path / 'flaky.jpg']
+    assert server.requests == {'/flaky': 3, '/missing': 1}
+
+    downloader.writeFailures(tmp_path / 'failures.csv')
+    with open(tmp_path / 'failures.csv') as f:
+        failures = list(csv.DictReader(f))
+    assert [(failure['url'], failure['status'], failure['attempts']) for failure in failures] == [(url + '/missing', '404', '1')]
+
+def test_requests_per_host_are_limited_and_connections_reused(server):
+    url = f"http://127.0.0.1:{server.server_address[1]}/image"
+    downloader = Downloader(hostConcurrency=2, hostRate=100, poolSize=4)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [downloader.fetch(url) for _ in range(5)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.maxActive <= 2
+    # 20 requests at 100 requests per second
+    assert time.monotonic() - start >= 0.19
+    assert len(server.ports) <= 4
+    assert downloader.stats()['downloads'] == 20
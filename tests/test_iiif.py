@@ -0,0 +1,39 @@
+import json
+from sariIiifClipSearch import ImageServices
+
+def test_derivatives_are_sized_for_the_model():
+    infos = {
+        'https://v2.example.org/iiif/a/info.json': {
+            '@context': 'http://iiif.io/api/image/2/context.json',
+            'profile': ['http://iiif.io/api/image/2/level2.json', {'formats': ['webp'], 'maxWidth': 400}]
+        },
+        'https://v3.example.org/iiif/b/info.json': {
+            '@context': 'http://iiif.io/api/image/3/context.json',
+            'profile': 'level0'
+        },
+        'https://v3l1.example.org/iiif/e/info.json': {
+            '@context': 'http://iiif.io/api/image/3/context.json',
+            'profile': 'level1', 'width': 3000, 'height': 2000
+        },
+        'https://v3sized.example.org/iiif/f/info.json': {
+            '@context': 'http://iiif.io/api/image/3/context.json',
+            'profile': 'level1', 'extraFeatures': ['sizeByConfinedWh'], 'width': 3000, 'height': 2000
+        }
+    }
+    fetched = []
+    def fetch(url):
+        fetched.append(url)
+        return json.dumps(infos[url]).encode() if url in infos else None
+
+    services = ImageServices(fetch, size=224, formats=('webp', 'jpg'))
+    assert services.url('https://v2.example.org/iiif/a') == 'https://v2.example.org/iiif/a/full/!400,400/0/default.webp'
+    assert services.url('https://v2.example.org/iiif/c/') == 'https://v2.example.org/iiif/c/full/!400,400/0/default.webp'
+    assert services.url('https://v3.example.org/iiif/b') == 'https://v3.example.org/iiif/b/full/max/0/default.jpg'
+    # Level 1 servers are asked for a width that fits the aspect ratio of their first image
+    assert services.url('https://v3l1.example.org/iiif/e') == 'https://v3l1.example.org/iiif/e/full/336,/0/default.jpg'
+    assert services.url('https://v3sized.example.org/iiif/f') == 'https://v3sized.example.org/iiif/f/full/!448,448/0/default.jpg'
+    # Unknown servers are assumed to be of level 1, without the size of an image the fixed width is requested
+    assert services.url('https://unknown.example.org/iiif/d') == 'https://unknown.example.org/iiif/d/full/640,/0/default.jpg'
+    # info.json is read once per server
+    assert len(fetched) == 5
+    assert services.stats()['v2.example.org']['formats'] == ['jpg', 'png', 'webp']
@@ -1,7 +1,64 @@
+from sariIiifClipSearch import Images, ImageServices
+
 def test_download(images_from_csv):
     images_from_csv.downloadImages()
     assert True
 
 def test_process(images_from_csv):
     images_from_csv.processImages()
-    assert True
\ No newline at end of file
+    assert True
+
+def test_streaming_does_not_store_images(tmp_path):
+    images = Images(mode=Images.MODE_CSV, imageCSV='tests/test_images.csv', dataDir=tmp_path, storeImages=False)
+    images.imageServices = ImageServices(lambda url: None, size=224)
+    images.downloader.fetch = lambda url: b'image' if url.startswith('https://example.org/a/') else None
+
+    assert images._fetchImage('https://example.org/a') == b'image'
+    assert images._fetchImage('https://example.org/b') is None
+    assert not (tmp_path / 'images').exists()
+
+def test_incremental_merge_appends_updates_and_removes_rows(tmp_path):
+    import csv
+    import numpy as np
+    from sariIiifClipSearch import readImageLookup, readRemovedRows, IVFIndex, ScalarQuantizer, IndexBundle
+
+    def writeCSV(urls):
+        with open(tmp_path / 'images.csv', 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['iiif_url', 'localIdentifier'])
+            writer.writeheader()
+            writer.writerows({'iiif_url': url, 'localIdentifier': images._customHash(url)} for url in urls)
+
+    images = Images(mode=Images.MODE_CSV, dataDir=tmp_path, storeImages=False)
+    ids = {name: images._customHash(name) for name in 'abcdef'}
+    writeCSV('abcde')
+    images._writeBatch(0, [ids[name] for name in 'abc'], np.eye(8, dtype=np.float32)[:3], ['1', '2', '3'])
+    images._writeBatch(1, [ids[name] for name in 'de'], np.eye(8, dtype=np.float32)[3:5], ['4', '5'])
+    images._mergeBatches()
+    assert np.load(tmp_path / 'features' / 'features.npy').shape == (5, 8)
+    images.buildIndex(lists=2)
+    images.quantizeFeatures('int8')
+    images.writeBundle()
+
+    # f is added, b changes and e is removed
+    writeCSV('abcdf')
+    images._writeBatch(2, [ids['f'], ids['b']], np.eye(8, dtype=np.float32)[[5, 6]], ['6', '7'])
+    images._mergeBatches()
+    features = np.load(tmp_path / 'features' / 'features.npy')
+    assert features.shape == (6, 8)
+    assert features[1, 6] == 1 and features[5, 5] == 1 and not features[4].any()
+    assert list(readRemovedRows(tmp_path / 'features')) == [4]
+    imageIDs, imageUrls = readImageLookup(tmp_path / 'features', tmp_path / 'images.csv')
+    assert imageIDs[5] == ids['f'] and imageUrls[4] == ''
+    # The index and the quantized features are updated with the changed rows, the bundle is removed instead of rewritten
+    assert not images.featuresRewritten and not (tmp_path / 'features' / IndexBundle.FILENAME).exists()
+    index = IVFIndex.load(tmp_path / 'features' / IVFIndex.FILENAME)
+    lists = np.repeat(np.arange(index.lists), np.diff(index.listOffsets))[np.argsort(index.listRows)]
+    assert list(lists) == list(np.argmax(features @ index.centroids.T, axis=1))
+    quantizer = ScalarQuantizer.load(tmp_path / 'features' / ScalarQuantizer.FILENAME)
+    assert quantizer.rows == 6 and np.array_equal(quantizer.codes[[1, 4, 5]], quantizer._encode(features[[1, 4, 5]]))
+
+    # e is added again with its earlier features
+    writeCSV('abcdef')
+    images._mergeBatches()
+    assert np.load(tmp_path / 'features' / 'features.npy')[4, 4] == 1
+    assert len(readRemovedRows(tmp_path / 'features')) == 0
@@ -0,0 +1,34 @@
+import numpy as np
+from io import BytesIO
+from PIL import Image
+from sariIiifClipSearch import FeaturePipeline
+
+def jpeg(value):
+    buffer = BytesIO()
+    Image.new('RGB', (8, 8), (value, value, value)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+def test_pipeline_encodes_all_images_in_batches():
+    images = {f"image{i}": jpeg(i) for i in range(10)}
+    images['broken'] = b'not an image'
+    def fetch(source):
+        return None if source == 'missing' else images[source]
+    def preprocess(image):
+        return np.asarray(image, dtype=np.float32).mean(axis=(0, 1))
+    def encode(batch):
+        assert len(batch) <= 4
+        return batch[:, :1]
+
+    pipeline = FeaturePipeline(fetch=fetch, preprocess=preprocess, encode=encode, fetchThreads=3, decodeProcesses=0, batchSize=4, queueSize=2, reportInterval=0)
+    items = [(name, name) for name in images] + [('missing', 'missing')]
+    results = {}
+    for identifiers, features in pipeline.run(items):
+        results.update(zip(identifiers, features[:, 0]))
+
+    assert set(results) == {f"image{i}" for i in range(10)}
+    assert abs(results['image7'] - 7) < 2
+    stats = pipeline.stats()
+    assert stats['stages']['fetch']['items'] == 12 and stats['stages']['fetch']['failed'] == 1
+    assert stats['stages']['decode']['failed'] == 1
+    assert stats['stages']['encode']['items'] == 10
+    assert stats['queues']['fetched']['max'] <= 2
@@ -0,0 +1,166 @@
+import pytest
+import numpy as np
+import torch
+from sariIiifClipSearch import topK, blockedTopK, blockedTopKBatch, IVFIndex, ScalarQuantizer, ProductQuantizer, IndexBundle
+
+def test_topk_matches_full_sort():
+    scores = np.random.default_rng(0).normal(0.2, 0.05, 1000).astype(np.float32)
+    indices, topScores = topK(scores, 10, minScore=0.2)
+    expected = [i for i in np.argsort(-scores, kind='stable') if scores[i] >= 0.2][:10]
+    assert list(indices) == expected
+    assert np.array_equal(topScores, scores[expected])
+
+def test_topk_min_score():
+    scores = np.array([0.1, 0.5, 0.3, 0.25], dtype=np.float32)
+    indices, topScores = topK(scores, 10, minScore=0.26)
+    assert list(indices) == [1, 2]
+    assert len(topK(scores, 0)[0]) == 0
+
+def test_blocked_topk_matches_full_scan():
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(1000, 16)).astype(np.float32)
+    queryFeatures = rng.normal(size=16).astype(np.float32)
+    expected = topK(features @ queryFeatures, 20)
+    indices, scores = blockedTopK(queryFeatures, features, 20, blockSize=64)
+    assert list(indices) == list(expected[0])
+    assert np.allclose(scores, expected[1])
+
+def test_blocked_topk_of_an_empty_matrix():
+    features = np.empty((0, 4), dtype=np.float32)
+    queryFeatures = np.ones((2, 4), dtype=np.float32)
+    assert len(blockedTopK(queryFeatures[0], features, 5)[0]) == 0
+    for blockSize in (None, 64):
+        results = blockedTopKBatch(queryFeatures, features, [5, 3], blockSize=blockSize)
+        assert [len(indices) for indices, _ in results] == [0, 0]
+
+def test_ivf_index_probing_all_lists_is_exact(tmp_path):
+    rng = np.random.default_rng(2)
+    features = rng.normal(size=(2000, 16)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    IVFIndex.train(features, lists=16).save(tmp_path / IVFIndex.FILENAME)
+    index = IVFIndex.load(tmp_path / IVFIndex.FILENAME)
+    queryFeatures = features[0]
+    indices, scores = index.search(queryFeatures, features, 10, nprobe=index.lists)
+    assert list(indices) == list(topK(features @ queryFeatures, 10)[0])
+    assert indices[0] == 0
+    # A negative nprobe scans a single list
+    assert index.search(queryFeatures, features, 10, nprobe=-1)[0][0] == 0
+
+def test_quantizers_rerank_to_exact_scores(tmp_path):
+    rng = np.random.default_rng(3)
+    features = rng.normal(size=(600, 16)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    queryFeatures = features[7]
+    expected = topK(features @ queryFeatures, 5)
+    for quantizer in [ScalarQuantizer.train(features), ProductQuantizer.train(features, subvectors=4, iterations=5)]:
+        quantizer.save(tmp_path / quantizer.FILENAME)
+        quantizer = type(quantizer).load(tmp_path / quantizer.FILENAME)
+        indices, scores = quantizer.search(queryFeatures, features, 5, rerank=600)
+        assert list(indices) == list(expected[0])
+        assert np.allclose(scores, expected[1])
+
+def test_blocked_topk_batch_matches_single_queries():
+    rng = np.random.default_rng(4)
+    features = rng.normal(size=(500, 16)).astype(np.float32)
+    queryFeatures = rng.normal(size=(3, 16)).astype(np.float32)
+    results = blockedTopKBatch(queryFeatures, features, [5, 1, 10], minScores=[None, 0.0, 1.0], blockSize=64)
+    for (indices, scores), query, k, minScore in zip(results, queryFeatures, [5, 1, 10], [None, 0.0, 1.0]):
+        expected = topK(features @ query, k, minScore=minScore)
+        assert list(indices) == list(expected[0])
+
+def test_trimmed_text_encoding_matches_full_context():
+    from clip.model import CLIP
+    torch.manual_seed(0)
+    model = CLIP(64, 32, 1, 64, 16, 77, 1000, 64, 2, 2).eval()
+    text = torch.zeros(2, 77, dtype=torch.long)
+    text[0, :4] = torch.tensor([998, 10, 20, 999])
+    text[1, :7] = torch.tensor([998, 1, 2, 3, 4, 5, 999])
+    with torch.no_grad():
+        assert torch.allclose(model.encode_text(text), model.encode_text(text, trim=False), atol=1e-5)
+
+def test_text_only_model_loads_image_encoder_later():
+    from clip.model import CLIP, build_model, load_visual
+    torch.manual_seed(0)
+    # build_model rounds the weights to fp16, so both models are built by it
+    stateDict = CLIP(64, 32, 1, 64, 16, 77, 1000, 64, 1, 2).state_dict()
+    model = build_model(dict(stateDict)).float()
+    textOnly = build_model(dict(stateDict), visual=False).float()
+    assert textOnly.visual is None
+    text = torch.randint(1, 998, (3, 77))
+    text[:, 10] = 999
+    with torch.no_grad():
+        assert torch.allclose(model.encode_text(text), textOnly.encode_text(text), atol=1e-5)
+        load_visual(textOnly, dict(stateDict))
+        textOnly.visual.float()
+        images = torch.randn(2, 3, 32, 32)
+        assert torch.allclose(model.encode_image(images), textOnly.encode_image(images), atol=1e-5)
+
+def test_model_checksum_is_only_computed_when_the_file_changes(tmp_path, monkeypatch):
+    import hashlib
+    from clip import clip
+    path = tmp_path / 'model.pt'
+    path.write_bytes(b'weights')
+    expected = hashlib.sha256(b'weights').hexdigest()
+    assert clip._verify(str(path), expected)
+
+    computed = []
+    sha256 = clip._sha256
+    monkeypatch.setattr(clip, '_sha256', lambda p: computed.append(p) or sha256(p))
+    assert clip._verify(str(path), expected)
+    assert computed == []
+
+    path.write_bytes(b'other weights')
+    assert not clip._verify(str(path), expected)
+    assert len(computed) == 1
+
+def test_index_bundle_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(300, 16)).astype(np.float32)
+    imageIDs = [f"image{i % 250}" for i in range(300)]
+    imageUrls = [f"https://example.org/iiif/{i}/é" for i in range(300)]
+    IndexBundle.write(tmp_path / IndexBundle.FILENAME, features, imageIDs, imageUrls, model='ViT-B/32', blockSize=64)
+
+    bundle = IndexBundle.load(tmp_path / IndexBundle.FILENAME)
+    assert bundle.model == 'ViT-B/32' and bundle.rows == 300
+    assert np.array_equal(bundle.features, features)
+    assert [bundle.imageIDs[i] for i in range(300)] == imageIDs
+    assert [bundle.imageUrls[i] for i in range(300)] == imageUrls
+    # Duplicate IDs resolve to their first row
+    assert bundle.imageIDs.find('image7') == 7
+    assert bundle.imageUrls.find(imageUrls[123]) == 123
+    assert bundle.imageIDs.find('image250') is None
+
+def test_query_by_indexed_image(indexed_query):
+    from sariIiifClipSearch import Query
+    rng = np.random.default_rng(5)
+    features = rng.normal(size=(50, 16)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    features[1] = features[0]
+    clipQuery = indexed_query(features, [f"id{i}" for i in range(50)], [f"https://example.org/iiif/{i}" for i in range(50)])
+
+    # The query image is excluded from its own results, an identical image is found first
+    results = clipQuery.query('id0', mode=Query.MODE_ID, numResults=5, minScore=None)
+    assert len(results) == 5 and results[0]['imageId'] == 'id1'
+    assert 'id0' not in [result['imageId'] for result in results]
+    batchResults = clipQuery.queryBatch([{'input': 'id0', 'mode': Query.MODE_ID, 'numResults': 5, 'minScore': None}])
+    assert [result['imageId'] for result in batchResults[0]] == [result['imageId'] for result in results]
+
+    # Images are found by their ID, base URI, info.json and requests of the whole image
+    for url in ['id3', 'https://example.org/iiif/3', 'https://example.org/iiif/3/', 'https://example.org/iiif/3/info.json',
+                'https://example.org/iiif/3/full/max/0/default.jpg', 'https://example.org/iiif/3/square/!400,400/0/color.png']:
+        assert clipQuery._lookupRow(url, Query.MODE_ID) == 3
+    assert clipQuery.hasImage('https://example.org/iiif/3/full/640,/0/default.jpg')
+    assert clipQuery.canQuery('https://example.org/iiif/3', Query.MODE_URL)
+
+    # Crops, rotations and other qualities are not the stored image
+    for url in ['https://example.org/iiif/3/0,0,50,50/full/0/default.jpg', 'https://example.org/iiif/3/full/max/90/gray.png',
+                'https://example.org/iiif/3/pct:10,10,20,20/200,/!0/bitonal.jpg']:
+        assert clipQuery._lookupRow(url, Query.MODE_URL) is None
+        assert not clipQuery.canQuery(url, Query.MODE_URL)
+
+    # Unknown images
+    assert not clipQuery.hasImage('unknown')
+    with pytest.raises(Exception, match='not indexed'):
+        clipQuery.query('unknown', mode=Query.MODE_ID)
+    with pytest.raises(Exception, match='not indexed'):
+        clipQuery.queryBatch([{'input': 'unknown', 'mode': Query.MODE_ID}])